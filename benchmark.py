@@ -0,0 +1,406 @@
+#!/usr/bin/python3
+"""
+Benchmark the hot paths of database_tools on generated data.
+
+Every scale gets its own temporary SQLite database, filled from a seeded random generator, so runs with the same
+seed are comparable. The results are printed (or written with --output) as JSON.
+
+With --check, nothing is timed: a seeded series of operations runs against both storage backends, SQLite and memory,
+and the results are compared. The exit status is 1 if they differ.
+
+Usage: ``python3 benchmark.py [--scales small,medium] [--repeat 200] [--seed 1] [--output results.json] [--check]``
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+import constants
+import database_tools as db
+import drop_sampler
+import storage
+
+SCALES = {
+    "small": {"characters": 1000, "images_per_character": 3, "shows": 100, "users": 100, "waifus": 10000},
+    "medium": {"characters": 10000, "images_per_character": 3, "shows": 1000, "users": 1000, "waifus": 100000},
+    "large": {"characters": 50000, "images_per_character": 4, "shows": 5000, "users": 5000, "waifus": 1000000},
+}
+
+# What --check fills both backends with, and how many operations it compares.
+CHECK_SIZES = {"characters": 300, "images_per_character": 2, "shows": 30, "users": 20, "guilds": 3, "operations": 3000}
+
+# Operations whose results come back in an unspecified order, compared sorted.
+UNORDERED_OPERATIONS = {"remove_waifus", "set_favorites", "get_shows_from_character"}
+
+# Searches return the best ranked matches, which the backends rank differently. When there are more matches than
+# that, only the number returned is compared.
+RANKED_OPERATIONS = {"get_character_data_like", "get_shows_like"}
+SEARCH_LIMIT = 25
+
+SYLLABLES = [
+    "a", "ka", "ki", "ku", "ko", "sa", "shi", "su", "ta", "chi", "tsu", "na", "ni", "no", "ha", "hi", "ma", "mi",
+    "mo", "ya", "yu", "yo", "ra", "ri", "ru", "re", "to", "sho", "ryu", "kyo", "n", "ei", "ou",
+]
+
+KANA = [
+    "ア", "カ", "キ", "ク", "サ", "シ", "ス", "タ", "チ", "ナ", "ニ", "ハ", "ヒ", "マ", "ミ", "ヤ", "ユ", "ラ", "リ", "ル",
+]
+
+# How many cards each side offers in the trade benchmark.
+TRADE_SIZE = 5
+
+
+def random_name(rng, parts):
+    return " ".join(
+        "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+        for _ in range(parts)
+    )
+
+
+def generate(rng, characters, images_per_character, shows, users, waifus):
+    """
+    Fill the current database with random characters, images, shows, show links, users and waifus.
+    """
+
+    conn, cursor = db.get_connection()
+    with conn:
+        character_rows = [(char_id, random_name(rng, 2), None) for char_id in range(1, characters + 1)]
+        cursor.executemany("""INSERT INTO character (id, en_name, jp_name) VALUES (?,?,?);""", character_rows)
+
+        for char_id, _, _ in character_rows:
+            db.index_character_name(cursor, char_id)
+
+        cursor.executemany("""INSERT INTO images (character_id, mal_url, normal_url, mirror_url, flipped_url, image_index)
+VALUES (?,?,?,?,?,?);""", [
+            (char_id, f"mal/{char_id}/{index}", f"normal/{char_id}/{index}", f"mirror/{char_id}/{index}", f"flipped/{char_id}/{index}", index)
+            for char_id in range(1, characters + 1)
+            for index in range(1, images_per_character + 1)
+        ])
+        image_count = characters * images_per_character
+
+        cursor.executemany("""INSERT INTO show (mal_id, jp_title, en_title, is_manga) VALUES (?,?,?,?);""", [
+            (mal_id, random_name(rng, 3), random_name(rng, 2), rng.random() < 0.3)
+            for mal_id in range(1, shows + 1)
+        ])
+
+        # Every character is in one show, some in a second one.
+        links = set()
+        for char_id in range(1, characters + 1):
+            links.add((char_id, rng.randint(1, shows)))
+            if rng.random() < 0.2:
+                links.add((char_id, rng.randint(1, shows)))
+        cursor.executemany("""INSERT INTO show_character (char_id, show_id) VALUES (?,?);""", sorted(links))
+
+        cursor.executemany("""INSERT INTO user (id, currency, last_daily, last_daily_day) VALUES (?,?,?,?);""", [
+            (user_id, rng.randint(0, 100000), "2000-01-01 00:00:00", 0)
+            for user_id in range(1, users + 1)
+        ])
+
+        # A few users hold most of the cards, like on the real bot.
+        weights = [1 / user_id for user_id in range(1, users + 1)]
+        owners = rng.choices(range(1, users + 1), weights = weights, k = waifus)
+        cursor.executemany("""INSERT INTO waifus (user_id, images_id, rarity, favorite) VALUES (?,?,?,?);""", [
+            (owner, rng.randint(1, image_count), rng.choices(range(6), weights = [50, 25, 13, 7, 4, 1])[0], rng.random() < 0.05)
+            for owner in owners
+        ])
+
+        conn.commit()
+        cursor.execute("""ANALYZE;""")
+        conn.commit()
+    db.catalog_changed()
+
+
+def time_calls(repeat, call, prepare = None):
+    """
+    Run call() `repeat` times and summarize the durations in milliseconds.
+    If prepare is given, each call gets the arguments it returns. Preparing is not timed.
+    """
+
+    durations = []
+    for _ in range(repeat):
+        args = prepare() if prepare else ()
+        start = time.perf_counter()
+        call(*args)
+        durations.append((time.perf_counter() - start) * 1000)
+
+    durations.sort()
+    return {
+        "calls": repeat,
+        "mean_ms": statistics.fmean(durations),
+        "p50_ms": durations[len(durations) // 2],
+        "p95_ms": durations[min(len(durations) - 1, int(0.95 * len(durations)))],
+        "min_ms": durations[0],
+        "max_ms": durations[-1],
+    }
+
+
+def check_operations(backend, seed, characters, images_per_character, shows, users, guilds, operations):
+    """
+    Fill a backend through the StorageBackend interface, then run a seeded mix of operations on it.
+    Yields the name, arguments and result of every operation. Backends that behave the same yield the same.
+    """
+
+    rng = random.Random(seed)
+
+    names = []
+    for char_id in range(1, characters + 1):
+        en_name = random_name(rng, 2)
+        jp_name = "".join(rng.choice(KANA) for _ in range(rng.randint(2, 5))) if rng.random() < 0.5 else None
+        images = [
+            types.SimpleNamespace(mal_url = f"mal/{char_id}/{index}", normal_url = f"normal/{char_id}/{index}",
+                                  mirror_url = f"mirror/{char_id}/{index}", upside_down_url = f"flipped/{char_id}/{index}")
+            for index in range(1, images_per_character + 1)
+        ]
+        backend.insert_character({"char_id": char_id, "en_name": en_name, "jp_name": jp_name, "images": images})
+        names.append(en_name)
+        if jp_name:
+            names.append(jp_name)
+
+    titles = []
+    for mal_id in range(1, shows + 1):
+        jp_title = random_name(rng, 3)
+        is_manga = rng.random() < 0.3
+        backend.insert_show(mal_id, jp_title, random_name(rng, 2), is_manga)
+        show_id = backend.get_show_id_by_mal(mal_id, is_manga)
+        yield "get_show_id_by_mal", (mal_id, is_manga), show_id
+        for char_id in rng.sample(range(1, characters + 1), 10):
+            backend.add_show_to_character(char_id, show_id)
+        titles.append(jp_title)
+
+    for guild_id in range(1, guilds + 1):
+        backend.assign_channel_to_guild(100 + guild_id, guild_id)
+
+    image_count = characters * images_per_character
+    user_ids = range(1, users + 1)
+
+    def fragment(name):
+        start = rng.randint(0, max(0, len(name) - 4))
+        return name[start:start + rng.randint(1, 5)]
+
+    def owned(user_id, count, max_rarity = 5):
+        waifus_ids = [waifu["waifus_id"] for waifu in backend.get_all_waifu_data_for_user(user_id) if waifu["rarity"] <= max_rarity]
+        return rng.sample(waifus_ids, min(count, len(waifus_ids)))
+
+    def offer(user_id):
+        return types.SimpleNamespace(money = rng.choice([0, 0, 50, 5000]),
+                                     waifus = [types.SimpleNamespace(waifu_id = waifus_id) for waifus_id in owned(user_id, 2)])
+
+    def drop(guild_id):
+        history = backend.get_history(guild_id)
+        data = backend.get_drop_data(history)
+        backend.update_history(guild_id, history, data)
+        return data
+
+    def drop_reward(*args):
+        slot = backend.add_drop_reward(*args)
+        # The SQLite backend writes rewards on the bot's next tick, which decides the ids the new cards get.
+        backend.flush_pending_rewards()
+        return slot
+
+    mix = [
+        ("add_user_currency", backend.add_user_currency, lambda: (rng.choice(user_ids), rng.randint(1, 500))),
+        ("change_user_currency", backend.change_user_currency, lambda: (rng.choice(user_ids), -100, rng.choice([0, 100, 2000]))),
+        ("transfer_user_currency", backend.transfer_user_currency, lambda: (*rng.sample(user_ids, 2), rng.randint(1, 1000))),
+        ("set_user_currency", backend.set_user_currency, lambda: (rng.choice(user_ids), rng.randint(0, 3000))),
+        ("claim_daily", backend.claim_daily, lambda: (rng.choice(user_ids),)),
+        ("add_user_upgrades", backend.add_user_upgrades, lambda: (rng.choice(user_ids), rng.randint(1, 3))),
+        ("get_user_state", backend.get_user_state, lambda: (rng.choice(user_ids),)),
+        ("add_waifu", backend.add_waifu, lambda: (rng.choice(user_ids), rng.randint(1, image_count), rng.randint(0, 5))),
+        ("add_drop_reward", drop_reward, lambda: (rng.choice(user_ids), rng.randint(1, image_count), rng.randint(0, 5), rng.randint(0, 100), rng.randint(0, 1))),
+        ("get_drop_data", drop, lambda: (rng.randint(1, guilds),)),
+        ("roll_waifus", backend.roll_waifus, lambda: (rng.choice(user_ids), rng.choice([100, 300, 1000]), rng.randint(1, 5))),
+        ("get_waifu_count", backend.get_waifu_count, lambda: (rng.choice(user_ids),)),
+        ("get_all_waifu_data_for_user", backend.get_all_waifu_data_for_user, lambda: (rng.choice(user_ids),)),
+        ("get_waifu_page", backend.get_waifu_page, lambda: (rng.choice(user_ids), None, None, 5)),
+        ("get_waifus_by_indices", backend.get_waifus_by_indices, lambda: (rng.choice(user_ids), [rng.randint(-5, 30) for _ in range(3)])),
+        ("remove_waifus", backend.remove_waifus, lambda: (lambda user_id: (user_id, owned(user_id, 3)))(rng.choice(user_ids))),
+        ("set_favorites", backend.set_favorites, lambda: (lambda user_id: (user_id, owned(user_id, 3), rng.random() < 0.7))(rng.choice(user_ids))),
+        ("upgrade_user_waifu", backend.upgrade_user_waifu, lambda: (lambda user_id: (user_id, (owned(user_id, 1, max_rarity = 4) or [0])[0], 1))(rng.choice(user_ids))),
+        ("trade", backend.trade, lambda: (lambda user1_id, user2_id: (user1_id, user2_id, offer(user1_id), offer(user2_id)))(*rng.sample(user_ids, 2))),
+        ("get_character_info", backend.get_character_info, lambda: (rng.randint(1, characters),)),
+        ("get_shows_from_character", backend.get_shows_from_character, lambda: (rng.randint(1, characters),)),
+        ("get_characters_from_show", backend.get_characters_from_show, lambda: (rng.randint(1, shows),)),
+        ("get_character_data_like", backend.get_character_data_like, lambda: (fragment(rng.choice(names)),)),
+        ("get_character_data_by_name", backend.get_character_data_by_name, lambda: (rng.choice([rng.choice(names), fragment(rng.choice(names))]),)),
+        ("get_character_ids_with_name_part", backend.get_character_ids_with_name_part, lambda: (fragment(rng.choice(names)),)),
+        ("get_shows_like", backend.get_shows_like, lambda: (fragment(rng.choice(titles)),)),
+        ("disable_drops", backend.disable_drops, lambda: (rng.randint(1, guilds),)),
+        ("enable_drops", backend.enable_drops, lambda: (rng.randint(1, guilds),)),
+        ("get_guild_config", backend.get_guild_config, lambda: (rng.randint(1, guilds + 1),)),
+    ]
+
+    for _ in range(operations):
+        operation, call, arguments = rng.choice(mix)
+        args = arguments()
+        # Drops and rarities use the random module, which both backends share. Seed it for every operation, so they
+        # draw the same.
+        random.seed(rng.getrandbits(64))
+        yield operation, args, call(*args)
+
+
+def comparable(operation, result):
+    """
+    Turn a result into what --check compares, ignoring differences the backends are allowed to have.
+    """
+
+    if operation in UNORDERED_OPERATIONS:
+        if isinstance(result, tuple):
+            return (sorted(result[0]), *result[1:])
+        return sorted(result)
+    if operation in RANKED_OPERATIONS:
+        return sorted(result, key = lambda match: match["id"]) if len(result) < SEARCH_LIMIT else len(result)
+    return result
+
+
+def run_check(seed, directory):
+    """
+    Run the same operations against the SQLite and the memory backend and compare the results.
+    Returns a report with the first mismatch, if any.
+    """
+
+    backends = [storage.SQLiteBackend(os.path.join(directory, "check.sqlite")), storage.MemoryBackend()]
+    runs = [check_operations(backend, seed, **CHECK_SIZES) for backend in backends]
+
+    compared = 0
+    for (operation, args, result), (_, _, expected) in zip(*runs):
+        compared += 1
+        if comparable(operation, result) != comparable(operation, expected):
+            # The operations that follow depend on this result, so they can't be compared anymore.
+            return {"compared": compared, "mismatch": {"operation": operation, "arguments": repr(args), "sqlite": repr(result), "memory": repr(expected)}}
+
+    return {"compared": compared, "mismatch": None}
+
+
+def run_scale(name, sizes, repeat, seed, directory):
+    rng = random.Random(seed)
+
+    db.DATABASE_URI = os.path.join(directory, f"{name}.sqlite")
+    db.create_database()
+
+    start = time.perf_counter()
+    generate(rng, **sizes)
+    setup_seconds = time.perf_counter() - start
+
+    users = range(1, sizes["users"] + 1)
+    history = drop_sampler.GuildHistory(constants.HISTORY_SIZE)
+
+    # Users with enough cards to trade and to look cards up in.
+    conn, cursor = db.get_connection(readonly = True)
+    with conn:
+        cursor.execute("""SELECT user_id, COUNT(*) FROM waifus GROUP BY user_id HAVING COUNT(*) >= ?;""", (2 * TRADE_SIZE,))
+        owners = cursor.fetchall()
+        names = []
+        for char_id in rng.sample(range(1, sizes["characters"] + 1), 100):
+            cursor.execute("""SELECT en_name FROM character WHERE id = ?;""", (char_id,))
+            names.append(cursor.fetchone()[0])
+        titles = []
+        for show_id in rng.sample(range(1, sizes["shows"] + 1), 100):
+            cursor.execute("""SELECT jp_title FROM show WHERE id = ?;""", (show_id,))
+            titles.append(cursor.fetchone()[0])
+
+    def drop():
+        data = db.get_drop_data(history)
+        history.append(data["id"])
+
+    def inventory_lookup():
+        user_id, count = rng.choice(owners)
+        db.get_waifu_data_of_user(user_id, rng.randint(1, count))
+
+    def trade_offers():
+        (user1, _), (user2, _) = rng.sample(owners, 2)
+        offers = []
+        for user_id in (user1, user2):
+            conn, cursor = db.get_connection(readonly = True)
+            with conn:
+                cursor.execute("""SELECT id FROM waifus WHERE user_id = ?;""", (user_id,))
+                waifu_ids = [row[0] for row in cursor.fetchall()]
+            waifus = [types.SimpleNamespace(waifu_id = waifu_id) for waifu_id in rng.sample(waifu_ids, TRADE_SIZE)]
+            offers.append(types.SimpleNamespace(money = rng.randint(0, 10), waifus = waifus))
+        return (user1, user2, *offers)
+
+    def name_fragment(name):
+        start = rng.randint(0, max(0, len(name) - 4))
+        return name[start:start + 4]
+
+    operations = {
+        "get_drop_data": drop,
+        "get_all_waifu_data_for_user": lambda: db.get_all_waifu_data_for_user(rng.choice(owners)[0]),
+        "get_waifu_page": lambda: db.get_waifu_page(rng.choice(owners)[0]),
+        "get_waifu_data_of_user": inventory_lookup,
+        "trade": (db.trade, trade_offers),
+        "get_character_info": lambda: db.get_character_info(rng.randint(1, sizes["characters"])),
+        "get_characters_from_show": lambda: db.get_characters_from_show(rng.randint(1, sizes["shows"])),
+        "get_character_data_like": lambda: db.get_character_data_like(name_fragment(rng.choice(names))),
+        "get_character_data_by_name": lambda: db.get_character_data_by_name(rng.choice(names)),
+        "get_shows_like": lambda: db.get_shows_like(name_fragment(rng.choice(titles))),
+        "get_user_currency": lambda: db.get_user_currency(rng.choice(users)),
+    }
+
+    results = {}
+    for operation, call in operations.items():
+        print(f"{name}: {operation}", file = sys.stderr)
+        if isinstance(call, tuple):
+            results[operation] = time_calls(repeat, *call)
+        else:
+            results[operation] = time_calls(repeat, call)
+
+    return {
+        "sizes": sizes,
+        "setup_seconds": setup_seconds,
+        "operations": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Benchmark database_tools on generated data.")
+    parser.add_argument("--scales", default = "small,medium", help = f"comma separated, from: {', '.join(SCALES)}")
+    parser.add_argument("--repeat", type = int, default = 200, help = "calls per operation")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--output", help = "write the JSON here instead of to stdout")
+    parser.add_argument("--check", action = "store_true", help = "compare the storage backends instead of timing")
+    args = parser.parse_args()
+
+    scales = [scale.strip() for scale in args.scales.split(",") if scale.strip()]
+    for scale in scales:
+        if scale not in SCALES:
+            parser.error(f"unknown scale {scale}")
+
+    report = {
+        "seed": args.seed,
+        "repeat": args.repeat,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "scales": {},
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.check:
+            del report["repeat"], report["scales"]
+            report["check"] = run_check(args.seed, directory)
+        else:
+            for scale in scales:
+                report["scales"][scale] = run_scale(scale, SCALES[scale], args.repeat, args.seed, directory)
+
+        db.flush_pending_rewards()
+
+    output = json.dumps(report, indent = 2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+
+    if args.check and report["check"]["mismatch"]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
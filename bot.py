@@ -13,7 +13,9 @@ import textwrap
 
 import command as cmd
 import constants
+import database_async as adb
 import database_tools as db
+import db_metrics
 import display
 import internet
 import mal_tools
@@ -25,7 +27,7 @@ import uma
 import util
 import waifu_filter
 import nao
-from waifu import Waifu, Character
+from waifu import Waifu, Character, InventoryPages
 import minecraft
 import logging
 logger = logging.getLogger('discord')
@@ -80,8 +82,11 @@ class AnimeCharGuessBot(discord.Client):
         """
         constants.BOT_OBJECT = self
 
-        db.enable_all_trades()
-        db.enable_all_removes()
+        await adb.enable_all_trades()
+        await adb.enable_all_removes()
+
+        if not self.flush_rewards.is_running():
+            self.flush_rewards.start()
 
         await internet.send_downtime_message(from_reboot=True)
 
@@ -97,8 +102,23 @@ class AnimeCharGuessBot(discord.Client):
         # loop.create_task(uma.run())
 
 
+    @tasks.loop(seconds = constants.REWARD_FLUSH_SECONDS)
+    async def flush_rewards(self):
+        """
+        Write the drop rewards granted since the last tick in one transaction.
+        Also drop the caches if another process, like daily.py, changed the database.
+        """
+
+        try:
+            await adb.drop_stale_caches()
+            await adb.flush_pending_rewards()
+        except Exception:
+            # An unhandled exception would stop the loop. The rewards stay queued for the next tick.
+            logger.exception("Flushing drop rewards failed")
+
+
     async def on_guild_remove(self, guild):
-        db.remove_guild(guild.id)
+        await adb.remove_guild(guild.id)
 
 
     async def on_message(self, message):
@@ -167,7 +187,7 @@ class AnimeCharGuessBot(discord.Client):
             # We might want to drop or check if a drop guess is correct.
             drop = self.active_drops.get(message.guild.id)
 
-            if isinstance(drop, Drop) and message.channel.id == db.get_assigned_channel_id(message.guild.id) and drop.guess_matches(message_content):
+            if isinstance(drop, Drop) and drop.guess_matches(message_content) and message.channel.id == await adb.get_assigned_channel_id(message.guild.id):
                 # A drop is currently running, and the message was a correct guess, so reward the guesser.
                 del self.active_drops[message.guild.id]
                 await self.give_drop(drop, message)
@@ -249,33 +269,43 @@ class AnimeCharGuessBot(discord.Client):
         super().run(self.token)
     
 
-    def start_trade(self, user1, user2):
+    async def start_trade(self, user1, user2):
         """
         Creates a trade between two users.
         """
 
-        if user1.id == user2.id or not db.can_trade(user1.id, self) or not db.can_trade(user2.id, self) or not db.can_remove(user1.id) or not db.can_remove(user2.id):
+        if user1.id == user2.id:
             return None
 
+        await self.timeout_trades()
+
+        for user in (user1, user2):
+            if not await adb.can_trade(user.id) or not await adb.can_remove(user.id):
+                return None
+
         trade = Trade(user1, user2)
 
-        trade.mark_users_as_trading()
+        await trade.mark_users_as_trading()
 
         self.active_trades.add(trade)
 
         return trade
     
 
-    def remove_trade(self, trade):
+    async def remove_trade(self, trade):
         """
         Removes a trade and allows the participating users to trade again.
         """
 
-        self.active_trades.remove(trade)
-        trade.mark_trade_over()
+        if trade not in self.active_trades:
+            # Already removed by a concurrent call, which also marks the trade as over.
+            return
+
+        self.active_trades.discard(trade)
+        await trade.mark_trade_over()
 
 
-    def timeout_trades(self):
+    async def timeout_trades(self):
         """
         Quietly remove any trades that have been inactive for too long.
         """
@@ -287,15 +317,15 @@ class AnimeCharGuessBot(discord.Client):
                 timed_out.append(trade)
 
         for trade in timed_out:
-            self.remove_trade(trade)
+            await self.remove_trade(trade)
 
 
-    def get_trade_involving(self, user_id):
+    async def get_trade_involving(self, user_id):
         """
         Finds what trade, if any, a user is currently part of.
         """
 
-        self.timeout_trades()
+        await self.timeout_trades()
 
         for trade in self.active_trades:
             if user_id in trade:
@@ -323,7 +353,7 @@ class AnimeCharGuessBot(discord.Client):
         """
         # return
 
-        assigned_channel_id = db.get_assigned_channel_id(guild.id)
+        assigned_channel_id = await adb.get_assigned_channel_id(guild.id)
 
         if not assigned_channel_id:
             # Guild has no assigned channel, so don't drop.
@@ -368,21 +398,19 @@ class AnimeCharGuessBot(discord.Client):
         bonus = random.randint(50, 125)
         upgrade = not random.randint(0, 9)
 
-        db.add_user_currency(message.author.id, bonus)
-        db.add_waifu(message.author.id, drop.waifu.image_id, drop.waifu.rarity)
+        reward = await adb.add_drop_reward(message.author.id, drop.waifu.image_id, drop.waifu.rarity, bonus, 1 if upgrade else 0)
 
         lines = [
             f'**{message.author.display_name}** is correct!',
             f"You've claimed **{drop.waifu.character.en_name}**.",
             display.rarity_string(drop.waifu.rarity),
             drop.waifu.character.source_string(),
-            f'They have filled inventory slot ``{db.get_waifusAmount(message.author.id)}``.',
-            f':coin: Your {self.currency}: **{db.get_user_currency(message.author.id)}** (+{bonus})'
+            f'They have filled inventory slot ``{reward["slot"]}``.',
+            f':coin: Your {self.currency}: **{reward["currency"]}** (+{bonus})'
         ]
 
         if upgrade:
-            db.add_user_upgrades(message.author.id, 1)
-            lines.append(f'You also found an upgrade part!\n:nut_and_bolt: Your upgrade parts: **{db.get_user_upgrades(message.author.id)}** (+1)')
+            lines.append(f'You also found an upgrade part!\n:nut_and_bolt: Your upgrade parts: **{reward["upgrades"]}** (+1)')
 
         await message.reply(embed = display.create_embed(
             'Waifu Claimed!',
@@ -495,10 +523,8 @@ class AnimeCharGuessBot(discord.Client):
         if not arg_list[-1].isnumeric():
             return cmd.BAD_USAGE
 
-        target = int(arg_list[-1])
-        wealth = db.get_user_currency(user.id)
+        wealth, target = await adb.set_user_currency(user.id, int(arg_list[-1]))
         change = target - wealth
-        db.add_user_currency(user.id, change)
 
         await args.message.reply(embed = display.create_embed(
             'Money Updated',
@@ -553,7 +579,7 @@ class AnimeCharGuessBot(discord.Client):
         else:
             skip = None
 
-        show_urls = db.get_all_show_mal_urls()
+        show_urls = await adb.get_all_show_mal_urls()
         if skip:
             show_urls = show_urls[skip:]
 
@@ -593,6 +619,33 @@ class AnimeCharGuessBot(discord.Client):
         return
         
 
+    @command('a.dbstats', require_bot_admin=True)
+    async def command_admin_dbstats(self, args):
+        """
+        Show how long database functions take. (Bot admin only)
+
+        Lists the calls, latency percentiles, rows fetched and writer lock wait of each database function, slowest in total first.
+        Usage: ``%PREFIX%%COMMAND% [reset]``
+        """
+        if args.arguments_string == 'reset':
+            db_metrics.reset()
+            await args.message.reply(embed = display.create_embed("Database stats reset", "Timings are recorded from now on."))
+            return
+
+        elif args.arguments_string:
+            return cmd.BAD_USAGE
+
+        lines = [
+            f"``{stats['function']}`` {stats['calls']} calls, "
+            f"p50/p95/p99 {stats['p50_ms']:.1f}/{stats['p95_ms']:.1f}/{stats['p99_ms']:.1f} ms, "
+            f"{stats['rows']} rows, {stats['lock_wait_ms']:.0f} ms lock wait"
+            + (f", {stats['slow_statements']} slow" if stats['slow_statements'] else "")
+            for stats in db_metrics.summary()
+        ]
+
+        await display.page(self, args, lines, "Database stats", page_size = 10, error_message = "No database calls yet.")
+
+
     # @command('a.changename', require_bot_admin=True)
     # async def command_admin_changename(self, args):
     #     """
@@ -624,7 +677,7 @@ class AnimeCharGuessBot(discord.Client):
         if args.arguments_string:
             return cmd.BAD_USAGE
 
-        db.assign_channel_to_guild(args.channel.id, args.guild.id)
+        await adb.assign_channel_to_guild(args.channel.id, args.guild.id)
         await args.message.reply(embed = display.create_embed(
             'Channel Assigned!',
             f"I've been assigned to channel ``#{args.channel.name}``"
@@ -646,10 +699,9 @@ class AnimeCharGuessBot(discord.Client):
         daily_reset = util.next_daily_reset()
         daily_reset = f'<t:{daily_reset}:R>'
 
-        if db.user_can_daily(args.user.id):
-            db.add_daily_currency(args.user.id)
-            
-            wealth = db.get_user_currency(args.user.id)
+        wealth = await adb.claim_daily(args.user.id)
+
+        if wealth is not None:
             await args.message.reply(embed = display.create_embed(
                 f'Daily {self.currency.capitalize()} Received',
                 f'You received {db.DAILY_CURRENCY}!\n'
@@ -717,19 +769,13 @@ class AnimeCharGuessBot(discord.Client):
 
         adding = args.command == 'fav'
 
-        changed = []
-
-        for i in indices:
-            waifu = Waifu.from_user_index(args.user, i)
-
-            if waifu:
-                if adding:
-                    db.set_favorite(waifu.waifu_id)
-                else:
-                    db.unfavorite(waifu.waifu_id)
+        waifus = await adb.run(args.user.id, Waifu.from_user_indices, args.user, indices)
+        found = [waifu for waifu in waifus if waifu]
 
-                changed.append(waifu)
+        changed_ids = set(await adb.set_favorites(args.user.id, [waifu.waifu_id for waifu in found], adding))
+        changed = [waifu for waifu in found if waifu.waifu_id in changed_ids]
 
+        for waifu in changed:
             # We don't want to show the heart emoji here.
             waifu.fav = False
 
@@ -789,7 +835,7 @@ class AnimeCharGuessBot(discord.Client):
             ))
             return
 
-        wealth = db.get_user_currency(args.user.id)
+        wealth = await adb.get_user_currency(args.user.id)
 
         if amount > wealth:
             await args.message.reply(embed = display.create_embed(
@@ -819,20 +865,21 @@ class AnimeCharGuessBot(discord.Client):
 
                 return
 
-        if not db.subtract_user_currency(args.user.id, amount):
+        balances = await adb.transfer_user_currency(args.user.id, recipient.id, amount)
+
+        if balances is None:
+            # Spent in the meantime.
             await reply_to.reply(embed = display.create_embed(
                 'Gift Failed',
-                'Something went wrong.'
+                f'You do not have enough {self.currency}.'
             ))
 
             return
 
-        db.add_user_currency(recipient.id, amount)
-
         await reply_to.reply(embed = display.create_embed(
             'Gift Successful',
             f'You have given **{amount}** {self.currency} to **{recipient.display_name}**.\n'
-            f':coin: Your {self.currency}: **{wealth - amount}** (-{amount})',
+            f':coin: Your {self.currency}: **{balances[0]}** (-{amount})',
             thumbnail = util.avatar(recipient)
         ))
 
@@ -936,8 +983,8 @@ class AnimeCharGuessBot(discord.Client):
         if not user:
             return cmd.USER_NOT_FOUND
 
-        money = db.get_user_currency(user.id)
-        upgparts = db.get_user_upgrades(user.id)
+        money = await adb.get_user_currency(user.id)
+        upgparts = await adb.get_user_upgrades(user.id)
 
         await args.message.reply(embed = display.create_embed(
             f"{user.display_name}'s Profile",
@@ -962,8 +1009,10 @@ class AnimeCharGuessBot(discord.Client):
         You can also remove multiple waifus by using a search query the same as %PREFIX%waifus.
         """
         
-        if db.can_remove(args.user.id) and db.can_trade(args.user.id, self):
-            db.disable_remove(args.user.id)
+        await self.timeout_trades()
+
+        if await adb.can_remove(args.user.id) and await adb.can_trade(args.user.id):
+            await adb.disable_remove(args.user.id)
 
         else:
             await args.message.reply(embed = display.create_embed(
@@ -1003,11 +1052,10 @@ class AnimeCharGuessBot(discord.Client):
             if is_number_list:
                 # Inventory number method.
 
-                for arg in arg_list:
-                    index = int(arg)
-
-                    waifu = Waifu.from_user_index(args.user, index)
+                waifus = await adb.run(args.user.id, Waifu.from_user_indices, args.user, [int(arg) for arg in arg_list])
+                selected = set()
 
+                for waifu in waifus:
                     if not waifu:
                         await args.message.reply(embed = display.create_embed(
                             '404 Waifu not Found',
@@ -1022,13 +1070,16 @@ class AnimeCharGuessBot(discord.Client):
                         ))
                         return
 
-                    to_remove.append(waifu)
+                    # The same card may be given more than once, e.g. as 1 and -N.
+                    if waifu.waifu_id not in selected:
+                        selected.add(waifu.waifu_id)
+                        to_remove.append(waifu)
 
             else:
                 # Search filter method.
 
                 try:
-                    search_filter = waifu_filter.Filter(arg_list)
+                    search_filter = await adb.run(None, waifu_filter.Filter, arg_list)
 
                 except Exception as e:
                     if 'No such show' in str(e):
@@ -1040,7 +1091,7 @@ class AnimeCharGuessBot(discord.Client):
 
                     return cmd.BAD_USAGE
 
-                all_waifus = db.get_all_waifu_data_for_user(args.user.id)
+                all_waifus = await adb.get_all_waifu_data_for_user(args.user.id)
                 waifus = search_filter.apply(Waifu.from_data(waifu, args.user) for waifu in all_waifus)
         
                 for waifu in waifus:
@@ -1129,29 +1180,24 @@ class AnimeCharGuessBot(discord.Client):
                     ))
                     return
 
-            success = []
-            failed = []
-            reward = 0
+            # All at once, the reward is credited in the same transaction.
+            removed_ids, reward = await adb.remove_waifus(args.user.id, [waifu.waifu_id for waifu in to_remove])
+            removed_ids = set(removed_ids)
 
-            for waifu in to_remove:
-                if db.remove_waifu(waifu.waifu_id):
-                    success.append(waifu)
-                    reward += db.get_rarity_currency(waifu.rarity)
-                else:
-                    failed.append(waifu)
+            success = [waifu for waifu in to_remove if waifu.waifu_id in removed_ids]
+            failed = [waifu for waifu in to_remove if waifu.waifu_id not in removed_ids]
 
-            if reward:
-                db.add_user_currency(args.user.id, reward)
+            wealth = await adb.get_user_currency(args.user.id)
 
         finally:
-            db.enable_remove(args.user.id)
+            await adb.enable_remove(args.user.id)
 
         if not failed and len(success) == 1:
             # There was only one waifu, and it was successfully removed.
             await reply_to.reply(embed = display.create_embed(
                 'Waifu Let Go',
                 f'**{success[0].character.en_name}** has been let go.\n'
-                f':coin: Your {self.currency}: **{db.get_user_currency(args.user.id)}** (+{reward})',
+                f':coin: Your {self.currency}: **{wealth}** (+{reward})',
                 thumbnail = success[0].image_url
             ))
 
@@ -1160,7 +1206,7 @@ class AnimeCharGuessBot(discord.Client):
             await reply_to.reply(embed = display.create_embed(
                 'Waifus Let Go',
                 f'{len(success)} waifus have been let go.\n'
-                f':coin: Your {self.currency}: **{db.get_user_currency(args.user.id)}** (+{reward})'
+                f':coin: Your {self.currency}: **{wealth}** (+{reward})'
             ))
         
         elif success:
@@ -1175,7 +1221,7 @@ class AnimeCharGuessBot(discord.Client):
             for waifu in failed:
                 lines.append(str(waifu))
 
-            lines.append('\n:coin: Your {self.currency}: **{db.get_user_currency(args.user.id)}** (+{reward})')
+            lines.append(f'\n:coin: Your {self.currency}: **{wealth}** (+{reward})')
 
             await reply_to.reply(embed = display.create_embed(
                 'Something Went Wrong',
@@ -1234,18 +1280,37 @@ class AnimeCharGuessBot(discord.Client):
           ``★★★★☆: 5000``
           ``★★★★★: 15000``
 
-        Usage: ``%PREFIX%%COMMAND% [%CURRENCY%]``
+        Add ``x<count>`` to roll several times at once, at that price each. (Maximum: 10 rolls)
+
+        Usage: ``%PREFIX%%COMMAND% [%CURRENCY%] [x<count>]``
         """
 
-        price = 100
+        price = None
+        count = None
 
-        if args.arguments_string:
-            if args.arguments_string.isnumeric():
-                price = int(args.arguments_string)
+        for arg in args.arguments_string.split():
+            if arg.isnumeric() and price is None:
+                price = int(arg)
+
+            elif arg[:1].lower() == 'x' and arg[1:].isnumeric() and count is None:
+                count = int(arg[1:])
 
             else:
                 return cmd.BAD_USAGE
 
+        if price is None:
+            price = 100
+
+        if count is None:
+            count = 1
+
+        if not (1 <= count <= constants.MAX_ROLLS):
+            await args.message.reply(embed = display.create_embed(
+                'Roll Failed',
+                f'You can roll between 1 and {constants.MAX_ROLLS} times at once.'
+            ))
+            return
+
         if not (100 <= price <= 15000):
             await args.message.reply(embed = display.create_embed(
                 'Roll Failed',
@@ -1253,23 +1318,24 @@ class AnimeCharGuessBot(discord.Client):
             ))
             return
 
-        wealth = db.get_user_currency(args.user.id)
+        # One payment for every roll, and all the cards in the same transaction.
+        result = await adb.roll_waifus(args.user.id, price, count)
 
-        if price > wealth:
+        if result is None:
             await args.message.reply(embed = display.create_embed(
                 'Roll Failed',
-                f'Insufficient {self.currency}. Currently: **{wealth}**'
+                f'Insufficient {self.currency}. Currently: **{await adb.get_user_currency(args.user.id)}**'
             ))
             return
 
-        waifu_data, price = db.get_drop_data(user_id = args.user.id, price = price)
-
-        db.add_waifu(args.user.id, waifu_data['image_id'], waifu_data['rarity'])
+        wealth, rolled = result
+        waifus = [Waifu.from_data(dict(data, card_index = data['slot'] - 1), args.user) for data in rolled]
 
-        index = db.get_waifusAmount(args.user.id)
-        waifu = Waifu.from_user_index(args.user, index)
+        if count == 1:
+            await args.message.reply(embed = waifus[0].create_roll_embed(self.currency, wealth, price))
 
-        await args.message.reply(embed = waifu.create_roll_embed(self.currency, wealth - price, price))
+        else:
+            await args.message.reply(embed = Waifu.create_multi_roll_embed(waifus, self.currency, wealth, price * count))
         
 
     @command('search')
@@ -1295,7 +1361,7 @@ class AnimeCharGuessBot(discord.Client):
             ))
             return
 
-        series_list = db.get_shows_like(query)
+        series_list = await adb.get_shows_like(query)
 
         if series_list:
             title = 'Search Results'
@@ -1344,7 +1410,7 @@ class AnimeCharGuessBot(discord.Client):
 
         else:
             # Searching by name.
-            series_list = db.get_shows_like(query)
+            series_list = await adb.get_shows_like(query)
 
             if len(series_list) == 1:
                 show_id = series_list[0]['id']
@@ -1354,7 +1420,7 @@ class AnimeCharGuessBot(discord.Client):
                 await self.command_search(args, ambiguous_flag=True)
                 return
 
-        show = Show.from_id(show_id)
+        show = await adb.run(None, Show.from_id, show_id)
 
         if not show or not show.characters:
             await args.message.reply(embed = display.create_embed(
@@ -1378,7 +1444,7 @@ class AnimeCharGuessBot(discord.Client):
 
         Usage: One of
         ``%PREFIX%%COMMAND% <user>`` - Start a trade with ``<user>``
-        ``%PREFIX%%COMMAND% add <inventory number>`` - Add a waifu to the trade
+        ``%PREFIX%%COMMAND% add <inventory number> ...`` - Add one or more waifus to the trade
         ``%PREFIX%%COMMAND% remove <inventory number>`` - Remove a waifu from the trade
         ``%PREFIX%%COMMAND% %CURRENCY% <amount>`` - Set the amount of currency to trade
         ``%PREFIX%%COMMAND% confirm`` - Confirm the trade
@@ -1387,7 +1453,7 @@ class AnimeCharGuessBot(discord.Client):
 
         arg_list = args.arguments_string.split()
 
-        if not arg_list or len(arg_list) > 2:
+        if not arg_list or (len(arg_list) > 2 and arg_list[0] != 'add'):
             return cmd.BAD_USAGE
 
         if not args.guild:
@@ -1400,7 +1466,7 @@ class AnimeCharGuessBot(discord.Client):
         action = arg_list[0]
 
         src_user = args.user
-        trade = self.get_trade_involving(src_user.id)
+        trade = await self.get_trade_involving(src_user.id)
 
         if trade is None and action in ('add', 'remove', self.currency, 'confirm', 'cancel'):
             await args.message.reply(embed = display.create_embed(
@@ -1414,19 +1480,21 @@ class AnimeCharGuessBot(discord.Client):
             offer = trade.offer_of(src_user.id)
 
         if action == 'add':
-            if len(arg_list) < 2 or not util.is_int(arg_list[1]):
+            if len(arg_list) < 2 or not all(util.is_int(arg) for arg in arg_list[1:]):
                 return cmd.BAD_USAGE
 
-            waifu = Waifu.from_user_index(src_user, int(arg_list[1]))
+            waifus = await adb.run(src_user.id, Waifu.from_user_indices, src_user, [int(arg) for arg in arg_list[1:]])
             
-            if not waifu:
+            if not all(waifus):
                 await args.message.reply(embed = display.create_embed(
                     'Trade Add Failed',
                     "Waifu not found in your inventory."
                 ))
                 return
 
-            if not offer.add_waifu(waifu):
+            added = [waifu for waifu in waifus if offer.add_waifu(waifu)]
+
+            if not added:
                 await args.message.reply(embed = display.create_embed(
                     'Trade Add Failed',
                     "Waifu is already in your offer."
@@ -1454,7 +1522,7 @@ class AnimeCharGuessBot(discord.Client):
 
             amount = int(arg_list[1])
 
-            if amount > db.get_user_currency(src_user.id):
+            if amount > await adb.get_user_currency(src_user.id):
                 await args.message.reply(embed = display.create_embed(
                     'Trade Money Failed',
                     'You have insufficient funds.'
@@ -1472,7 +1540,7 @@ class AnimeCharGuessBot(discord.Client):
             offer.confirmed = True
 
             if trade.confirmed():
-                if trade.perform():
+                if await trade.perform():
                     await args.channel.send(embed = display.create_embed(
                         'Trade Confirmed',
                         'Trade has been confirmed!'
@@ -1483,14 +1551,14 @@ class AnimeCharGuessBot(discord.Client):
                         'Something went wrong.'
                     ))
 
-                self.remove_trade(trade)
+                await self.remove_trade(trade)
                 return
 
         elif action == 'cancel':
             if len(arg_list) > 1:
                 return cmd.BAD_USAGE
 
-            self.remove_trade(trade)
+            await self.remove_trade(trade)
             await args.channel.send(embed = display.create_embed(
                 'Trade Cancelled',
                 'Trade has been cancelled.'
@@ -1517,7 +1585,7 @@ class AnimeCharGuessBot(discord.Client):
                 ))
                 return
 
-            trade = self.start_trade(src_user, target_user)
+            trade = await self.start_trade(src_user, target_user)
 
         if trade:
             await args.channel.send(embed = trade.create_embed(self))
@@ -1546,7 +1614,7 @@ class AnimeCharGuessBot(discord.Client):
         if len(args_list) != 1 or not util.is_int(args_list[0]):
             return cmd.BAD_USAGE
 
-        waifu = Waifu.from_user_index(args.user, int(args_list[0]))
+        waifu = await adb.run(args.user.id, Waifu.from_user_index, args.user, int(args_list[0]))
 
         if waifu is None:
             await args.message.reply(embed = display.create_embed(
@@ -1566,7 +1634,7 @@ class AnimeCharGuessBot(discord.Client):
 
             return
 
-        have = db.get_user_upgrades(args.user.id)
+        have = await adb.get_user_upgrades(args.user.id)
 
         if needed > have:
             await args.message.reply(embed = display.create_embed(
@@ -1600,11 +1668,13 @@ class AnimeCharGuessBot(discord.Client):
 
                 return
 
-        if db.upgrade_user_waifu(args.user.id, waifu.waifu_id, needed):
+        upgraded = await adb.upgrade_user_waifu(args.user.id, waifu.waifu_id, needed)
+
+        if upgraded is not None:
             await reply_to.reply(embed = display.create_embed(
                 'Upgrade Successful',
-                f'**{waifu.character.en_name}** has been upgraded to {display.rarity_string(waifu.rarity + 1)}.\n'
-                f':nut_and_bolt: Your upgrade parts: **{have - needed}** (-{needed})',
+                f'**{waifu.character.en_name}** has been upgraded to {display.rarity_string(upgraded["rarity"])}.\n'
+                f':nut_and_bolt: Your upgrade parts: **{upgraded["upgrades"]}** (-{needed})',
                 thumbnail = waifu.image_url
             ))
 
@@ -1637,24 +1707,24 @@ class AnimeCharGuessBot(discord.Client):
         else:
             # Search by name.
 
-            # Try name in supplied order, and reversed.
+            # Match the normalized name parts in any order.
+            data = await adb.get_character_data_by_name(args.arguments_string)
 
-            # Attempting to normalize here doesn't work, because the characters are queried using LIKE.
-            # name_parts = nt.normalize_romanization(args.arguments_string).split()
-            
-            name_parts = args.arguments_string.split()
-            q1 = ' '.join(name_parts)
-            q2 = ' '.join(name_parts[::-1])
+            if not data:
+                # Not a romanized name, so try name in supplied order, and reversed.
+                name_parts = args.arguments_string.split()
+                q1 = ' '.join(name_parts)
+                q2 = ' '.join(name_parts[::-1])
 
-            if q1 == q2:
-                # Name reversed is itself.
-                data = db.get_character_data_like(q1)
+                if q1 == q2:
+                    # Name reversed is itself.
+                    data = await adb.get_character_data_like(q1)
 
-            else:
-                data = [
-                    *db.get_character_data_like(q1),
-                    *db.get_character_data_like(q2)
-                ]
+                else:
+                    data = [
+                        *await adb.get_character_data_like(q1),
+                        *await adb.get_character_data_like(q2)
+                    ]
 
             if not data:
                 await args.message.reply(embed = display.create_embed(
@@ -1673,7 +1743,7 @@ class AnimeCharGuessBot(discord.Client):
 
             chara_id = data[0]['id']
         
-        chara = Character.from_id(chara_id)
+        chara = await adb.run(None, Character.from_id, chara_id)
 
         if chara:
             await chara.display_info(args.message)
@@ -1700,27 +1770,28 @@ class AnimeCharGuessBot(discord.Client):
 
         amount = int(args.arguments_string)
 
-        wealth = db.get_user_currency(args.user.id)
+        won = random.randint(0, 1)
 
-        if amount > wealth:
+        # The balance check and the payout or loss are one statement.
+        wealth = await adb.change_user_currency(args.user.id, amount if won else -amount, amount)
+
+        if wealth is None:
             await args.message.reply(embed = display.create_embed(
                 'Wager Failed',
-                f'You do not have enough {self.currency}. Currently: **{wealth}**'
+                f'You do not have enough {self.currency}. Currently: **{await adb.get_user_currency(args.user.id)}**'
             ))
             return
 
-        if random.randint(0, 1):
-            db.add_user_currency(args.user.id, amount)
+        if won:
             await args.message.reply(embed = display.create_embed(
                 'You Win!',
-                f'You doubled your wager!\n:coin: Your {self.currency}: **{wealth + amount}** (+{amount})'
+                f'You doubled your wager!\n:coin: Your {self.currency}: **{wealth}** (+{amount})'
             ))
         
         else:
-            db.subtract_user_currency(args.user.id, amount)
             await args.message.reply(embed = display.create_embed(
                 'You Lose...',
-                f'Too bad, you lost your wager. Better luck next time.\n:coin: Your {self.currency}: **{wealth - amount}** (-{amount})'
+                f'Too bad, you lost your wager. Better luck next time.\n:coin: Your {self.currency}: **{wealth}** (-{amount})'
             ))
 
 
@@ -1762,7 +1833,7 @@ class AnimeCharGuessBot(discord.Client):
         if not user:
             return cmd.USER_NOT_FOUND
 
-        waifu = Waifu.from_user_index(user, waifu_index)
+        waifu = await adb.run(user.id, Waifu.from_user_index, user, waifu_index)
 
         if waifu is None:
             await args.message.reply(embed = display.create_embed(
@@ -1842,7 +1913,7 @@ class AnimeCharGuessBot(discord.Client):
                 del arg_list[pflag]
 
         try:
-            search_filter = waifu_filter.Filter(arg_list)
+            search_filter = await adb.run(None, waifu_filter.Filter, arg_list)
         except Exception as e:
             if 'No such show' in str(e):
                 await args.message.reply(embed = display.create_embed(
@@ -1853,7 +1924,26 @@ class AnimeCharGuessBot(discord.Client):
 
             return cmd.BAD_USAGE
 
-        all_waifus = db.get_all_waifu_data_for_user(user.id)
+        title = f"{user.display_name}'s Waifus"
+        error = "There are no waifus here!"
+
+        if not search_filter.filters:
+            # Nothing to filter, so only read the pages that are viewed.
+            count = await adb.get_waifu_count(user.id)
+
+            if not count:
+                await args.message.reply(embed = display.create_embed(
+                    '404 Waifu not Found',
+                    "Selected user does not have any waifus yet...\nThey'd better claim some!"
+                ))
+                return
+
+            pages = InventoryPages(user, constants.PROFILE_PAGE_SIZE)
+
+            await display.lazy_page(self, args, count, pages.fetch, title, page, constants.PROFILE_PAGE_SIZE, constants.PROFILE_TIMEOUT, error)
+            return
+
+        all_waifus = await adb.get_all_waifu_data_for_user(user.id)
         waifus = search_filter.apply(Waifu.from_data(waifu, user) for waifu in all_waifus)
 
         if not waifus:
@@ -1864,9 +1954,6 @@ class AnimeCharGuessBot(discord.Client):
             ))
             return
 
-        title = f"{user.display_name}'s Waifus"
-        error = "There are no waifus here!"
-
         await display.page(self, args, waifus, title, page, constants.PROFILE_PAGE_SIZE, constants.PROFILE_TIMEOUT, error)
     
     @command('uma.gacha', only_in_assigned_channel = False)
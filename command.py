@@ -1,6 +1,6 @@
 import textwrap
 import display
-import database_tools as db
+import database_async as adb
 import traceback
 import logging
 logger = logging.getLogger('discord')
@@ -72,7 +72,7 @@ class Command:
         bot.set_cooldown(arguments.user.id)
 
         # Check if in the correct channel.
-        if self.only_in_assigned_channel and arguments.message.guild and arguments.message.channel.id != db.get_assigned_channel_id(arguments.message.guild.id):
+        if self.only_in_assigned_channel and arguments.message.guild and arguments.message.channel.id != await adb.get_assigned_channel_id(arguments.message.guild.id):
             return
 
         if self.check_permissions(arguments):
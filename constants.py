@@ -28,6 +28,19 @@ TRADE_TIMEOUT = 60
 UPGRADE_TIMEOUT = 15
 HISTORY_SIZE = 500
 
+# Database connection pool.
+DB_BUSY_TIMEOUT = 30
+DB_CACHED_STATEMENTS = 256
+DB_READER_CONNECTIONS = 4
+DB_QUEUE_SIZE = 64
+DB_WORKER_THREADS = 4
+REWARD_FLUSH_SECONDS = 2
+# Statements taking at least this long are logged with their query plan.
+DB_SLOW_QUERY_MS = 100
+
+# Most cards a single roll command can roll.
+MAX_ROLLS = 10
+
 UPGRADE_FROM_COSTS = {
     0: 1,
     1: 5,
@@ -36,3 +49,9 @@ UPGRADE_FROM_COSTS = {
 }
 
 TMP_DIR = "tmp"
+
+# In-process caches of database state.
+USER_CACHE_SIZE = 10000
+GUILD_CACHE_SIZE = 10000
+# Users whose inventory order (their waifus ids) is kept in memory.
+INVENTORY_CACHE_SIZE = 1000
@@ -1,3 +1,21 @@
+"""
+Give every user their daily currency, for running on a schedule.
+
+This is separate from the users' own daily claim: everyone gets it whether or not they claimed today, and can still
+claim afterwards. Running this more than once a day grants nothing the second time. A running bot notices the change on
+its next reward flush tick and reloads its caches.
+"""
+
 import database_tools as db
+import logging
+logger = logging.getLogger('discord')
+
+
+def grant_daily(amount = db.DAILY_CURRENCY):
+    db.create_database()
+    return db.grant_daily_to_all(amount)
+
 
-db.addDailyCurrency()
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    grant_daily()
@@ -0,0 +1,20 @@
+-- Secondary indexes for the inventory, drop, series and scraper queries.
+-- Every table in create.sql only had its primary key, so these were all full scans.
+
+-- Inventory listing, counting and lookup by inventory number (rowid is implied, so ORDER BY id is free).
+CREATE INDEX waifus_user_id_idx ON waifus (user_id);
+
+-- Character stats: covers the rarity and favorite counts per image.
+CREATE INDEX waifus_images_id_idx ON waifus (images_id, rarity, favorite);
+
+-- Drops, image numbering and the scraper's duplicate image check.
+CREATE INDEX images_character_id_idx ON images (character_id);
+
+-- Series pages and show filters.
+CREATE INDEX show_character_show_id_idx ON show_character (show_id, char_id);
+
+-- Shows of a character and the scraper's "character has show" check.
+CREATE INDEX show_character_char_id_idx ON show_character (char_id, show_id);
+
+-- Scraper lookup of shows by their MAL id.
+CREATE INDEX show_mal_id_idx ON show (mal_id, is_manga);
@@ -0,0 +1,9 @@
+-- Store each image's number within its character ("image #N"), instead of computing
+-- ROW_NUMBER() OVER (PARTITION BY character_id ORDER BY id) across all images per query.
+
+ALTER TABLE images ADD COLUMN image_index integer;
+
+UPDATE images SET image_index = (
+    SELECT COUNT(*) FROM images i
+    WHERE i.character_id = images.character_id AND i.id <= images.id
+);
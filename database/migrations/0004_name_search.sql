@@ -0,0 +1,51 @@
+-- Trigram full text indexes over character names and show titles, for the "view", "search" and
+-- "series" commands and the -sn filter. These used LIKE '%q%', which scans every row.
+-- Both are external content tables: the text stays in character and show, the triggers keep the index in sync.
+
+CREATE VIRTUAL TABLE character_search USING fts5(
+    en_name, jp_name, alt_name,
+    content='character', content_rowid='id', tokenize='trigram'
+);
+
+CREATE TRIGGER character_search_insert AFTER INSERT ON character BEGIN
+    INSERT INTO character_search (rowid, en_name, jp_name, alt_name)
+    VALUES (new.id, new.en_name, new.jp_name, new.alt_name);
+END;
+
+CREATE TRIGGER character_search_delete AFTER DELETE ON character BEGIN
+    INSERT INTO character_search (character_search, rowid, en_name, jp_name, alt_name)
+    VALUES ('delete', old.id, old.en_name, old.jp_name, old.alt_name);
+END;
+
+CREATE TRIGGER character_search_update AFTER UPDATE OF en_name, jp_name, alt_name ON character BEGIN
+    INSERT INTO character_search (character_search, rowid, en_name, jp_name, alt_name)
+    VALUES ('delete', old.id, old.en_name, old.jp_name, old.alt_name);
+    INSERT INTO character_search (rowid, en_name, jp_name, alt_name)
+    VALUES (new.id, new.en_name, new.jp_name, new.alt_name);
+END;
+
+CREATE VIRTUAL TABLE show_search USING fts5(
+    jp_title, en_title,
+    content='show', content_rowid='id', tokenize='trigram'
+);
+
+CREATE TRIGGER show_search_insert AFTER INSERT ON show BEGIN
+    INSERT INTO show_search (rowid, jp_title, en_title)
+    VALUES (new.id, new.jp_title, new.en_title);
+END;
+
+CREATE TRIGGER show_search_delete AFTER DELETE ON show BEGIN
+    INSERT INTO show_search (show_search, rowid, jp_title, en_title)
+    VALUES ('delete', old.id, old.jp_title, old.en_title);
+END;
+
+CREATE TRIGGER show_search_update AFTER UPDATE OF jp_title, en_title ON show BEGIN
+    INSERT INTO show_search (show_search, rowid, jp_title, en_title)
+    VALUES ('delete', old.id, old.jp_title, old.en_title);
+    INSERT INTO show_search (rowid, jp_title, en_title)
+    VALUES (new.id, new.jp_title, new.en_title);
+END;
+
+-- Index the existing catalog.
+INSERT INTO character_search (character_search) VALUES ('rebuild');
+INSERT INTO show_search (show_search) VALUES ('rebuild');
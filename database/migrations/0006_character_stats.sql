@@ -0,0 +1,76 @@
+-- Copies per rarity and favorites of every character, for the character info page.
+-- These were counted by joining every owned copy of the character. Now the triggers below keep them up to date
+-- whenever a card is added, removed, upgraded, favorited or moved, and the page reads one row.
+-- Cards with an unset rarity (-1) only count towards copies.
+
+CREATE TABLE character_stats (
+    char_id integer NOT NULL CONSTRAINT character_stats_pk PRIMARY KEY,
+    copies integer NOT NULL DEFAULT 0,
+    favorites integer NOT NULL DEFAULT 0,
+    rarity_0 integer NOT NULL DEFAULT 0,
+    rarity_1 integer NOT NULL DEFAULT 0,
+    rarity_2 integer NOT NULL DEFAULT 0,
+    rarity_3 integer NOT NULL DEFAULT 0,
+    rarity_4 integer NOT NULL DEFAULT 0,
+    rarity_5 integer NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER waifus_stats_insert AFTER INSERT ON waifus BEGIN
+    INSERT INTO character_stats (char_id, copies, favorites, rarity_0, rarity_1, rarity_2, rarity_3, rarity_4, rarity_5)
+    SELECT character_id, 1, new.favorite = 1, new.rarity = 0, new.rarity = 1, new.rarity = 2, new.rarity = 3, new.rarity = 4, new.rarity = 5
+    FROM images WHERE id = new.images_id
+    ON CONFLICT (char_id) DO UPDATE SET
+        copies = copies + excluded.copies,
+        favorites = favorites + excluded.favorites,
+        rarity_0 = rarity_0 + excluded.rarity_0,
+        rarity_1 = rarity_1 + excluded.rarity_1,
+        rarity_2 = rarity_2 + excluded.rarity_2,
+        rarity_3 = rarity_3 + excluded.rarity_3,
+        rarity_4 = rarity_4 + excluded.rarity_4,
+        rarity_5 = rarity_5 + excluded.rarity_5;
+END;
+
+CREATE TRIGGER waifus_stats_delete AFTER DELETE ON waifus BEGIN
+    UPDATE character_stats SET
+        copies = copies - 1,
+        favorites = favorites - (old.favorite = 1),
+        rarity_0 = rarity_0 - (old.rarity = 0),
+        rarity_1 = rarity_1 - (old.rarity = 1),
+        rarity_2 = rarity_2 - (old.rarity = 2),
+        rarity_3 = rarity_3 - (old.rarity = 3),
+        rarity_4 = rarity_4 - (old.rarity = 4),
+        rarity_5 = rarity_5 - (old.rarity = 5)
+    WHERE char_id = (SELECT character_id FROM images WHERE id = old.images_id);
+END;
+
+CREATE TRIGGER waifus_stats_update AFTER UPDATE OF images_id, rarity, favorite ON waifus BEGIN
+    UPDATE character_stats SET
+        copies = copies - 1,
+        favorites = favorites - (old.favorite = 1),
+        rarity_0 = rarity_0 - (old.rarity = 0),
+        rarity_1 = rarity_1 - (old.rarity = 1),
+        rarity_2 = rarity_2 - (old.rarity = 2),
+        rarity_3 = rarity_3 - (old.rarity = 3),
+        rarity_4 = rarity_4 - (old.rarity = 4),
+        rarity_5 = rarity_5 - (old.rarity = 5)
+    WHERE char_id = (SELECT character_id FROM images WHERE id = old.images_id);
+    INSERT INTO character_stats (char_id, copies, favorites, rarity_0, rarity_1, rarity_2, rarity_3, rarity_4, rarity_5)
+    SELECT character_id, 1, new.favorite = 1, new.rarity = 0, new.rarity = 1, new.rarity = 2, new.rarity = 3, new.rarity = 4, new.rarity = 5
+    FROM images WHERE id = new.images_id
+    ON CONFLICT (char_id) DO UPDATE SET
+        copies = copies + excluded.copies,
+        favorites = favorites + excluded.favorites,
+        rarity_0 = rarity_0 + excluded.rarity_0,
+        rarity_1 = rarity_1 + excluded.rarity_1,
+        rarity_2 = rarity_2 + excluded.rarity_2,
+        rarity_3 = rarity_3 + excluded.rarity_3,
+        rarity_4 = rarity_4 + excluded.rarity_4,
+        rarity_5 = rarity_5 + excluded.rarity_5;
+END;
+
+-- Count the existing cards.
+INSERT INTO character_stats (char_id, copies, favorites, rarity_0, rarity_1, rarity_2, rarity_3, rarity_4, rarity_5)
+SELECT i.character_id, COUNT(*), SUM(w.favorite = 1), SUM(w.rarity = 0), SUM(w.rarity = 1), SUM(w.rarity = 2), SUM(w.rarity = 3), SUM(w.rarity = 4), SUM(w.rarity = 5)
+FROM waifus w
+INNER JOIN images i ON i.id = w.images_id
+GROUP BY i.character_id;
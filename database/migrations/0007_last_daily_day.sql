@@ -0,0 +1,7 @@
+-- Store the day of the last daily claim as a number of days since 1970-01-01, in local time like last_daily.
+-- Claims compare it to today's number, instead of formatting and parsing last_daily on every check.
+
+ALTER TABLE user ADD COLUMN last_daily_day integer NOT NULL DEFAULT 0;
+
+UPDATE user SET last_daily_day = CAST(julianday(DATE(last_daily)) - julianday('1970-01-01') AS integer)
+WHERE DATE(last_daily) IS NOT NULL;
@@ -0,0 +1,4 @@
+-- The day of the last scheduled daily grant, apart from last_daily_day, so a grant doesn't use up the user's own claim
+-- and running the grant twice on one day still grants once.
+
+ALTER TABLE user ADD COLUMN last_grant_day integer NOT NULL DEFAULT 0;
@@ -0,0 +1,28 @@
+-- Trigram full text index over the normalized names, for the name filters of "waifus", "rm" and the like.
+-- They match any part of a name, which the token index can't do without scanning every character.
+-- An external content table like character_search: the triggers keep it in sync with character.normalized_name.
+
+CREATE VIRTUAL TABLE character_name_search USING fts5(
+    normalized_name,
+    content='character', content_rowid='id', tokenize='trigram'
+);
+
+CREATE TRIGGER character_name_search_insert AFTER INSERT ON character BEGIN
+    INSERT INTO character_name_search (rowid, normalized_name)
+    VALUES (new.id, new.normalized_name);
+END;
+
+CREATE TRIGGER character_name_search_delete AFTER DELETE ON character BEGIN
+    INSERT INTO character_name_search (character_name_search, rowid, normalized_name)
+    VALUES ('delete', old.id, old.normalized_name);
+END;
+
+CREATE TRIGGER character_name_search_update AFTER UPDATE OF normalized_name ON character BEGIN
+    INSERT INTO character_name_search (character_name_search, rowid, normalized_name)
+    VALUES ('delete', old.id, old.normalized_name);
+    INSERT INTO character_name_search (rowid, normalized_name)
+    VALUES (new.id, new.normalized_name);
+END;
+
+-- Index the existing catalog.
+INSERT INTO character_name_search (character_name_search) VALUES ('rebuild');
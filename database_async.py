@@ -0,0 +1,179 @@
+"""
+Non-blocking access to database_tools for code running on the event loop.
+
+Every helper in database_tools can be awaited through this module under the same name, e.g.
+``await adb.get_user_currency(user_id)``. Other blocking functions that use the database can be awaited with ``run``.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import inspect
+
+import constants
+import database_tools as db
+
+_executor = None
+
+# Parameters that hold the ordering key of a database_tools helper, most preferred first.
+KEY_PARAMETERS = ('user_id', 'guild_id', 'user1_id', 'sender_id')
+
+
+class DatabaseExecutor:
+    '''
+    Runs blocking database calls on dedicated threads.
+
+    Calls are sharded by a key, normally a user or guild id. Each shard is a single thread that runs its calls in the
+    order they were made, so calls for the same user are never reordered. A shard holds at most `queue_size` calls,
+    further callers wait (in order) for a free slot.
+    '''
+
+    def __init__(self, shards = constants.DB_WORKER_THREADS, queue_size = constants.DB_QUEUE_SIZE):
+        self.threads = [
+            concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = f'acgb-db-{shard}')
+            for shard in range(shards)
+        ]
+        self.queue_size = queue_size
+        self.pending = [0] * shards
+        self.waiters = [collections.deque() for _ in range(shards)]
+
+
+    def shard_of(self, key):
+        if key is None:
+            return 0
+        return hash(key) % len(self.threads)
+
+
+    async def run(self, key, function, *args, **kwargs):
+        '''
+        Run a function on the shard of a key and wait for its result.
+        '''
+
+        shard = self.shard_of(key)
+        loop = asyncio.get_running_loop()
+
+        if self.pending[shard] >= self.queue_size or self.waiters[shard]:
+            # Shard is full, wait until a finishing call hands its slot over.
+            waiter = loop.create_future()
+            self.waiters[shard].append(waiter)
+
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self._release(shard)
+                elif waiter in self.waiters[shard]:
+                    self.waiters[shard].remove(waiter)
+                raise
+
+        else:
+            self.pending[shard] += 1
+
+        try:
+            return await loop.run_in_executor(self.threads[shard], functools.partial(function, *args, **kwargs))
+        finally:
+            self._release(shard)
+
+
+    def _release(self, shard):
+        while self.waiters[shard]:
+            waiter = self.waiters[shard].popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+        self.pending[shard] -= 1
+
+
+    def shutdown(self):
+        for thread in self.threads:
+            thread.shutdown(wait = True)
+
+
+def _get_executor():
+    global _executor
+
+    if _executor is None:
+        _executor = DatabaseExecutor()
+
+    return _executor
+
+
+def _key_parameter(function):
+    '''
+    Find the parameter of a database_tools helper that holds its ordering key, as (position, name).
+    Returns None for helpers without a user or guild, which all share one shard.
+    '''
+
+    parameters = list(inspect.signature(function).parameters)
+
+    for name in KEY_PARAMETERS:
+        if name in parameters:
+            return parameters.index(name), name
+
+    return None
+
+
+def _key_of(key_parameter, args, kwargs):
+    '''
+    Pick the ordering key of a database_tools call from the argument passed for its key parameter.
+    '''
+
+    if key_parameter is None:
+        return None
+
+    position, name = key_parameter
+
+    if name in kwargs:
+        return kwargs[name]
+
+    if position < len(args):
+        return args[position]
+
+    return None
+
+
+async def run(key, function, *args, **kwargs):
+    '''
+    Await a blocking function on the database threads, ordered with the other calls for `key`.
+    '''
+
+    return await _get_executor().run(key, function, *args, **kwargs)
+
+
+async def get_guild_config(guild_id):
+    '''
+    Guild configuration is read on every message, so a cached guild is answered right away without a thread hop.
+    '''
+
+    config = db.cached_guild_config(guild_id)
+
+    if config is None:
+        config = await run(guild_id, db.get_guild_config, guild_id)
+
+    return config
+
+
+async def get_assigned_channel_id(guild_id):
+    return (await get_guild_config(guild_id))["channel_id"]
+
+
+async def can_drop(guild_id):
+    return (await get_guild_config(guild_id))["can_drop"]
+
+
+def __getattr__(name):
+    function = getattr(db, name)
+
+    if not callable(function) or asyncio.iscoroutinefunction(function):
+        raise AttributeError(f"database_tools.{name} cannot be awaited through {__name__}")
+
+    key_parameter = _key_parameter(function)
+
+    @functools.wraps(function)
+    async def call(*args, **kwargs):
+        return await run(_key_of(key_parameter, args, kwargs), function, *args, **kwargs)
+
+    globals()[name] = call
+    return call
@@ -0,0 +1,192 @@
+import os
+
+import constants
+import name_tools as nt
+import logging
+logger = logging.getLogger('discord')
+
+MIGRATIONS_DIR = "database/migrations"
+
+
+def create_guild_history(cursor):
+    '''
+    Move the ";"-joined guild.history text into a ring buffer table.
+    '''
+
+    cursor.execute("""CREATE TABLE guild_history (
+    guild_id integer NOT NULL,
+    slot integer NOT NULL,
+    char_id integer NOT NULL,
+    CONSTRAINT guild_history_pk PRIMARY KEY (guild_id, slot)
+) WITHOUT ROWID;""")
+    cursor.execute("""ALTER TABLE guild ADD COLUMN history_head integer NOT NULL DEFAULT 0;""")
+
+    cursor.execute("""SELECT id, history FROM guild WHERE history IS NOT NULL AND history != '';""")
+    for guild_id, history in cursor.fetchall():
+        char_ids = [int(hist_element) for hist_element in history.split(";")][-constants.HISTORY_SIZE:]
+        cursor.executemany("""INSERT INTO guild_history (guild_id, slot, char_id) VALUES (?,?,?);""",
+                           [(guild_id, slot, char_id) for slot, char_id in enumerate(char_ids)])
+        cursor.execute("""UPDATE guild SET history_head = ?, history = NULL WHERE id = ?;""", (len(char_ids), guild_id))
+
+
+def add_normalized_names(cursor):
+    '''
+    Store each character's normalized name, and its name tokens for unordered lookups.
+    '''
+
+    cursor.execute("""ALTER TABLE character ADD COLUMN normalized_name text;""")
+    cursor.execute("""CREATE TABLE character_name_token (
+    token text NOT NULL,
+    char_id integer NOT NULL,
+    CONSTRAINT character_name_token_pk PRIMARY KEY (token, char_id)
+) WITHOUT ROWID;""")
+    cursor.execute("""CREATE INDEX character_name_token_char_id_idx ON character_name_token (char_id);""")
+
+    cursor.execute("""SELECT id, en_name, alt_name FROM character;""")
+    for char_id, en_name, alt_name in cursor.fetchall():
+        normalized_name, tokens = nt.name_keys(en_name, alt_name)
+        cursor.execute("""UPDATE character SET normalized_name = ? WHERE id = ?;""", (normalized_name, char_id))
+        cursor.executemany("""INSERT INTO character_name_token (token, char_id) VALUES (?,?);""",
+                           [(token, char_id) for token in tokens])
+
+
+def index_name_lookups(cursor):
+    '''
+    Index normalized names for exact lookups, add Japanese names to the name tokens, and mark characters whose names
+    are changed outside the bot, so they are indexed again.
+    '''
+
+    cursor.execute("""CREATE INDEX character_normalized_name_idx ON character (normalized_name);""")
+
+    # The tokens can only be computed in Python. A NULL normalized_name makes create_database() index the names again.
+    cursor.execute("""CREATE TRIGGER character_name_changed AFTER UPDATE OF en_name, jp_name, alt_name ON character
+WHEN old.en_name IS NOT new.en_name OR old.jp_name IS NOT new.jp_name OR old.alt_name IS NOT new.alt_name
+BEGIN
+    UPDATE character SET normalized_name = NULL WHERE id = new.id;
+    DELETE FROM character_name_token WHERE char_id = new.id;
+END;""")
+
+    cursor.execute("""SELECT id, en_name, alt_name, jp_name FROM character;""")
+    for char_id, en_name, alt_name, jp_name in cursor.fetchall():
+        normalized_name, tokens = nt.name_keys(en_name, alt_name, jp_name)
+        cursor.execute("""UPDATE character SET normalized_name = ? WHERE id = ?;""", (normalized_name, char_id))
+        cursor.execute("""DELETE FROM character_name_token WHERE char_id = ?;""", (char_id,))
+        cursor.executemany("""INSERT INTO character_name_token (token, char_id) VALUES (?,?);""",
+                           [(token, char_id) for token in tokens])
+
+
+# Schema versions on top of database/create.sql, applied in order.
+# A step is either a SQL file in MIGRATIONS_DIR or a function taking a cursor.
+MIGRATIONS = [
+    (1, "Hot path indexes", "0001_hot_path_indexes.sql"),
+    (2, "Stored image numbers", "0002_image_index.sql"),
+    (3, "Guild history ring buffer", create_guild_history),
+    (4, "Name search index", "0004_name_search.sql"),
+    (5, "Normalized name keys", add_normalized_names),
+    (6, "Character statistics", "0006_character_stats.sql"),
+    (7, "Daily claims by day number", "0007_last_daily_day.sql"),
+    (8, "Exact and Japanese name lookups", index_name_lookups),
+    (9, "Daily grants apart from claims", "0009_daily_grant_day.sql"),
+    (10, "Name part search index", "0010_name_part_search.sql"),
+]
+
+# Queries whose plans are reported before and after migrating.
+HOT_QUERIES = {
+    "inventory": ("""SELECT images_id, rarity, favorite FROM waifus WHERE user_id = ? ORDER BY id;""", (0,)),
+    "inventory count": ("""SELECT COUNT(*) FROM waifus WHERE user_id = ?;""", (0,)),
+    "drop images": ("""SELECT id, normal_url FROM images WHERE droppable = 1 AND character_id = ?;""", (0,)),
+    "image index": ("""SELECT COUNT(*) FROM images WHERE character_id = ? AND id <= ?;""", (0, 0)),
+    "character stats": ("""SELECT c.en_name, s.copies FROM character c LEFT JOIN character_stats s ON s.char_id = c.id WHERE c.id = ?;""", (0,)),
+    "series characters": ("""SELECT sc.char_id, c.en_name FROM show_character sc LEFT JOIN character c ON sc.char_id = c.id WHERE sc.show_id = ?;""", (0,)),
+    "character shows": ("""SELECT DISTINCT show_id FROM show_character WHERE char_id = ?;""", (0,)),
+    "character search": ("""SELECT rowid FROM character_search WHERE character_search MATCH ? ORDER BY rank LIMIT 25;""", ('"abc"',)),
+    "show search": ("""SELECT rowid FROM show_search WHERE show_search MATCH ? ORDER BY rank LIMIT 25;""", ('"abc"',)),
+    "exact name": ("""SELECT id FROM character WHERE normalized_name = ?;""", ("a",)),
+    "name part search": ("""SELECT rowid FROM character_name_search WHERE character_name_search MATCH ?;""", ('"abc"',)),
+    "name token": ("""SELECT char_id FROM character_name_token WHERE token >= ? AND token < ?;""", ("a", "b")),
+    "show by mal id": ("""SELECT id FROM show WHERE mal_id = ? AND is_manga = ?;""", (0, 0)),
+}
+
+
+def schema_version(cursor):
+    cursor.execute("""PRAGMA user_version;""")
+    return cursor.fetchone()[0]
+
+
+def explain(cursor, query, params):
+    '''
+    Get the query plan of a statement as a single line.
+    '''
+
+    cursor.execute("EXPLAIN QUERY PLAN " + query, params)
+    return " | ".join(row[3] for row in cursor.fetchall())
+
+
+def explain_hot_queries(cursor):
+    plans = {}
+    for name, (query, params) in HOT_QUERIES.items():
+        try:
+            plans[name] = explain(cursor, query, params)
+        except Exception as e:
+            # The query may refer to columns a later migration adds.
+            plans[name] = f"unavailable ({e})"
+    return plans
+
+
+def apply_migration(conn, cursor, version, step):
+    if callable(step):
+        cursor.execute("""BEGIN;""")
+        try:
+            step(cursor)
+            cursor.execute(f"""PRAGMA user_version = {int(version)};""")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    else:
+        with open(os.path.join(MIGRATIONS_DIR, step), encoding="utf-8") as migration_file:
+            sql_as_string = migration_file.read()
+
+        try:
+            cursor.executescript(f"BEGIN;\n{sql_as_string}\nPRAGMA user_version = {int(version)};\nCOMMIT;")
+        except Exception:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+
+
+def migrate(conn, cursor):
+    '''
+    Bring a database up to the latest schema version, in place.
+
+    Returns the before and after query plans of the hot queries, keyed by query name.
+    '''
+
+    version = schema_version(cursor)
+    pending = [migration for migration in MIGRATIONS if migration[0] > version]
+
+    if not pending:
+        logger.info(f"Database schema is up to date (version {version}).")
+        return {}
+
+    before = explain_hot_queries(cursor)
+
+    for version, description, step in pending:
+        logger.info(f"Applying migration {version}: {description}")
+        apply_migration(conn, cursor, version, step)
+
+    cursor.execute("""ANALYZE;""")
+    conn.commit()
+
+    after = explain_hot_queries(cursor)
+
+    report = {}
+    for name in HOT_QUERIES:
+        report[name] = (before[name], after[name])
+        logger.info(f"Query plan for {name}:")
+        logger.info(f"    before: {before[name]}")
+        logger.info(f"    after:  {after[name]}")
+
+    logger.info(f"Database schema migrated to version {version}.")
+    return report
@@ -0,0 +1,180 @@
+import queue
+import sqlite3
+import threading
+import time
+
+import constants
+import db_metrics
+import logging
+logger = logging.getLogger('discord')
+
+
+class CountingCursor(sqlite3.Cursor):
+    '''
+    A cursor that reports the rows it fetches to db_metrics.
+    '''
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            db_metrics.record_rows(1)
+        return row
+
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        db_metrics.record_rows(len(rows))
+        return rows
+
+
+    def fetchall(self):
+        rows = super().fetchall()
+        db_metrics.record_rows(len(rows))
+        return rows
+
+
+    def __next__(self):
+        row = super().__next__()
+        db_metrics.record_rows(1)
+        return row
+
+
+class PooledConnection:
+    '''
+    A long-lived SQLite connection handed out by a ConnectionPool.
+
+    Behaves like a regular sqlite3 connection, except that close() returns it to the pool instead of closing it.
+    Using it in a with block closes it at the end of the block, also when the block raises.
+    '''
+
+    def __init__(self, pool, connection, readonly):
+        self.pool = pool
+        self.connection = connection
+        self.readonly = readonly
+
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+    def cursor(self):
+        return self.connection.cursor(CountingCursor)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Unlike a sqlite3 connection, this doesn't commit. Whatever the block didn't commit is rolled back.
+        self.close()
+        return False
+
+
+    def close(self):
+        '''
+        Give the connection back to the pool. Uncommitted changes are rolled back, like closing would.
+        '''
+        self.pool.release(self)
+
+
+class ConnectionPool:
+    '''
+    A pool of SQLite connections to one database file.
+
+    There is a single writer connection, guarded by a re-entrant lock so nested helpers on the same thread share it,
+    and a small set of read-only connections. All connections use WAL mode so readers never block on the writer.
+    '''
+
+    def __init__(self, uri, readers = constants.DB_READER_CONNECTIONS, cached_statements = constants.DB_CACHED_STATEMENTS, timeout = constants.DB_BUSY_TIMEOUT):
+        self.uri = uri
+        self.readers = readers
+        self.cached_statements = cached_statements
+        self.timeout = timeout
+
+        self._writer = None
+        self._writer_lock = threading.RLock()
+        self._writer_depth = 0
+
+        self._idle_readers = queue.LifoQueue()
+        self._closed = False
+
+
+    def _connect(self, readonly):
+        connection = sqlite3.connect(self.uri,
+                                     timeout = self.timeout,
+                                     cached_statements = self.cached_statements,
+                                     check_same_thread = False)
+        connection.execute("PRAGMA journal_mode = WAL;")
+        connection.execute("PRAGMA synchronous = NORMAL;")
+        connection.set_trace_callback(db_metrics.trace_statement)
+        if readonly:
+            connection.execute("PRAGMA query_only = ON;")
+        return PooledConnection(self, connection, readonly)
+
+
+    def acquire(self, readonly = False):
+        '''
+        Get a connection from the pool. Readonly connections are shared between threads, the writer is exclusive.
+        '''
+
+        if readonly:
+            try:
+                return self._idle_readers.get_nowait()
+            except queue.Empty:
+                return self._connect(readonly = True)
+
+        start = time.perf_counter()
+        self._writer_lock.acquire()
+        db_metrics.record_lock_wait(time.perf_counter() - start)
+        try:
+            if self._writer is None:
+                self._writer = self._connect(readonly = False)
+        except BaseException:
+            self._writer_lock.release()
+            raise
+        self._writer_depth += 1
+        return self._writer
+
+
+    def release(self, pooled):
+        '''
+        Return a connection to the pool.
+        '''
+
+        if pooled.readonly:
+            if pooled.in_transaction:
+                pooled.connection.rollback()
+
+            if self._closed or self._idle_readers.qsize() >= self.readers:
+                pooled.connection.close()
+            else:
+                self._idle_readers.put(pooled)
+            return
+
+        self._writer_depth -= 1
+        try:
+            if self._writer_depth == 0 and pooled.in_transaction:
+                # The outermost user of the writer did not commit, so discard its changes.
+                pooled.connection.rollback()
+        finally:
+            self._writer_lock.release()
+
+
+    def close(self):
+        '''
+        Close every idle connection. Connections that are checked out are closed when they are released.
+        '''
+
+        self._closed = True
+
+        while True:
+            try:
+                self._idle_readers.get_nowait().connection.close()
+            except queue.Empty:
+                break
+
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.connection.close()
+                self._writer = None
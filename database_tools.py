@@ -1,13 +1,23 @@
+import array
 import asyncio
+import atexit
+import contextlib
+import contextvars
 import datetime
 import random
-import sqlite3
 import os
+import threading
 
 import bot_token
 import constants
+import database_migrations
+import database_pool
+import db_metrics
+import drop_sampler
+import lru_cache
 import mal_tools
 import name_tools as nt
+import write_behind
 import logging
 logger = logging.getLogger('discord')
 
@@ -16,28 +26,257 @@ DATABASE_URI = os.getenv("ACGB_DATABASE")
 
 DAILY_CURRENCY = 500
 
+# Shorter name searches can't use the trigram indexes.
+SEARCH_MIN_LENGTH = 3
 
-def get_connection():
-    conn = sqlite3.connect(DATABASE_URI)
-    return conn, conn.cursor()
+# Most characters a name lookup returns.
+NAME_MATCH_LIMIT = 25
+
+# Most ids bound in one "IN (...)" list, well below SQLite's limit on statement variables.
+IN_LIST_SIZE = 500
+
+# Columns of the cached user states and guild configs.
+USER_STATE_COLUMNS = "currency, upgrades, last_daily_day"
+GUILD_CONFIG_COLUMNS = "channel_id, can_drop, history_head"
+
+# What a dropped or rolled waifu is shown with, from images joined with character.
+DROP_COLUMNS = "images.character_id, images.id, en_name, alt_name, jp_name, normal_url, mirror_url, flipped_url, image_index"
+
+
+class _Database:
+    '''
+    The connection pool, caches and queued rewards of one database.
+    '''
+
+    def __init__(self, uri):
+        self.pool = database_pool.ConnectionPool(uri)
+
+        # Bumped whenever characters or images are added or change droppability.
+        self.catalog_version = 0
+        self.drop_sampler = drop_sampler.DropSampler()
+
+        # In-memory mirrors of guild_history, by guild id.
+        self.guild_histories = {}
+
+        # Drop rewards waiting to be written by flush_pending_rewards().
+        self.pending_rewards = write_behind.PendingRewards()
+
+        # Committed currency, upgrades and last daily claim day of recently active users, by user id.
+        # Every write to these columns goes through a helper below that updates the cache after committing.
+        self.user_cache = lru_cache.LRUCache(constants.USER_CACHE_SIZE)
+
+        # Assigned channel, drop setting and history head of recently active guilds, by guild id.
+        # Guilds without a row are cached too, so messages in unassigned guilds don't query the database either.
+        self.guild_cache = lru_cache.LRUCache(constants.GUILD_CACHE_SIZE)
+
+        # Waifus ids of recently active users in inventory order, by user id, so an inventory number is a direct array
+        # index. The arrays are never changed in place. Writes replace or drop them while holding the writer connection,
+        # and misses are loaded on the writer connection too, so a load can't cache ids from before a write that
+        # committed after it.
+        self.inventory_cache = lru_cache.LRUCache(constants.INVENTORY_CACHE_SIZE)
+
+        # PRAGMA data_version of the writer connection when the caches were last checked against the database.
+        # It only changes when another connection commits, and only the writer commits in this process.
+        self.data_version = None
+
+
+# The databases used so far, by URI.
+_databases = {}
+_databases_lock = threading.Lock()
+
+# The database the functions below use, when not DATABASE_URI. Set with using_database().
+_database_uri = contextvars.ContextVar("database_uri", default=None)
+
+
+def _database():
+    uri = _database_uri.get() or DATABASE_URI
+    database = _databases.get(uri)
+    if database is None:
+        with _databases_lock:
+            database = _databases.get(uri)
+            if database is None:
+                database = _databases[uri] = _Database(uri)
+    return database
+
+
+@contextlib.contextmanager
+def using_database(uri):
+    """
+    Make the functions of this module use the database at uri inside the with block, instead of DATABASE_URI.
+    Each database has its own connection pool, caches and queued rewards.
+    """
+    token = _database_uri.set(uri)
+    try:
+        yield
+    finally:
+        _database_uri.reset(token)
+
+
+def get_connection(readonly=False):
+    """
+    Get a pooled connection and a cursor for it. Calling close() on the connection, or leaving a with block on it,
+    returns it to the pool.
+
+    Read-only helpers should pass readonly=True so they don't wait on the single writer connection.
+    """
+    conn = _database().pool.acquire(readonly)
+    try:
+        return conn, conn.cursor()
+    except BaseException:
+        conn.close()
+        raise
+
+
+def drop_stale_caches(connection=None):
+    """
+    Clear the caches if another process, like daily.py, committed to the database since the last check.
+    Returns whether they were cleared.
+    """
+    database = _database()
+    if connection:
+        conn, cursor = connection
+    else:
+        conn, cursor = get_connection()
+    try:
+        cursor.execute("""PRAGMA data_version;""")
+        data_version = cursor.fetchone()[0]
+        if data_version == database.data_version:
+            return False
+
+        # Cleared while holding the writer connection, so no write can cache a value from before the check.
+        if database.data_version is not None:
+            logger.info("The database was changed by another process, clearing the caches.")
+        database.data_version = data_version
+        database.user_cache.clear()
+        database.guild_cache.clear()
+        database.inventory_cache.clear()
+        database.guild_histories.clear()
+        catalog_changed()
+        return True
+    finally:
+        if not connection:
+            conn.close()
 
 
 def create_database():
     logger.info("Setting up DB.")
     conn, cursor = get_connection()
+    with conn:
+        cursor.execute("""SELECT name FROM sqlite_master WHERE type = 'table';""")
+        if not cursor.fetchall():
+            # Fresh database, create the base schema that the migrations build on.
+            create_script = open("database/create.sql")
+            sql_as_string = create_script.read()
+            cursor.executescript(sql_as_string)
+            create_script.close()
+
+        database_migrations.migrate(conn, cursor)
+
+        # Characters added or renamed outside the bot have no normalized name yet.
+        cursor.execute("""SELECT id FROM character WHERE normalized_name IS NULL;""")
+        unindexed = [row[0] for row in cursor.fetchall()]
+        if unindexed:
+            logger.info(f"Indexing the names of {len(unindexed)} characters.")
+            for char_id in unindexed:
+                index_character_name(cursor, char_id)
+            conn.commit()
 
-    create_script = open("database/create.sql")
-    sql_as_string = create_script.read()
-    cursor.executescript(sql_as_string)
-    create_script.close()
-
-    conn.close()
     logger.info("Finished setting up DB")
 
 
-def bulk_insert_character(character_data_list):
-    for character_data in character_data_list:
-        insert_character(character_data)
+def bulk_insert_character(character_data_list, overwrite=False):
+    conn, cursor = get_connection()
+    with conn:
+        _ingest_characters(cursor, character_data_list, overwrite)
+        conn.commit()
+    catalog_changed()
+
+
+def get_existing_character_ids(char_ids):
+    char_ids = list(char_ids)
+    if not char_ids:
+        return set()
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute(f"""SELECT id FROM character WHERE id IN ({",".join("?" * len(char_ids))});""", char_ids)
+        rows = cursor.fetchall()
+    return {row[0] for row in rows}
+
+
+def _ingest_characters(cursor, character_data_list, overwrite=False):
+    """
+    Insert characters and their new images, with one statement per table for the whole list. Doesn't commit.
+    Existing characters are skipped, unless overwrite is set. Then their names are updated, unless they have an
+    alt_name, because it might have been manually changed.
+    """
+    characters = []
+    for char_data in character_data_list:
+        images = [image for image in char_data["images"] if image]
+        if not images:
+            logger.warn(f"Character {char_data['char_id']} {char_data['en_name']} does not have any images. Skipping.")
+            continue
+        characters.append((int(char_data["char_id"]), char_data["en_name"], char_data["jp_name"], images))
+
+    if not overwrite:
+        existing = get_existing_character_ids(char_id for char_id, _, _, _ in characters)
+        for char_id, en_name, _, _ in characters:
+            if char_id in existing:
+                logger.warn(f"Character {char_id} {en_name} already exists in the database and not overwriting.")
+        characters = [character for character in characters if character[0] not in existing]
+
+    if not characters:
+        return
+
+    logger.info(f"Inserting {len(characters)} characters")
+    cursor.executemany("""INSERT INTO character (id, en_name, jp_name) VALUES (?,?,?)
+ON CONFLICT (id) DO UPDATE SET en_name = excluded.en_name, jp_name = excluded.jp_name
+WHERE character.alt_name IS NULL;""",
+                       [(char_id, en_name, jp_name) for char_id, en_name, jp_name, _ in characters])
+
+    # Images the character already has are skipped. New ones are numbered after the existing ones.
+    cursor.executemany("""INSERT INTO images (character_id, mal_url, normal_url, mirror_url, flipped_url, image_index)
+SELECT ?1, ?2, ?3, ?4, ?5, (SELECT COALESCE(MAX(image_index), 0) + 1 FROM images WHERE character_id = ?1)
+WHERE NOT EXISTS (SELECT 1 FROM images WHERE character_id = ?1 AND mal_url = ?2);""",
+                       [(char_id, image.mal_url, image.normal_url, image.mirror_url, image.upside_down_url)
+                        for char_id, _, _, images in characters
+                        for image in images])
+
+    for char_id, _, _, _ in characters:
+        index_character_name(cursor, char_id)
+
+
+def ingest_show(mal_id, jp_title, en_title, is_manga, char_ids, character_data_list=(), overwrite=False):
+    """
+    Store a scraped show in one transaction: the show itself, the (new) characters in character_data_list and their
+    images, and links between the show and every character in char_ids that exists.
+    Returns the show id.
+    """
+    conn, cursor = get_connection()
+    logger.info(f"Ingesting show {mal_id} {en_title}, is_manga: {is_manga}")
+
+    try:
+        cursor.execute("""BEGIN IMMEDIATE;""")
+        cursor.execute("""INSERT INTO show (mal_id, jp_title, en_title, is_manga)
+SELECT ?1, ?2, ?3, ?4
+WHERE NOT EXISTS (SELECT 1 FROM show WHERE mal_id = ?1 AND is_manga = ?4);""", (mal_id, jp_title, en_title, is_manga))
+        cursor.execute("""SELECT id FROM show WHERE mal_id = ? AND is_manga = ?;""", (mal_id, is_manga))
+        show_id = cursor.fetchone()[0]
+
+        _ingest_characters(cursor, character_data_list, overwrite)
+
+        cursor.executemany("""INSERT INTO show_character (char_id, show_id)
+SELECT ?1, ?2
+WHERE EXISTS (SELECT 1 FROM character WHERE id = ?1)
+AND NOT EXISTS (SELECT 1 FROM show_character WHERE char_id = ?1 AND show_id = ?2);""",
+                           [(int(char_id), show_id) for char_id in char_ids])
+
+        conn.commit()
+    finally:
+        # Rolls back if anything failed.
+        conn.close()
+
+    catalog_changed()
+    return show_id
 
 
 def insert_character(char_data, alt_name=None, overwrite=False):
@@ -58,46 +297,94 @@ def insert_character(char_data, alt_name=None, overwrite=False):
 
     logger.info(f"Inserting character {char_id} {en_name}")
     conn, cursor = get_connection()
-
-    if overwrite and exists:
-        # Character exists but we are overwriting its data.
-        # UNLESS it has an alt_name set, because it might have been manually changed.
-        cursor.execute("""UPDATE character SET en_name = ?, jp_name = ? WHERE id = ? AND alt_name = NULL;""",
-                        (en_name, jp_name, char_id))
-    else:
-        if not exists:
-            cursor.execute("""INSERT INTO character (id, en_name, jp_name, alt_name) VALUES (?,?,?,?);""",
-                        (char_id, en_name, jp_name, alt_name))
-    
-    for image in images:
-        if not character_has_image(cursor, char_id, image.mal_url):
-            logger.info(f"Inserting image {image.mal_url}")
-            cursor.execute("""INSERT INTO images (character_id, mal_url, normal_url, mirror_url, flipped_url) VALUES (?,?,?,?,?);""", (char_id, image.mal_url, image.normal_url, image.mirror_url, image.upside_down_url))
+    with conn:
+        if overwrite and exists:
+            # Character exists but we are overwriting its data.
+            # UNLESS it has an alt_name set, because it might have been manually changed.
+            cursor.execute("""UPDATE character SET en_name = ?, jp_name = ? WHERE id = ? AND alt_name IS NULL;""",
+                            (en_name, jp_name, char_id))
         else:
-            logger.warn(f"Character {char_id} already has image with MAL URL {image.mal_url}. Skipping image.")
+            if not exists:
+                cursor.execute("""INSERT INTO character (id, en_name, jp_name, alt_name) VALUES (?,?,?,?);""",
+                            (char_id, en_name, jp_name, alt_name))
+    
+        index_character_name(cursor, char_id)
+
+        for image in images:
+            if not character_has_image(cursor, char_id, image.mal_url):
+                logger.info(f"Inserting image {image.mal_url}")
+                cursor.execute("""INSERT INTO images (character_id, mal_url, normal_url, mirror_url, flipped_url, image_index)
+VALUES (?,?,?,?,?,(SELECT COALESCE(MAX(image_index), 0) + 1 FROM images WHERE character_id = ?));""",
+                               (char_id, image.mal_url, image.normal_url, image.mirror_url, image.upside_down_url, char_id))
+            else:
+                logger.warn(f"Character {char_id} already has image with MAL URL {image.mal_url}. Skipping image.")
+
+        conn.commit()
+    catalog_changed()
+
+
+def index_character_name(cursor, char_id):
+    """
+    Store the normalized name and name tokens of a character, from the names it has in the database.
+    Call it after every write to a name.
+    """
+    cursor.execute("""SELECT en_name, alt_name, jp_name FROM character WHERE id = ?;""", (char_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return
+
+    normalized_name, tokens = nt.name_keys(row[0], row[1], row[2])
+    cursor.execute("""UPDATE character SET normalized_name = ? WHERE id = ?;""", (normalized_name, char_id))
+    cursor.execute("""DELETE FROM character_name_token WHERE char_id = ?;""", (char_id,))
+    cursor.executemany("""INSERT INTO character_name_token (token, char_id) VALUES (?,?);""",
+                       [(token, char_id) for token in tokens])
+
+
+def _guild_config(row):
+    """
+    Turn a row of GUILD_CONFIG_COLUMNS, or None for a guild without a row, into a guild cache entry.
+    """
+    if row is None:
+        return {"exists": False, "channel_id": None, "can_drop": False, "history_head": 0}
+
+    return {"exists": True, "channel_id": row[0], "can_drop": bool(row[1]), "history_head": row[2]}
+
+
+def cached_guild_config(guild_id):
+    """
+    Get the configuration of a guild if it is cached, without touching the database. Returns None on a miss.
+    """
+    return _database().guild_cache.get(guild_id)
 
-    conn.commit()
-    conn.close()
+
+def get_guild_config(guild_id):
+    """
+    Get the assigned channel, drop setting and history head of a guild, from the cache if possible.
+    The returned dict must not be modified.
+    """
+    guild_cache = _database().guild_cache
+    config = guild_cache.get(guild_id)
+    if config is not None:
+        return config
+
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute(f"""SELECT {GUILD_CONFIG_COLUMNS} FROM guild WHERE id = ?;""", (guild_id,))
+        row = cursor.fetchone()
+
+    # Don't overwrite a newer config that a write stored in the meantime.
+    return guild_cache.setdefault(guild_id, _guild_config(row))
 
 
 def guild_exists(guild_id):
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT id FROM guild WHERE id = ?;""", (guild_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    if not rows:
-        # Guild does not exist
-        return False
-    else:
-        # Guild does exist
-        return True
+    return get_guild_config(guild_id)["exists"]
 
 
 def character_exists(char_id):
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT id FROM character WHERE id = ?;""", (char_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT id FROM character WHERE id = ?;""", (char_id,))
+        rows = cursor.fetchall()
     if not rows:
         return False
     else:
@@ -105,10 +392,10 @@ def character_exists(char_id):
 
 
 def show_exists_by_mal(mal_id, is_manga):
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT id FROM show WHERE mal_id = ? AND is_manga = ?;""", (mal_id, is_manga))
-    rows = cursor.fetchall()
-    conn.close()
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT id FROM show WHERE mal_id = ? AND is_manga = ?;""", (mal_id, is_manga))
+        rows = cursor.fetchall()
     if not rows:
         return False
     else:
@@ -116,10 +403,10 @@ def show_exists_by_mal(mal_id, is_manga):
 
 
 def show_exists(show_id):
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT id FROM show WHERE id = ?;""", (show_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT id FROM show WHERE id = ?;""", (show_id,))
+        rows = cursor.fetchall()
     if not rows:
         return False
     else:
@@ -128,14 +415,15 @@ def show_exists(show_id):
 
 def waifu_exists(waifus_id, connection=None):
     if not connection:
-        conn, cursor = get_connection()
+        conn, cursor = get_connection(readonly=True)
     else:
         conn, cursor = connection
-    cursor.execute("""SELECT id FROM waifus WHERE id = ?;""", (waifus_id,))
-    rows = cursor.fetchall()
-
-    if not connection:
-        conn.close()
+    try:
+        cursor.execute("""SELECT id FROM waifus WHERE id = ?;""", (waifus_id,))
+        rows = cursor.fetchall()
+    finally:
+        if not connection:
+            conn.close()
 
     if not rows:
         return False
@@ -145,49 +433,32 @@ def waifu_exists(waifus_id, connection=None):
 
 def assign_channel_to_guild(channel_id, guild_id):
     conn, cursor = get_connection()
-    if guild_exists(guild_id):
-        # Guild already exists, update channel.
-        cursor.execute("""UPDATE guild SET channel_id = ? WHERE id = ?;""", (channel_id, guild_id))
-    else:
-        # Guild does not exist, insert it.
-        cursor.execute("""INSERT INTO guild (id, channel_id) VALUES (?,?);""", (guild_id, channel_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        if guild_exists(guild_id):
+            # Guild already exists, update channel.
+            cursor.execute(f"""UPDATE guild SET channel_id = ? WHERE id = ? RETURNING {GUILD_CONFIG_COLUMNS};""", (channel_id, guild_id))
+        else:
+            # Guild does not exist, insert it.
+            cursor.execute(f"""INSERT INTO guild (id, channel_id) VALUES (?,?) RETURNING {GUILD_CONFIG_COLUMNS};""", (guild_id, channel_id))
+        rows = cursor.fetchall()
+        conn.commit()
+        _database().guild_cache.put(guild_id, _guild_config(rows[0] if rows else None))
 
 
 def get_assigned_channel_id(guild_id):
-    channel_id = None
-
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT channel_id FROM guild WHERE id = ?;""", (guild_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    if rows and rows[0]:
-        channel_id = rows[0][0]
-
-    return channel_id
+    return get_guild_config(guild_id)["channel_id"]
 
 
 def can_drop(guild_id):
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT can_drop FROM guild WHERE id = ? AND can_drop = 1;""", (guild_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    if rows:
-        return True
-    else:
-        return False
-
+    return get_guild_config(guild_id)["can_drop"]
 
-def can_trade(user_id, bot):
-    # Any time "can trade" is checked, we need to make sure to cancel any timed out trades first.
-    
-    bot.timeout_trades()
 
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT can_trade FROM user WHERE id = ? AND can_trade = 1;""", (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
+def can_trade(user_id):
+    # Any time "can trade" is checked, the caller needs to make sure to cancel any timed out trades first.
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT can_trade FROM user WHERE id = ? AND can_trade = 1;""", (user_id,))
+        rows = cursor.fetchall()
     if rows:
         return True
     else:
@@ -195,64 +466,78 @@ def can_trade(user_id, bot):
 
 
 def can_remove(user_id):
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT can_remove FROM user WHERE id = ? AND can_remove = 1;""", (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT can_remove FROM user WHERE id = ? AND can_remove = 1;""", (user_id,))
+        rows = cursor.fetchall()
     if rows:
         return True
     else:
         return False
 
 
+def get_drop_sampler():
+    """
+    Get the in-memory pool of droppable characters, reloading it if the catalog changed since it was loaded.
+    """
+    database = _database()
+    sampler = database.drop_sampler
+    with sampler.lock:
+        if sampler.is_stale(database.catalog_version):
+            version = database.catalog_version
+            conn, cursor = get_connection(readonly=True)
+            with conn:
+                if bot_token.isDebug():
+                    cursor.execute("""SELECT c.id, i.id FROM character c JOIN images i ON c.id = i.character_id
+WHERE c.droppable = 1 AND i.droppable = 1 AND i.normal_url IS NOT NULL
+ORDER BY c.id, i.id;""")
+                else:
+                    cursor.execute("""SELECT c.id, i.id FROM character c JOIN images i ON c.id = i.character_id
+WHERE c.droppable = 1 AND i.droppable = 1
+ORDER BY c.id, i.id;""")
+                sampler.load(cursor, version)
+            logger.info(f"Loaded {len(sampler)} droppable characters.")
+
+    return sampler
+
+
+def catalog_changed():
+    """
+    Mark the character catalog as changed, so the drop pool is reloaded before the next drop.
+    """
+    _database().catalog_version += 1
+
+
+def _drop_data(row, rarity):
+    """
+    Turn a row of DROP_COLUMNS into the data of a dropped or rolled waifu.
+    """
+    return {"id": row[0],
+            "en_name": row[2],
+            "jp_name": row[4],
+            "alt_name": row[3],
+            "image_url": row[5],
+            "image_id": row[1],
+            "image_index": row[8],
+            "rarity": rarity,
+            "normal_url": row[5],
+            "mirror_url": row[6],
+            "flipped_url": row[7]}
+
+
 def get_drop_data(history=None, price=None, user_id=None):
-    conn, cursor = get_connection()
-    if history:
-        if bot_token.isDebug():
-            cursor.execute(
-                f"""SELECT DISTINCT c.id FROM character c JOIN images i on c.id = i.character_id WHERE c.droppable = 1 AND i.normal_url IS NOT NULL AND c.id NOT IN ({",".join(["?" for _ in history])});""",
-                tuple(history))
-        else:
-            cursor.execute(
-                f"""SELECT DISTINCT id FROM character WHERE droppable = 1 AND id NOT IN ({",".join(["?" for _ in history])});""",
-                tuple(history))
-    else:
-        cursor.execute("""SELECT DISTINCT id FROM character WHERE droppable = 1;""")
-    rows = cursor.fetchall()
+    exclude = history or ()
+    char_id, image_id = get_drop_sampler().sample(exclude)
+
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute(f"""SELECT {DROP_COLUMNS} FROM images
+JOIN character ON character.id = images.character_id
+WHERE images.id = ?;""", (image_id,))
+        row = cursor.fetchone()
 
-    char_id = random.choice(rows)[0]
-    if bot_token.isDebug():
-        cursor.execute("""SELECT en_name, alt_name, images.id, jp_name, normal_url, mirror_url, flipped_url FROM character
-LEFT JOIN images ON character.id = images.character_id
-WHERE images.droppable = 1 AND normal_url IS NOT NULL AND character.id = ?;""", (char_id,))
-    else:
-        cursor.execute("""SELECT en_name, alt_name, images.id, jp_name, normal_url, mirror_url, flipped_url FROM character
-LEFT JOIN images ON character.id = images.character_id
-WHERE images.droppable = 1 AND character.id = ?;""", (char_id,))
-    rows2 = cursor.fetchall()
-
-    conn.close()
-
-    random.shuffle(rows2)
-    en_name = rows2[0][0]
-    alt_name = rows2[0][1]
-    jp_name = rows2[0][3]
-    image_id = rows2[0][2]
-    normal_url = rows2[0][4]
-    mirror_url = rows2[0][5]
-    flipped_url = rows2[0][6]
     rarity, price = generate_rarity(price)
-
-    cur_waifu = {"id": char_id,
-                 "en_name": en_name,
-                 "jp_name": jp_name,
-                 "alt_name": alt_name,
-                 "image_url": normal_url,
-                 "image_id": image_id,
-                 "rarity": rarity,
-                 "normal_url": normal_url,
-                 "mirror_url": mirror_url,
-                 "flipped_url": flipped_url}
+    cur_waifu = _drop_data(row, rarity)
 
     if price and user_id:
         # We are rolling.
@@ -267,94 +552,272 @@ WHERE images.droppable = 1 AND character.id = ?;""", (char_id,))
 
 def disable_drops(guild_id):
     conn, cursor = get_connection()
-    cursor.execute("""UPDATE guild SET can_drop = 0 WHERE id = ?;""", (guild_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor.execute(f"""UPDATE guild SET can_drop = 0 WHERE id = ? RETURNING {GUILD_CONFIG_COLUMNS};""", (guild_id,))
+        rows = cursor.fetchall()
+        conn.commit()
+        _database().guild_cache.put(guild_id, _guild_config(rows[0] if rows else None))
 
 
 def enable_drops(guild_id):
     conn, cursor = get_connection()
-    cursor.execute("""UPDATE guild SET can_drop = 1 WHERE id = ?;""", (guild_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor.execute(f"""UPDATE guild SET can_drop = 1 WHERE id = ? RETURNING {GUILD_CONFIG_COLUMNS};""", (guild_id,))
+        rows = cursor.fetchall()
+        conn.commit()
+        _database().guild_cache.put(guild_id, _guild_config(rows[0] if rows else None))
 
 
 def enable_trade(user_id):
     conn, cursor = get_connection()
-    cursor.execute("""UPDATE user SET can_trade = 1 WHERE id = ?;""", (user_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor.execute("""UPDATE user SET can_trade = 1 WHERE id = ?;""", (user_id,))
+        conn.commit()
 
 
 def disable_trade(user_id):
     conn, cursor = get_connection()
-    cursor.execute("""UPDATE user SET can_trade = 0 WHERE id = ?;""", (user_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor.execute("""UPDATE user SET can_trade = 0 WHERE id = ?;""", (user_id,))
+        conn.commit()
 
 
 def enable_remove(user_id):
     conn, cursor = get_connection()
-    cursor.execute("""UPDATE user SET can_remove = 1 WHERE id = ?;""", (user_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor.execute("""UPDATE user SET can_remove = 1 WHERE id = ?;""", (user_id,))
+        conn.commit()
 
 
 def disable_remove(user_id):
     conn, cursor = get_connection()
-    cursor.execute("""UPDATE user SET can_remove = 0 WHERE id = ?;""", (user_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor.execute("""UPDATE user SET can_remove = 0 WHERE id = ?;""", (user_id,))
+        conn.commit()
 
 
 def enable_all_drops():
     conn, cursor = get_connection()
-    cursor.execute("""UPDATE guild SET can_drop = 1;""")
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor.execute("""UPDATE guild SET can_drop = 1;""")
+        conn.commit()
+        _database().guild_cache.clear()
 
 
 def enable_all_trades():
     conn, cursor = get_connection()
-    cursor.execute("""UPDATE user SET can_trade = 1;""")
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor.execute("""UPDATE user SET can_trade = 1;""")
+        conn.commit()
 
 
 def enable_all_removes():
     conn, cursor = get_connection()
-    cursor.execute("""UPDATE user SET can_remove = 1;""")
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor.execute("""UPDATE user SET can_remove = 1;""")
+        conn.commit()
 
 
 def ensure_user_exists(user_id, connection=None):
+    if user_id in _database().user_cache:
+        # Only existing users are cached.
+        return
     if connection:
         conn, cursor = connection
     else:
         conn, cursor = get_connection()
-    cursor.execute("""SELECT id FROM user WHERE id = ?;""", (user_id,))
-    rows = cursor.fetchall()
-    if not rows:
-        # User does not exist
-        cursor.execute("""INSERT INTO user (id, last_daily) VALUES (?,?);""", (user_id, datetime.datetime.now()))
-        conn.commit()
-    if not connection:
-        conn.close()
+    try:
+        cursor.execute("""SELECT id FROM user WHERE id = ?;""", (user_id,))
+        rows = cursor.fetchall()
+        if not rows:
+            # User does not exist
+            cursor.execute("""INSERT INTO user (id, last_daily, last_daily_day) VALUES (?,?,?);""", (user_id, datetime.datetime.now(), epoch_day()))
+            conn.commit()
+    finally:
+        if not connection:
+            conn.close()
+
+
+def epoch_day(date=None):
+    """
+    Get the number of a (local) date, counted in days since 1970-01-01. Defaults to today.
+    """
+    if date is None:
+        date = datetime.date.today()
+    return (date - datetime.date(1970, 1, 1)).days
+
+
+def _user_state(row):
+    """
+    Turn a row of USER_STATE_COLUMNS into a user cache entry.
+    """
+    return {
+        "currency": row[0],
+        "upgrades": row[1],
+        "last_daily_day": row[2]
+    }
+
+
+def get_user_state(user_id):
+    """
+    Get the committed currency, upgrades and last daily claim day of a user, from the cache if possible.
+    Pending drop rewards are not included. The returned dict must not be modified.
+    """
+    user_cache = _database().user_cache
+    state = user_cache.get(user_id)
+    if state is not None:
+        return state
+
+    ensure_user_exists(user_id)
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute(f"""SELECT {USER_STATE_COLUMNS} FROM user WHERE id = ?;""", (user_id,))
+        row = cursor.fetchone()
+
+    # Don't overwrite a newer state that a write stored in the meantime.
+    return user_cache.setdefault(user_id, _user_state(row))
 
 
 def add_waifu(user_id, image_id, rarity, connection=None):
+    """
+    Give a user a waifu. Returns its waifus id and its inventory number, as {"waifus_id": ..., "slot": ...}.
+    The slot is None when the write is part of the caller's transaction.
+    """
     ensure_user_exists(user_id)
     if not connection:
         conn, cursor = get_connection()
     else:
         conn, cursor = connection
-    cursor.execute("""INSERT INTO waifus (user_id, images_id, rarity) VALUES (?,?,?);""", (user_id, image_id, rarity))
+    slot = None
+
+    try:
+        cursor.execute("""INSERT INTO waifus (user_id, images_id, rarity) VALUES (?,?,?) RETURNING id;""", (user_id, image_id, rarity))
+        waifus_id = cursor.fetchall()[0][0]
+
+        if not connection:
+            conn.commit()
+            _inventory_changed(user_id, added=(waifus_id,))
+            # Still holding the writer connection, so the new waifu is the last one.
+            slot = len(get_inventory_ids(user_id))
+        else:
+            # The caller's transaction may still roll back.
+            _database().inventory_cache.pop(user_id)
+
+    finally:
+        if not connection:
+            conn.close()
+
+    return {"waifus_id": waifus_id, "slot": slot}
+
+
+def get_inventory_ids(user_id):
+    """
+    Get the waifus ids of a user in inventory order, from the cache if possible. Pending drop rewards are not included.
+    The returned array must not be modified.
+    """
+    inventory_cache = _database().inventory_cache
+    ids = inventory_cache.get(user_id)
+    if ids is not None:
+        return ids
+
+    conn, cursor = get_connection()
+    try:
+        ids = inventory_cache.get(user_id)
+        if ids is None:
+            cursor.execute("""SELECT id FROM waifus WHERE user_id = ? ORDER BY id;""", (user_id,))
+            ids = array.array('q', (row[0] for row in cursor.fetchall()))
+            inventory_cache.put(user_id, ids)
+    finally:
+        conn.close()
+
+    return ids
+
+
+def _inventory_changed(user_id, added=(), removed=()):
+    """
+    Update the cached inventory of a user after a write committed. Call it before closing the writer connection.
+    """
+    inventory_cache = _database().inventory_cache
+    ids = inventory_cache.get(user_id)
+    if ids is None:
+        return
+
+    if removed:
+        removed = set(removed)
+        ids = array.array('q', (waifus_id for waifus_id in ids if waifus_id not in removed))
+    else:
+        ids = array.array('q', ids)
+
+    # New ids are always the highest, so they go at the end.
+    ids.extend(sorted(added))
+    inventory_cache.put(user_id, ids)
+
+
+def roll_waifus(user_id, price, count=1):
+    """
+    Roll several waifus at once: one payment of count * price, then every card is added in the same transaction.
+    Returns the new balance and the data of the rolled waifus, with their waifus ids and inventory numbers ("slot"),
+    or None if the user can't pay.
+    """
+    # Pick everything up front, without repeating a character within one roll.
+    sampler = get_drop_sampler()
+    picked = set()
+    image_ids = []
+    rarities = []
+    for _ in range(count):
+        char_id, image_id = sampler.sample(picked)
+        picked.add(char_id)
+        image_ids.append(image_id)
+        rarities.append(generate_rarity(price)[0])
+
+    total = price * count
+    ensure_user_exists(user_id)
+    flush_pending_rewards(user_id)
+    conn, cursor = get_connection()
+
+    try:
+        cursor.execute("""BEGIN IMMEDIATE;""")
+        cursor.execute(f"""UPDATE user SET currency = currency - ? WHERE id = ? AND currency >= ? RETURNING {USER_STATE_COLUMNS};""",
+                       (total, user_id, total))
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+        state = rows[0]
+
+        cursor.execute("""SELECT COALESCE(MAX(id), 0) FROM waifus;""")
+        last_id = cursor.fetchone()[0]
+        cursor.executemany("""INSERT INTO waifus (user_id, images_id, rarity) VALUES (?,?,?);""",
+                           [(user_id, image_id, rarity) for image_id, rarity in zip(image_ids, rarities)])
+        # The writer connection is ours, so the newer ids are the rolled cards, in insertion order.
+        cursor.execute("""SELECT id FROM waifus WHERE id > ? ORDER BY id;""", (last_id,))
+        waifus_ids = [row[0] for row in cursor.fetchall()]
+
+        distinct_image_ids = list(dict.fromkeys(image_ids))
+        placeholders = ",".join("?" * len(distinct_image_ids))
+        cursor.execute(f"""SELECT {DROP_COLUMNS} FROM images
+JOIN character ON character.id = images.character_id
+WHERE images.id IN ({placeholders});""", distinct_image_ids)
+        image_rows = {row[1]: row for row in cursor.fetchall()}
 
-    if not connection:
         conn.commit()
+        _database().user_cache.put(user_id, _user_state(state))
+        _inventory_changed(user_id, added=waifus_ids)
+        first_slot = len(get_inventory_ids(user_id)) - count + 1
+
+    finally:
+        # Rolls back if the user couldn't pay.
         conn.close()
 
+    rolled = []
+    for i, (image_id, rarity, waifus_id) in enumerate(zip(image_ids, rarities, waifus_ids)):
+        waifu_data = _drop_data(image_rows[image_id], rarity)
+        waifu_data["waifus_id"] = waifus_id
+        waifu_data["slot"] = first_slot + i
+        rolled.append(waifu_data)
+
+    logger.info(f"{user_id} rolled {count} waifus for {total} currency")
+    return state[0], rolled
+
 
 def divide_waifus(waifus_list, chunk_size):
     # looping till length l
@@ -364,20 +827,68 @@ def divide_waifus(waifus_list, chunk_size):
 
 def get_all_waifu_data_for_user(user_id):
     ensure_user_exists(user_id)
-    conn, cursor = get_connection()
-
-    cursor.execute("""SELECT en_name, jp_name, s.image_index, rarity, s.char_id, images_id, waifus.id, s.url, waifus.favorite
+    flush_pending_rewards(user_id)
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT en_name, jp_name, i.image_index, rarity, i.character_id, images_id, waifus.id, i.normal_url, waifus.favorite
 FROM waifus
-LEFT JOIN (SELECT w.id as id, w.character_id as char_id, c.en_name as en_name, c.jp_name as jp_name, w.row_num as image_index, w.normal_url as url
-FROM character c
-LEFT JOIN (SELECT id, character_id, normal_url, ROW_NUMBER() OVER (PARTITION BY character_id ORDER BY id) AS row_num FROM images) w
-ON w.character_id = c.id) s
-ON waifus.images_id = s.id
+LEFT JOIN images i ON waifus.images_id = i.id
+LEFT JOIN character c ON i.character_id = c.id
 WHERE waifus.user_id = ?
 ORDER BY waifus.id;""", (user_id,))
-    rows = cursor.fetchall()
+        rows = cursor.fetchall()
     
-    waifus = [
+        waifus = [
+            {
+                "en_name": row[0],
+                "jp_name": row[1],
+                "image_index": row[2],
+                "rarity": row[3],
+                "id": row[4],
+                "image_id": row[5],
+                "waifus_id": row[6],
+                "card_index": index,
+                "image_url": row[7],
+                "favorite": row[8]
+            }
+            for index, row in enumerate(rows)
+        ]
+
+    return waifus
+
+def get_waifu_page(user_id, after_id=None, before_id=None, limit=constants.PROFILE_PAGE_SIZE, start_index=0):
+    """
+    Get one page of a user's waifus, in inventory order, without reading the rest of the inventory.
+    Pass the last waifus id of a page as after_id for the page after it, or the first waifus id as before_id for the
+    page before it. start_index is the inventory index of the first waifu on the page, and is used for card_index.
+    """
+    ensure_user_exists(user_id)
+    flush_pending_rewards(user_id)
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        query = """SELECT en_name, jp_name, i.image_index, rarity, i.character_id, images_id, waifus.id, i.normal_url, waifus.favorite
+FROM waifus
+LEFT JOIN images i ON waifus.images_id = i.id
+LEFT JOIN character c ON i.character_id = c.id
+WHERE waifus.user_id = ?"""
+
+        if before_id is not None:
+            cursor.execute(query + """ AND waifus.id < ?
+ORDER BY waifus.id DESC
+LIMIT ?;""", (user_id, before_id, limit))
+            rows = cursor.fetchall()[::-1]
+        elif after_id is not None:
+            cursor.execute(query + """ AND waifus.id > ?
+ORDER BY waifus.id
+LIMIT ?;""", (user_id, after_id, limit))
+            rows = cursor.fetchall()
+        else:
+            cursor.execute(query + """
+ORDER BY waifus.id
+LIMIT ?;""", (user_id, limit))
+            rows = cursor.fetchall()
+
+    return [
         {
             "en_name": row[0],
             "jp_name": row[1],
@@ -386,48 +897,48 @@ ORDER BY waifus.id;""", (user_id,))
             "id": row[4],
             "image_id": row[5],
             "waifus_id": row[6],
-            "card_index": index,
+            "card_index": start_index + index,
             "image_url": row[7],
             "favorite": row[8]
         }
         for index, row in enumerate(rows)
     ]
 
-    conn.close()
 
-    return waifus
+def get_waifu_id_at(user_id, index):
+    """
+    Get the waifus id at an inventory index, to start a page from when jumping to it.
+    """
+    flush_pending_rewards(user_id)
+    ids = get_inventory_ids(user_id)
+    return ids[index] if 0 <= index < len(ids) else None
 
 def get_waifus(user_id, rarity=None, name_query=None, show_id=None, page_size=25, unpaginated=False, inventory_index=None):
     ensure_user_exists(user_id)
-    conn, cursor = get_connection()
-
-    if show_id:
-        cursor.execute("""SELECT en_name, s.image_index, rarity, s.char_id, images_id, waifus.id, s.url, waifus.favorite, sc.show_id
+    flush_pending_rewards(user_id)
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        if show_id:
+            cursor.execute("""SELECT en_name, i.image_index, rarity, i.character_id, images_id, waifus.id, i.mal_url, waifus.favorite, sc.show_id
 FROM waifus
-LEFT JOIN (SELECT w.id as id, w.character_id as char_id, c.en_name as en_name, w.row_num as image_index, w.mal_url as url
-FROM character c
-LEFT JOIN (SELECT id, character_id, mal_url, ROW_NUMBER() OVER (PARTITION BY character_id ORDER BY id) AS row_num FROM images) w
-ON w.character_id = c.id) s
-ON waifus.images_id = s.id
+LEFT JOIN images i ON waifus.images_id = i.id
+LEFT JOIN character c ON i.character_id = c.id
 LEFT JOIN (
     SELECT char_id, show_id
     FROM show_character
     WHERE show_id = ?
     ) sc
-ON sc.char_id = s.char_id
+ON sc.char_id = i.character_id
 WHERE waifus.user_id = ?
 ORDER BY waifus.id;""", (show_id, user_id))
-    else:
-        cursor.execute("""SELECT en_name, s.image_index, rarity, s.char_id, images_id, waifus.id, s.url, waifus.favorite
+        else:
+            cursor.execute("""SELECT en_name, i.image_index, rarity, i.character_id, images_id, waifus.id, i.normal_url, waifus.favorite
 FROM waifus
-LEFT JOIN (SELECT w.id as id, w.character_id as char_id, c.en_name as en_name, w.row_num as image_index, w.normal_url as url
-FROM character c
-LEFT JOIN (SELECT id, character_id, normal_url, ROW_NUMBER() OVER (PARTITION BY character_id ORDER BY id) AS row_num FROM images) w
-ON w.character_id = c.id) s
-ON waifus.images_id = s.id
+LEFT JOIN images i ON waifus.images_id = i.id
+LEFT JOIN character c ON i.character_id = c.id
 WHERE waifus.user_id = ?
 ORDER BY waifus.id;""", (user_id,))
-    rows = cursor.fetchall()
+        rows = cursor.fetchall()
     waifus = []
     final_pages = []
     index = 0
@@ -457,14 +968,11 @@ ORDER BY waifus.id;""", (user_id,))
                 continue
 
         if inventory_index and index == inventory_index:
-            conn.close()
             return [cur_waifu]
 
         if not inventory_index:
             waifus.append(cur_waifu)
 
-    conn.close()
-
     if waifus:
         if unpaginated:
             final_pages = waifus
@@ -476,99 +984,108 @@ ORDER BY waifus.id;""", (user_id,))
 
 def remove_guild(guild_id):
     conn, cursor = get_connection()
-    cursor.execute("""DELETE FROM guild WHERE id = ?;""", (guild_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor.execute("""DELETE FROM guild WHERE id = ?;""", (guild_id,))
+        cursor.execute("""DELETE FROM guild_history WHERE guild_id = ?;""", (guild_id,))
+        conn.commit()
+        _database().guild_cache.put(guild_id, _guild_config(None))
+    _database().guild_histories.pop(guild_id, None)
 
 
 def get_waifu_count(user_id):
     ensure_user_exists(user_id)
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT COUNT() FROM waifus WHERE user_id = ? ORDER BY id;""", (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    if not rows:
-        return 0
-    else:
-        return rows[0][0]
+    flush_pending_rewards(user_id)
+    return len(get_inventory_ids(user_id))
 
 
 def get_waifu_image_index(waifu_id):
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT s.image_index
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT i.image_index
 FROM waifus
-LEFT JOIN (SELECT w.id as id, c.en_name as en_name, w.row_num as image_index
-FROM character c
-LEFT JOIN (SELECT id, character_id, ROW_NUMBER() OVER (PARTITION BY character_id ORDER BY id) AS row_num FROM images) w
-ON w.character_id = c.id) s
-ON waifus.images_id = s.id
+LEFT JOIN images i ON waifus.images_id = i.id
 WHERE waifus.id = ?;""", (waifu_id,))
-    rows = cursor.fetchall()
-    conn.close()
+        rows = cursor.fetchall()
     if not rows:
         return -1
     return rows[0][0]
 
 
 def get_waifu_data_of_user(user_id, waifu_index):
-    ensure_user_exists(user_id)
-
-    if waifu_index < 1:
-        # Negative numbers are taken from the end.
-        count = get_waifu_count(user_id)
-
-        if count == 0:
-            return None
-
-        waifu_index %= count
-
-    else:
-        # Waifus are 1-indexed.
-        waifu_index -= 1
+    return get_waifus_by_indices(user_id, [waifu_index])[0]
 
-    conn, cursor = get_connection()
 
-    cursor.execute("""SELECT en_name, jp_name, character_id, normal_url, waifus.id, rarity, waifus.images_id, waifus.favorite
+def get_waifus_by_indices(user_id, indices):
+    """
+    Get the waifus at several inventory numbers of a user with one query, in the order the numbers were given.
+    Numbers are 1-indexed and negative numbers count from the end. A number past the end gives None.
+    """
+    ensure_user_exists(user_id)
+    flush_pending_rewards(user_id)
+    ids = get_inventory_ids(user_id)
+
+    positions = []
+    for waifu_index in indices:
+        if waifu_index < 1:
+            # Negative numbers are taken from the end.
+            positions.append(waifu_index % len(ids) if ids else None)
+        else:
+            # Waifus are 1-indexed.
+            positions.append(waifu_index - 1 if waifu_index <= len(ids) else None)
+
+    wanted = list(dict.fromkeys(ids[position] for position in positions if position is not None))
+    rows = {}
+
+    if wanted:
+        conn, cursor = get_connection(readonly=True)
+        with conn:
+            for chunk in divide_waifus(wanted, IN_LIST_SIZE):
+                placeholders = ",".join("?" * len(chunk))
+                cursor.execute(f"""SELECT en_name, jp_name, character_id, normal_url, waifus.id, rarity, waifus.images_id, waifus.favorite, i.image_index
 FROM waifus
 LEFT JOIN images i ON waifus.images_id = i.id
 LEFT JOIN character c ON i.character_id = c.id
-WHERE user_id = ?
-LIMIT ?, 1;""", (user_id, waifu_index))
+WHERE waifus.id IN ({placeholders}) AND user_id = ?;""", (*chunk, user_id))
+                for row in cursor.fetchall():
+                    rows[row[4]] = row
 
-    row = cursor.fetchone()
+    waifus = []
+    for position in positions:
+        row = rows.get(ids[position]) if position is not None else None
+        if row is None:
+            waifus.append(None)
+            continue
 
-    conn.close()
+        waifus.append({"en_name": row[0],
+                       "jp_name": row[1],
+                       "id": row[2],
+                       "image_url": row[3],
+                       "image_index": row[8],
+                       "rarity": row[5],
+                       "waifus_id": row[4],
+                       "image_id": row[6],
+                       "favorite": row[7],
+                       "card_index": position})
 
-    if not row:
-        return None
-    return {"en_name": row[0],
-            "jp_name": row[1],
-            "id": row[2],
-            "image_url": row[3],
-            "image_index": get_waifu_image_index(row[4]),
-            "rarity": row[5],
-            "waifus_id": row[4],
-            "image_id": row[6],
-            "favorite": row[7],
-            "card_index": waifu_index}
+    return waifus
 
 
 def insert_show(mal_id, jp_title, en_title, is_manga):
     conn, cursor = get_connection()
-    logger.info(f"Inserting show {mal_id} {en_title}, is_manga: {is_manga}")
+    with conn:
+        logger.info(f"Inserting show {mal_id} {en_title}, is_manga: {is_manga}")
 
-    cursor.execute("""INSERT INTO show (mal_id, jp_title, en_title, is_manga) VALUES (?,?,?,?)""",
-                   (mal_id, jp_title, en_title, is_manga))
+        cursor.execute("""INSERT INTO show (mal_id, jp_title, en_title, is_manga) VALUES (?,?,?,?)""",
+                       (mal_id, jp_title, en_title, is_manga))
 
-    conn.commit()
-    conn.close()
+        conn.commit()
 
 
 def get_show_id_by_mal(mal_id, is_manga):
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT id FROM show WHERE mal_id = ? AND is_manga = ?;""", (mal_id, is_manga))
-    rows = cursor.fetchall()
-    conn.close()
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT id FROM show WHERE mal_id = ? AND is_manga = ?;""", (mal_id, is_manga))
+        rows = cursor.fetchall()
     if not rows:
         return None
     else:
@@ -576,10 +1093,10 @@ def get_show_id_by_mal(mal_id, is_manga):
 
 
 def character_has_show(char_id, show_id):
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT id FROM show_character WHERE char_id = ? AND show_id = ?;""", (char_id, show_id))
-    rows = cursor.fetchall()
-    conn.close()
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT id FROM show_character WHERE char_id = ? AND show_id = ?;""", (char_id, show_id))
+        rows = cursor.fetchall()
     if not rows:
         return False
     else:
@@ -596,30 +1113,47 @@ def character_has_image(cursor, char_id, mal_url):
 
 def add_show_to_character(char_id, show_id):
     conn, cursor = get_connection()
-    logger.info(f"Adding show {show_id} to character {char_id}")
-    cursor.execute("""INSERT INTO show_character (char_id, show_id) VALUES (?,?);""", (char_id, show_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        logger.info(f"Adding show {show_id} to character {char_id}")
+        cursor.execute("""INSERT INTO show_character (char_id, show_id) VALUES (?,?);""", (char_id, show_id))
+        conn.commit()
 
 
 def get_characters_without_shows():
-    conn, cursor = get_connection()
-    cursor.execute("""select * from character
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""select * from character
 left join show_character sc on character.id = sc.char_id
 where sc.id is null;""")
-    rows = cursor.fetchall()
-    conn.close()
+        rows = cursor.fetchall()
     return rows
 
 
+def _search_phrase(search_query):
+    """
+    Quote a search query as one FTS5 phrase, so quotes and operators in it are matched literally.
+    """
+    return '"' + search_query.replace('"', '""') + '"'
+
+
 def get_character_data_like(search_query):
-    conn, cursor = get_connection()
-    wildcard_query = f"%{search_query}%"
-    cursor.execute('SELECT id, en_name FROM character WHERE en_name LIKE ? or jp_name LIKE ? or alt_name LIKE ? LIMIT 25',
-                    (wildcard_query, wildcard_query, wildcard_query))
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        if len(search_query) >= SEARCH_MIN_LENGTH:
+            # Ranked substring match through the trigram index.
+            cursor.execute("""SELECT c.id, c.en_name
+FROM character_search s
+INNER JOIN character c ON c.id = s.rowid
+WHERE s.character_search MATCH ?
+ORDER BY s.rank
+LIMIT 25;""", (_search_phrase(search_query),))
+        else:
+            # Too short to have any trigrams.
+            wildcard_query = f"%{search_query}%"
+            cursor.execute('SELECT id, en_name FROM character WHERE en_name LIKE ? or jp_name LIKE ? or alt_name LIKE ? LIMIT 25',
+                            (wildcard_query, wildcard_query, wildcard_query))
     
-    rows = cursor.fetchall()
-    conn.close()
+        rows = cursor.fetchall()
 
     chara_list = []
 
@@ -632,13 +1166,109 @@ def get_character_data_like(search_query):
     return chara_list
 
 
+def get_character_data_by_name(name):
+    """
+    Find characters by name, ignoring romanization differences and the order of the name parts.
+    A character whose English name is the name wins. Otherwise every part of the name has to be a different part of
+    the character's English name, or of its alternative name. Only if no character has all the parts, they are
+    matched as the start of name parts instead.
+    """
+    tokens = sorted(nt.name_tokens(name), key=len, reverse=True)
+    if not tokens:
+        return []
+
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT id, en_name FROM character WHERE normalized_name = ? ORDER BY id LIMIT ?;""",
+                       (nt.normalize_romanization(" ".join(name.split())), NAME_MATCH_LIMIT))
+        rows = cursor.fetchall()
+        if rows:
+            return [{'id': chara_id, 'en_name': en_name} for chara_id, en_name in rows]
+
+        for exact in (True, False):
+            # Longest tokens first, as they are the most selective.
+            if exact:
+                matches = " INTERSECT ".join(["""SELECT char_id FROM character_name_token WHERE token = ?"""] * len(tokens))
+                params = list(tokens)
+            else:
+                # Each token is a prefix range on the token index.
+                matches = " INTERSECT ".join(["""SELECT char_id FROM character_name_token WHERE token >= ? AND token < ?"""] * len(tokens))
+                params = [bound for token in tokens for bound in (token, token + "\uffff")]
+
+            cursor.execute(f"""SELECT c.id, c.en_name, c.alt_name FROM character c WHERE c.id IN ({matches}) ORDER BY c.id LIMIT ?;""",
+                           (*params, NAME_MATCH_LIMIT))
+
+            chara_list = []
+
+            for chara_id, en_name, alt_name in cursor.fetchall():
+                # The index has a row per distinct token, so check that the parts match different tokens.
+                if _tokens_match(tokens, nt.name_tokens(en_name), exact) or _tokens_match(tokens, nt.name_tokens(alt_name), exact):
+                    chara_list.append({
+                        'id': chara_id,
+                        'en_name': en_name
+                    })
+
+            if chara_list:
+                return chara_list
+
+    return []
+
+
+def _tokens_match(prefixes, tokens, exact=False):
+    # Longest prefixes first, so a short prefix doesn't take a token a longer one needs.
+    tokens = list(tokens)
+    for prefix in prefixes:
+        for i, token in enumerate(tokens):
+            if token == prefix if exact else token.startswith(prefix):
+                del tokens[i]
+                break
+        else:
+            return False
+    return True
+
+
+def get_character_ids_with_name_part(name_part):
+    """
+    Get the ids of the characters whose English name contains a name part, ignoring romanization differences,
+    or whose Japanese name contains it.
+    """
+    normalized_part = nt.normalize_romanization(name_part)
+
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        if len(normalized_part) >= SEARCH_MIN_LENGTH and len(name_part) >= SEARCH_MIN_LENGTH:
+            # Substring match through the trigram indexes. They ignore case, which is right for the normalized names
+            # but not for the Japanese names, so those are checked again.
+            cursor.execute("""SELECT rowid FROM character_name_search WHERE character_name_search MATCH ?
+UNION
+SELECT c.id FROM character_search s INNER JOIN character c ON c.id = s.rowid
+WHERE s.character_search MATCH ? AND instr(c.jp_name, ?) > 0;""",
+                           (_search_phrase(normalized_part), "jp_name : " + _search_phrase(name_part), name_part))
+        else:
+            # Too short to have any trigrams.
+            cursor.execute("""SELECT id FROM character WHERE instr(normalized_name, ?) > 0 OR instr(jp_name, ?) > 0;""",
+                           (normalized_part, name_part))
+        rows = cursor.fetchall()
+    return {row[0] for row in rows}
+
+
 def get_shows_like(search_query):
-    conn, cursor = get_connection()
-    wildcard_query = f"%{search_query}%"
-    cursor.execute("""SELECT id, jp_title, is_manga FROM show WHERE jp_title LIKE ? or en_title LIKE ? LIMIT 25""",
-                   (wildcard_query, wildcard_query))
-    rows = cursor.fetchall()
-    conn.close()
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        if len(search_query) >= SEARCH_MIN_LENGTH:
+            # Ranked substring match through the trigram index.
+            cursor.execute("""SELECT sh.id, sh.jp_title, sh.is_manga
+FROM show_search s
+INNER JOIN show sh ON sh.id = s.rowid
+WHERE s.show_search MATCH ?
+ORDER BY s.rank
+LIMIT 25;""", (_search_phrase(search_query),))
+        else:
+            # Too short to have any trigrams.
+            wildcard_query = f"%{search_query}%"
+            cursor.execute("""SELECT id, jp_title, is_manga FROM show WHERE jp_title LIKE ? or en_title LIKE ? LIMIT 25""",
+                           (wildcard_query, wildcard_query))
+        rows = cursor.fetchall()
     shows_list = []
     for row in rows:
         shows_list.append({
@@ -650,10 +1280,10 @@ def get_shows_like(search_query):
 
 
 def get_show_title_jp(show_id):
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT jp_title FROM show WHERE id = ?""", (show_id,))
-    rows = cursor.fetchall()
-    conn.close()
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT jp_title FROM show WHERE id = ?""", (show_id,))
+        rows = cursor.fetchall()
     if not rows:
         return None
     if rows:
@@ -661,8 +1291,9 @@ def get_show_title_jp(show_id):
 
 
 def get_characters_from_show(show_id):
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT s.char_id, s.en_name, COUNT(s.char_id) FROM images i
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT s.char_id, s.en_name, COUNT(s.char_id) FROM images i
 INNER JOIN (
     SELECT sc.char_id, c.en_name FROM show_character sc
     LEFT JOIN character c ON sc.char_id = c.id
@@ -670,8 +1301,7 @@ INNER JOIN (
     ) s ON s.char_id = i.character_id
 GROUP BY s.char_id
 ORDER BY s.en_name;""", (show_id,))
-    rows = cursor.fetchall()
-    conn.close()
+        rows = cursor.fetchall()
     if not rows:
         return None
     else:
@@ -686,33 +1316,43 @@ ORDER BY s.en_name;""", (show_id,))
 
 
 def get_history(guild_id):
-    conn, cursor = get_connection()
-
-    cursor.execute("""SELECT history FROM guild WHERE id = ?""", (guild_id,))
-    rows = cursor.fetchall()
-
-    conn.close()
+    """
+    Get the recent drops of a guild. The history is loaded once and then kept in memory.
+    """
+    guild_histories = _database().guild_histories
+    history = guild_histories.get(guild_id)
+    if history is not None:
+        return history
+
+    head = get_guild_config(guild_id)["history_head"]
+
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT slot, char_id FROM guild_history WHERE guild_id = ? AND slot < ?;""", (guild_id, constants.HISTORY_SIZE))
+        rows = cursor.fetchall()
 
-    if not rows or not rows[0][0]:
-        return None
-    else:
-        return [int(hist_element) for hist_element in rows[0][0].split(";")]
+    # Oldest first: the slot after the most recent one is the oldest.
+    rows.sort(key=lambda row: (row[0] - head) % constants.HISTORY_SIZE)
+    history = drop_sampler.GuildHistory(constants.HISTORY_SIZE, (row[1] for row in rows), head)
+    guild_histories[guild_id] = history
+    return history
 
 
 def update_history(guild_id, history, waifu_data):
-    if not history:
-        history = list()
-    else:
-        if len(history) > constants.HISTORY_SIZE:
-            history = history[-constants.HISTORY_SIZE:]
-        history.pop(0)
-    history.append(waifu_data["id"])
-    history_joined = ";".join([str(hist_element) for hist_element in history])
+    if history is None:
+        history = get_history(guild_id)
+
     conn, cursor = get_connection()
-    cursor.execute("""UPDATE guild SET history = ? WHERE id = ?""", (history_joined, guild_id))
+    with conn:
+        cursor.execute("""INSERT OR REPLACE INTO guild_history (guild_id, slot, char_id) VALUES (?,?,?);""",
+                       (guild_id, history.next_slot(), waifu_data["id"]))
+        cursor.execute(f"""UPDATE guild SET history_head = ? WHERE id = ? RETURNING {GUILD_CONFIG_COLUMNS};""", (history.head + 1, guild_id))
+        rows = cursor.fetchall()
 
-    conn.commit()
-    conn.close()
+        conn.commit()
+        _database().guild_cache.put(guild_id, _guild_config(rows[0] if rows else None))
+
+    history.append(waifu_data["id"])
 
 
 def generate_rarity(price=None):
@@ -754,82 +1394,95 @@ def generate_rarity(price=None):
 
 
 def generate_rarities_for_unset_waifus():
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT id FROM waifus WHERE rarity = -1""")
-    rows = cursor.fetchall()
-    conn.close()
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT id FROM waifus WHERE rarity = -1""")
+        rows = cursor.fetchall()
     if not rows:
         return
     conn, cursor = get_connection()
-    for row in rows:
-        waifu_id = row[0]
-        rarity, price = generate_rarity()
-        cursor.execute("""UPDATE waifus SET rarity = ? WHERE id = ?""", (rarity, waifu_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        for row in rows:
+            waifu_id = row[0]
+            rarity, price = generate_rarity()
+            cursor.execute("""UPDATE waifus SET rarity = ? WHERE id = ?""", (rarity, waifu_id))
+        conn.commit()
     return
 
 
 def trade(user1_id, user2_id, user1_offer, user2_offer):
+    """
+    Settle a trade in one transaction. If either user no longer has what they offered, nothing changes and this
+    returns False.
+    """
+    flush_pending_rewards(user1_id)
+    flush_pending_rewards(user2_id)
+    ensure_user_exists(user1_id)
+    ensure_user_exists(user2_id)
     conn, cursor = get_connection()
 
-    # First, check if users have enough currency.
-    # Then, remove/add currency
-    if user1_offer.money > 0:
-        cursor.execute("""SELECT currency FROM user WHERE id = ?;""", (user1_id,))
-        row = cursor.fetchone()
-        if row[0] < user1_offer.money or not subtract_user_currency(user1_id, user1_offer.money, (conn, cursor)):
-            conn.close()
-            return False
-        add_user_currency(user2_id, user1_offer.money, (conn, cursor))
+    states = {}
 
-    if user2_offer.money > 0:
-        cursor.execute("""SELECT currency FROM user WHERE id = ?;""", (user2_id,))
-        row = cursor.fetchone()
-        if row[0] < user2_offer.money or not subtract_user_currency(user2_id, user2_offer.money, (conn, cursor)):
-            conn.close()
-            return False
-        add_user_currency(user1_id, user2_offer.money, (conn, cursor))
+    try:
+        cursor.execute("""BEGIN IMMEDIATE;""")
 
-    # Start by deleting existing waifus, ensuring they exist. Then insert waifu for other user.
-    for waifu in user1_offer.waifus:
-        cursor.execute("""SELECT id FROM waifus WHERE id = ? AND user_id = ?""", (waifu.waifu_id, user1_id))
-        rows = cursor.fetchall()
-        if not rows:
-            conn.close()
-            return False
-        else:
-            cursor.execute("""DELETE FROM waifus WHERE id = ?""", (waifu.waifu_id,))
-            add_waifu(user2_id, waifu.image_id, waifu.rarity, connection=(conn, cursor))
+        for giver_id, receiver_id, offer in ((user1_id, user2_id, user1_offer), (user2_id, user1_id, user2_offer)):
+            if offer.money > 0:
+                # Only take the currency if the user still has enough.
+                cursor.execute(f"""UPDATE user SET currency = currency - ? WHERE id = ? AND currency >= ? RETURNING {USER_STATE_COLUMNS};""",
+                               (offer.money, giver_id, offer.money))
+                rows = cursor.fetchall()
+                if not rows:
+                    return False
+                states[giver_id] = rows[0]
 
-    for waifu in user2_offer.waifus:
-        cursor.execute("""SELECT id FROM waifus WHERE id = ? AND user_id = ?""", (waifu.waifu_id, user2_id))
-        rows = cursor.fetchall()
-        if not rows:
-            conn.close()
-            return False
-        else:
-            cursor.execute("""DELETE FROM waifus WHERE id = ?""", (waifu.waifu_id,))
-            add_waifu(user1_id, waifu.image_id, waifu.rarity, connection=(conn, cursor))
+                cursor.execute(f"""UPDATE user SET currency = currency + ? WHERE id = ? RETURNING {USER_STATE_COLUMNS};""",
+                               (offer.money, receiver_id))
+                states[receiver_id] = cursor.fetchall()[0]
+
+            waifu_ids = list(dict.fromkeys(waifu.waifu_id for waifu in offer.waifus))
+            if not waifu_ids:
+                continue
+
+            placeholders = ",".join("?" * len(waifu_ids))
+            cursor.execute(f"""SELECT COUNT(*) FROM waifus WHERE user_id = ? AND id IN ({placeholders});""",
+                           (giver_id, *waifu_ids))
+            if cursor.fetchone()[0] != len(waifu_ids):
+                return False
+
+            # Copy the cards to the end of the receiver's inventory, in the order they were offered, then remove the originals.
+            cursor.executemany("""INSERT INTO waifus (user_id, images_id, rarity) SELECT ?, images_id, rarity FROM waifus WHERE id = ?;""",
+                               [(receiver_id, waifu_id) for waifu_id in waifu_ids])
+            cursor.execute(f"""DELETE FROM waifus WHERE id IN ({placeholders});""", waifu_ids)
+
+        conn.commit()
+
+        database = _database()
+        for user_id, row in states.items():
+            database.user_cache.put(user_id, _user_state(row))
+        database.inventory_cache.pop(user1_id)
+        database.inventory_cache.pop(user2_id)
+
+    finally:
+        # Rolls back if the trade failed.
+        conn.close()
 
-    conn.commit()
-    conn.close()
     return True
 
 
 def remove_useless_waifus():
     conn, cursor = get_connection()
+    with conn:
+        cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%father%'""")
+        cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%grandfather%'""")
+        cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%grandpa%'""")
+        cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%mother%'""")
+        cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%grandmother%'""")
+        cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%grandma%'""")
+        cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%teacher%'""")
 
-    cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%father%'""")
-    cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%grandfather%'""")
-    cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%grandpa%'""")
-    cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%mother%'""")
-    cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%grandmother%'""")
-    cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%grandma%'""")
-    cursor.execute("""UPDATE character SET droppable = 0 WHERE en_name LIKE '%teacher%'""")
-
-    conn.commit()
-    conn.close()
+        conn.commit()
+    catalog_changed()
 
 
 def remove_waifu(waifus_id):
@@ -837,26 +1490,21 @@ def remove_waifu(waifus_id):
         return False
 
     conn, cursor = get_connection()
+    with conn:
+        cursor.execute("""DELETE FROM waifus WHERE id = ? RETURNING user_id;""", (waifus_id,))
+        rows = cursor.fetchall()
 
-    cursor.execute("""DELETE FROM waifus WHERE id = ?;""", (waifus_id,))
-
-    conn.commit()
-    conn.close()
+        conn.commit()
+        for row in rows:
+            _inventory_changed(row[0], removed=(waifus_id,))
 
     return True
 
 
 def get_user_currency(user_id):
-    ensure_user_exists(user_id)
-    conn, cursor = get_connection()
-
-    cursor.execute("""SELECT currency FROM user WHERE id = ?;""", (user_id,))
-    row = cursor.fetchone()
-
-    conn.commit()
-    conn.close()
-
-    return row[0]
+    pending_rewards = _database().pending_rewards
+    with pending_rewards.lock:
+        return get_user_state(user_id)["currency"] + pending_rewards.pending_for(user_id, "currency")
 
 
 def add_user_currency(user_id, amount, connection=None):
@@ -865,12 +1513,16 @@ def add_user_currency(user_id, amount, connection=None):
         conn, cursor = connection
     else:
         conn, cursor = get_connection()
-    cursor.execute("""UPDATE user SET currency = currency + ? WHERE id = ?;""", (amount, user_id))
-    conn.commit()
-    if not connection:
-        conn.close()
+    try:
+        cursor.execute(f"""UPDATE user SET currency = currency + ? WHERE id = ? RETURNING {USER_STATE_COLUMNS};""", (amount, user_id))
+        rows = cursor.fetchall()
+        conn.commit()
+        _database().user_cache.put(user_id, _user_state(rows[0]))
+    finally:
+        if not connection:
+            conn.close()
     logger.info(f"Added {amount} currency to {user_id}")
-    return
+    return rows[0][0]
 
 
 def subtract_user_currency(user_id, amount, connection=None):
@@ -878,21 +1530,106 @@ def subtract_user_currency(user_id, amount, connection=None):
     if connection:
         conn, cursor = connection
     else:
+        flush_pending_rewards(user_id)
         conn, cursor = get_connection()
-    cursor.execute("""SELECT currency FROM user WHERE id = ?;""", (user_id,))
-    row = cursor.fetchone()
-    if row[0] < amount:
+    try:
+        # Only subtracts if the user still has enough.
+        cursor.execute(f"""UPDATE user SET currency = currency - ? WHERE id = ? AND currency >= ? RETURNING {USER_STATE_COLUMNS};""",
+                       (amount, user_id, amount))
+        rows = cursor.fetchall()
+        if not rows:
+            return False
+        conn.commit()
+        _database().user_cache.put(user_id, _user_state(rows[0]))
+    finally:
         if not connection:
             conn.close()
-        return False
-    cursor.execute("""UPDATE user SET currency = currency - ? WHERE id = ?;""", (amount, user_id))
-    conn.commit()
-    if not connection:
-        conn.close()
     logger.info(f"Subtracted {amount} currency from {user_id}")
     return True
 
 
+def change_user_currency(user_id, amount, required=0):
+    """
+    Add an amount, which may be negative, to a user's currency if they have at least `required`.
+    The check and the change are one statement. Returns the new balance, or None if the user has too little.
+    """
+    ensure_user_exists(user_id)
+    flush_pending_rewards(user_id)
+    conn, cursor = get_connection()
+    with conn:
+        cursor.execute(f"""UPDATE user SET currency = currency + ? WHERE id = ? AND currency >= ? RETURNING {USER_STATE_COLUMNS};""",
+                       (amount, user_id, required))
+        rows = cursor.fetchall()
+        conn.commit()
+        if rows:
+            _database().user_cache.put(user_id, _user_state(rows[0]))
+
+    if not rows:
+        return None
+    logger.info(f"Changed currency of {user_id} by {amount}")
+    return rows[0][0]
+
+
+def transfer_user_currency(sender_id, recipient_id, amount):
+    """
+    Move currency from one user to another in one transaction, if the sender has enough.
+    Returns the new balances of the sender and the recipient, or None if the sender has too little.
+    """
+    ensure_user_exists(sender_id)
+    ensure_user_exists(recipient_id)
+    flush_pending_rewards(sender_id)
+    flush_pending_rewards(recipient_id)
+    conn, cursor = get_connection()
+
+    try:
+        cursor.execute("""BEGIN IMMEDIATE;""")
+        cursor.execute(f"""UPDATE user SET currency = currency - ? WHERE id = ? AND currency >= ? RETURNING {USER_STATE_COLUMNS};""",
+                       (amount, sender_id, amount))
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+        sender_row = rows[0]
+
+        cursor.execute(f"""UPDATE user SET currency = currency + ? WHERE id = ? RETURNING {USER_STATE_COLUMNS};""", (amount, recipient_id))
+        recipient_row = cursor.fetchall()[0]
+
+        conn.commit()
+        _database().user_cache.put(sender_id, _user_state(sender_row))
+        _database().user_cache.put(recipient_id, _user_state(recipient_row))
+
+    finally:
+        # Rolls back if the sender had too little.
+        conn.close()
+
+    logger.info(f"Transferred {amount} currency from {sender_id} to {recipient_id}")
+    return sender_row[0], recipient_row[0]
+
+
+def set_user_currency(user_id, amount):
+    """
+    Set a user's currency. Returns the balance before and after.
+    """
+    ensure_user_exists(user_id)
+    flush_pending_rewards(user_id)
+    conn, cursor = get_connection()
+
+    try:
+        cursor.execute("""BEGIN IMMEDIATE;""")
+        cursor.execute("""SELECT currency FROM user WHERE id = ?;""", (user_id,))
+        previous = cursor.fetchone()[0]
+        cursor.execute(f"""UPDATE user SET currency = ? WHERE id = ? RETURNING {USER_STATE_COLUMNS};""", (amount, user_id))
+        rows = cursor.fetchall()
+
+        conn.commit()
+        _database().user_cache.put(user_id, _user_state(rows[0]))
+
+    finally:
+        conn.close()
+
+    logger.info(f"Set currency of {user_id} from {previous} to {amount}")
+    return previous, rows[0][0]
+
+
 def get_rarity_currency(rarity):
     exchange_rates = {
         0: 100/4,
@@ -907,24 +1644,65 @@ def get_rarity_currency(rarity):
 
 def add_daily_currency(user_id):
     ensure_user_exists(user_id)
-    add_user_currency(user_id, DAILY_CURRENCY)
     conn, cursor = get_connection()
-    cursor.execute("""UPDATE user SET last_daily = ? WHERE id = ?;""", (datetime.datetime.now(), user_id))
-    conn.commit()
-    conn.close()
+    with conn:
+        cursor.execute(f"""UPDATE user SET currency = currency + ?, last_daily = ?, last_daily_day = ? WHERE id = ? RETURNING {USER_STATE_COLUMNS};""",
+                       (DAILY_CURRENCY, datetime.datetime.now(), epoch_day(), user_id))
+        rows = cursor.fetchall()
+        conn.commit()
+        _database().user_cache.put(user_id, _user_state(rows[0]))
+    logger.info(f"Added {DAILY_CURRENCY} daily currency to {user_id}")
 
 
-def get_user_upgrades(user_id):
+def claim_daily(user_id):
+    """
+    Give a user their daily currency, unless they already claimed it today. Returns the new balance, or None if it
+    was already claimed.
+    The check and the claim are one statement, so a double claim can't slip in between them.
+    """
     ensure_user_exists(user_id)
+    today = epoch_day()
     conn, cursor = get_connection()
+    with conn:
+        cursor.execute(f"""UPDATE user SET currency = currency + ?, last_daily = ?, last_daily_day = ?
+WHERE id = ? AND last_daily_day < ?
+RETURNING {USER_STATE_COLUMNS};""", (DAILY_CURRENCY, datetime.datetime.now(), today, user_id, today))
+        rows = cursor.fetchall()
+        conn.commit()
+        if rows:
+            _database().user_cache.put(user_id, _user_state(rows[0]))
+    if not rows:
+        return None
+    logger.info(f"{user_id} claimed {DAILY_CURRENCY} daily currency")
+    return rows[0][0] + _database().pending_rewards.pending_for(user_id, "currency")
+
+
+def grant_daily_to_all(amount=DAILY_CURRENCY):
+    """
+    Give the daily currency to every user, in one statement. The grant is separate from the users' own claim: it
+    doesn't depend on whether they claimed today, and doesn't use up their claim. Running it again on the same day
+    grants nothing. Returns the number of users it was granted to.
+    """
+    today = epoch_day()
+    user_cache = _database().user_cache
+    conn, cursor = get_connection()
+    with conn:
+        cursor.execute(f"""UPDATE user SET currency = currency + ?, last_grant_day = ? WHERE last_grant_day < ?
+RETURNING id, {USER_STATE_COLUMNS};""", (amount, today, today))
+        rows = cursor.fetchall()
+        conn.commit()
+        for row in rows:
+            # Only refresh users that are cached, rather than pushing every user through the cache.
+            if row[0] in user_cache:
+                user_cache.put(row[0], _user_state(row[1:]))
+    logger.info(f"Granted {amount} daily currency to {len(rows)} users")
+    return len(rows)
 
-    cursor.execute("""SELECT upgrades FROM user WHERE id = ?;""", (user_id,))
-    row = cursor.fetchone()
-
-    conn.commit()
-    conn.close()
 
-    return row[0]
+def get_user_upgrades(user_id):
+    pending_rewards = _database().pending_rewards
+    with pending_rewards.lock:
+        return get_user_state(user_id)["upgrades"] + pending_rewards.pending_for(user_id, "upgrades")
 
 
 def add_user_upgrades(user_id, amount, connection=None):
@@ -933,12 +1711,16 @@ def add_user_upgrades(user_id, amount, connection=None):
         conn, cursor = connection
     else:
         conn, cursor = get_connection()
-    cursor.execute("""UPDATE user SET upgrades = upgrades + ? WHERE id = ?;""", (amount, user_id))
-    conn.commit()
-    if not connection:
-        conn.close()
+    try:
+        cursor.execute(f"""UPDATE user SET upgrades = upgrades + ? WHERE id = ? RETURNING {USER_STATE_COLUMNS};""", (amount, user_id))
+        rows = cursor.fetchall()
+        conn.commit()
+        _database().user_cache.put(user_id, _user_state(rows[0]))
+    finally:
+        if not connection:
+            conn.close()
     logger.info(f"Added {amount} upgrades to {user_id}")
-    return
+    return rows[0][1]
 
 
 def subtract_user_upgrades(user_id, amount, connection=None):
@@ -947,102 +1729,246 @@ def subtract_user_upgrades(user_id, amount, connection=None):
         conn, cursor = connection
     else:
         conn, cursor = get_connection()
-    cursor.execute("""SELECT upgrades FROM user WHERE id = ?;""", (user_id,))
-    row = cursor.fetchone()
-    if row[0] < amount:
+    try:
+        # Only subtracts if the user still has enough.
+        cursor.execute(f"""UPDATE user SET upgrades = upgrades - ? WHERE id = ? AND upgrades >= ? RETURNING {USER_STATE_COLUMNS};""",
+                       (amount, user_id, amount))
+        rows = cursor.fetchall()
+        if not rows:
+            return False
+        conn.commit()
+        _database().user_cache.put(user_id, _user_state(rows[0]))
+    finally:
         if not connection:
             conn.close()
-        return False
-    cursor.execute("""UPDATE user SET upgrades = upgrades - ? WHERE id = ?;""", (amount, user_id))
-    conn.commit()
-    if not connection:
-        conn.close()
     logger.info(f"Subtracted {amount} upgrades from {user_id}")
     return True
 
 
 def set_favorite(waifus_id):
     conn, cursor = get_connection()
+    with conn:
+        cursor.execute("""UPDATE waifus SET favorite = 1 WHERE id = ?""", (waifus_id,))
 
-    cursor.execute("""UPDATE waifus SET favorite = 1 WHERE id = ?""", (waifus_id,))
-
-    conn.commit()
-    conn.close()
+        conn.commit()
 
 
 def unfavorite(waifus_id):
     conn, cursor = get_connection()
+    with conn:
+        cursor.execute("""UPDATE waifus SET favorite = 0 WHERE id = ?""", (waifus_id,))
+
+        conn.commit()
+
+
+def remove_waifus(user_id, waifus_ids):
+    """
+    Remove waifus of a user and give them the currency for the removed rarities, in one transaction.
+    Ids the user doesn't own are skipped. Returns the ids that were removed and the currency rewarded.
+    """
+    waifus_ids = list(dict.fromkeys(waifus_ids))
+    ensure_user_exists(user_id)
+    flush_pending_rewards(user_id)
+    conn, cursor = get_connection()
+
+    removed = []
+    reward = 0
+
+    try:
+        cursor.execute("""BEGIN IMMEDIATE;""")
+
+        for chunk in divide_waifus(waifus_ids, IN_LIST_SIZE):
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(f"""DELETE FROM waifus WHERE user_id = ? AND id IN ({placeholders}) RETURNING id, rarity;""",
+                           (user_id, *chunk))
+            for waifus_id, rarity in cursor.fetchall():
+                removed.append(waifus_id)
+                reward += get_rarity_currency(rarity)
+
+        rows = None
+        if reward:
+            cursor.execute(f"""UPDATE user SET currency = currency + ? WHERE id = ? RETURNING {USER_STATE_COLUMNS};""", (reward, user_id))
+            rows = cursor.fetchall()
+
+        conn.commit()
+        if rows:
+            _database().user_cache.put(user_id, _user_state(rows[0]))
+        _inventory_changed(user_id, removed=removed)
+
+    finally:
+        conn.close()
+
+    logger.info(f"Removed {len(removed)} waifus of {user_id} for {reward} currency")
+    return removed, reward
+
+
+def set_favorites(user_id, waifus_ids, favorite=True):
+    """
+    Favorite or unfavorite waifus of a user, in one transaction. Ids the user doesn't own are skipped.
+    Returns the ids that were changed.
+    """
+    waifus_ids = list(dict.fromkeys(waifus_ids))
+    flush_pending_rewards(user_id)
+    conn, cursor = get_connection()
 
-    cursor.execute("""UPDATE waifus SET favorite = 0 WHERE id = ?""", (waifus_id,))
+    changed = []
 
-    conn.commit()
-    conn.close()
+    try:
+        cursor.execute("""BEGIN IMMEDIATE;""")
+
+        for chunk in divide_waifus(waifus_ids, IN_LIST_SIZE):
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(f"""UPDATE waifus SET favorite = ? WHERE user_id = ? AND id IN ({placeholders}) RETURNING id;""",
+                           (favorite, user_id, *chunk))
+            changed.extend(row[0] for row in cursor.fetchall())
+
+        conn.commit()
+
+    finally:
+        conn.close()
+
+    return changed
 
 
 def get_shows_from_character(char_id, connection=None):
     if connection:
         conn, cursor = connection
     else:
-        conn, cursor = get_connection()
+        conn, cursor = get_connection(readonly=True)
 
     show_list = []
 
-    cursor.execute("""SELECT DISTINCT show_id FROM show_character WHERE char_id = ?""", (char_id,))
-    rows = cursor.fetchall()
+    try:
+        cursor.execute("""SELECT DISTINCT show_id FROM show_character WHERE char_id = ?""", (char_id,))
+        rows = cursor.fetchall()
+    finally:
+        if not connection:
+            conn.close()
+
     for row in rows:
         show_list.append(int(row[0]))
 
-    if not connection:
-        conn.close()
-
     return show_list
 
 
 def get_waifusAmount(user_id):
+    pending_rewards = _database().pending_rewards
+    with pending_rewards.lock:
+        conn, cursor = get_connection(readonly=True)
+        with conn:
+            cursor.execute("""SELECT COUNT(*) FROM waifus WHERE user_id = ?;""", (user_id,))
+            rows = cursor.fetchall()
+
+        return rows[0][0] + pending_rewards.pending_for(user_id, "waifus")
+
+
+def add_drop_reward(user_id, image_id, rarity, currency, upgrades=0):
+    """
+    Give a user a waifu, currency and upgrades for a drop. The reward is written by the next flush_pending_rewards(),
+    but the user's balance reads include it immediately.
+    Returns the user's balances including the reward and the inventory number of the new waifu, as
+    {"currency": ..., "upgrades": ..., "slot": ...}.
+    """
+    pending_rewards = _database().pending_rewards
+    with pending_rewards.lock:
+        pending = pending_rewards.add(user_id, image_id, rarity, currency, upgrades)
+        state = get_user_state(user_id)
+        committed_waifus = len(get_inventory_ids(user_id))
+
+    logger.info(f"Queued drop reward for {user_id}: image {image_id}, {currency} currency, {upgrades} upgrades")
+    return {"currency": state["currency"] + pending["currency"],
+            "upgrades": state["upgrades"] + pending["upgrades"],
+            "slot": committed_waifus + pending["waifus"]}
+
+
+def flush_pending_rewards(user_id=None):
+    """
+    Write all queued drop rewards in one transaction.
+    If user_id is given, only flush when that user has rewards queued. If the write fails, the rewards stay queued.
+    """
+    database = _database()
+    with database.pending_rewards.lock:
+        if not database.pending_rewards or (user_id is not None and user_id not in database.pending_rewards):
+            return
 
-    conn, cursor = get_connection()
-
-    cursor.execute("""SELECT COUNT(*) FROM waifus WHERE user_id = ?;""", (user_id,))
-    rows = cursor.fetchall()
-
-    conn.close()
-
-    return rows[0][0]
+        conn, cursor = get_connection()
+        with conn:
+            # The cached balances below are updated by adding to them, so they must not be stale.
+            drop_stale_caches((conn, cursor))
+            waifus, totals = database.pending_rewards.drain()
+            try:
+                cursor.executemany("""INSERT OR IGNORE INTO user (id, last_daily, last_daily_day) VALUES (?,?,?);""",
+                                   [(pending_user, datetime.datetime.now(), epoch_day()) for pending_user in totals])
+                cursor.executemany("""UPDATE user SET currency = currency + ?, upgrades = upgrades + ? WHERE id = ?;""",
+                                   [(pending["currency"], pending["upgrades"], pending_user) for pending_user, pending in totals.items()])
+                cursor.execute("""SELECT COALESCE(MAX(id), 0) FROM waifus;""")
+                last_id = cursor.fetchone()[0]
+                cursor.executemany("""INSERT INTO waifus (user_id, images_id, rarity) VALUES (?,?,?);""", waifus)
+                # The writer connection is ours, so every newer id is one of the rewards.
+                cursor.execute("""SELECT user_id, id FROM waifus WHERE id > ?;""", (last_id,))
+                added = {}
+                for pending_user, waifus_id in cursor.fetchall():
+                    added.setdefault(pending_user, []).append(waifus_id)
+                conn.commit()
+
+            except BaseException:
+                conn.rollback()
+                # Retry them on the next flush.
+                database.pending_rewards.restore(waifus, totals)
+                raise
+
+            for pending_user, waifus_ids in added.items():
+                _inventory_changed(pending_user, added=waifus_ids)
+
+            for pending_user, pending in totals.items():
+                state = database.user_cache.get(pending_user)
+                if state is not None:
+                    database.user_cache.put(pending_user, dict(state,
+                                                               currency=state["currency"] + pending["currency"],
+                                                               upgrades=state["upgrades"] + pending["upgrades"]))
+
+        logger.info(f"Flushed {len(waifus)} drop rewards for {len(totals)} users")
+
+
+def _flush_all_pending_rewards():
+    for uri in list(_databases):
+        with using_database(uri):
+            flush_pending_rewards()
+
+
+# Don't lose rewards that were granted right before shutting down.
+atexit.register(_flush_all_pending_rewards)
 
 
 def get_character_info(char_id):
-    if not character_exists(char_id):
-        return None
-    conn, cursor = get_connection()
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        # The copies are counted by triggers on waifus, see database/migrations/0006_character_stats.sql.
+        cursor.execute("""SELECT c.en_name, c.jp_name, s.copies, s.favorites, s.rarity_0, s.rarity_1, s.rarity_2, s.rarity_3, s.rarity_4, s.rarity_5
+FROM character c
+LEFT JOIN character_stats s ON s.char_id = c.id
+WHERE c.id = ?;""", (char_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        cursor.execute("""SELECT normal_url FROM images WHERE character_id = ?;""", (char_id,))
+        rows = cursor.fetchall()
 
-    cursor.execute("""SELECT en_name, jp_name FROM character WHERE id = ?;""", (char_id,))
-    row = cursor.fetchone()
     en_name = row[0]
     jp_name = row[1]
+    waifu_count = row[2] or 0
+    favs_count = row[3] or 0
+    rarity_count = {
+        rarity: count
+        for rarity, count in enumerate(row[4:10])
+        if count
+    }
 
-    cursor.execute("""SELECT normal_url FROM images WHERE character_id = ?;""", (char_id,))
-    rows = cursor.fetchall()
     image_urls = []
     for row in rows:
         image_urls.append(row[0])
 
-    cursor.execute("""SELECT rarity, favorite FROM waifus w INNER JOIN (SELECT id FROM images WHERE character_id = ?) i ON i.id = w.images_id;""", (char_id,))
-    rows = cursor.fetchall()
-    waifu_count = len(rows)
-    rarity_count = {}
-    favs_count = 0
-    for row in rows:
-        cur_rarity = row[0]
-        cur_fav = row[1]
-        if cur_fav == 1:
-            favs_count += 1
-        if cur_rarity not in rarity_count:
-            rarity_count[cur_rarity] = 1
-        else:
-            rarity_count[cur_rarity] += 1
-
-    conn.close()
-
     return {
         "id": char_id,
         "en_name": en_name,
@@ -1055,75 +1981,104 @@ def get_character_info(char_id):
 
 
 def user_can_daily(user_id):
-    ensure_user_exists(user_id)
-    conn, cursor = get_connection()
-
-    date_format = "%d-%m-%Y %H:%M:%S"
-    cursor.execute("""SELECT STRFTIME(?, last_daily) FROM user WHERE id = ?;""", (date_format, user_id))
-    row = cursor.fetchone()
-    conn.close()
-    last_datetime = datetime.datetime.strptime(row[0], date_format)
-    if last_datetime.date() < datetime.datetime.today().date():
-        return True
-    return False
+    return get_user_state(user_id)["last_daily_day"] < epoch_day()
 
 
 def upgrade_user_waifu(user_id, waifus_id, amount):
+    """
+    Spend upgrade parts to raise the rarity of a user's waifu, in one transaction.
+    Returns the user's remaining parts and the new rarity, as {"upgrades": ..., "rarity": ...}, or None if the user
+    doesn't have enough parts or no longer has the waifu.
+    """
     ensure_user_exists(user_id)
+    flush_pending_rewards(user_id)
     conn, cursor = get_connection()
 
-    # Remove upgrades
-    if not subtract_user_upgrades(user_id, amount, (conn, cursor)):
-        conn.close()
-        return False
+    try:
+        cursor.execute("""BEGIN IMMEDIATE;""")
 
-    # Upgrade waifu
-    cursor.execute("""UPDATE waifus SET rarity = rarity + 1 WHERE id = ?;""", (waifus_id,))
+        # Remove upgrades
+        cursor.execute(f"""UPDATE user SET upgrades = upgrades - ? WHERE id = ? AND upgrades >= ? RETURNING {USER_STATE_COLUMNS};""",
+                       (amount, user_id, amount))
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+        state = rows[0]
 
-    conn.commit()
-    conn.close()
-    return True
+        # Upgrade waifu
+        cursor.execute("""UPDATE waifus SET rarity = rarity + 1 WHERE id = ? AND user_id = ? RETURNING rarity;""", (waifus_id, user_id))
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+
+        conn.commit()
+        _database().user_cache.put(user_id, _user_state(state))
+
+    finally:
+        # Rolls back if the upgrade failed.
+        conn.close()
+
+    return {"upgrades": state[1], "rarity": rows[0][0]}
 
 async def update_images():
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT id, mal_url, character_id FROM images WHERE normal_url IS NULL;""")
-    rows = cursor.fetchall()
+    # Don't hold the writer connection across the awaits below, other helpers need it in the meantime.
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT id, mal_url, character_id FROM images WHERE normal_url IS NULL;""")
+        rows = cursor.fetchall()
     for row in rows:
         cur_id = row[0]
         logger.info(f"Updating image {cur_id}, character: {row[2]}")
         mal_url = row[1]
         images_obj = await mal_tools.CharacterImage.create(mal_url)
         if images_obj:
-            cursor.execute("""UPDATE images SET normal_url = ?, mirror_url = ?, flipped_url = ? WHERE id = ?;""", (images_obj.normal_url, images_obj.mirror_url, images_obj.upside_down_url, cur_id))
-            conn.commit()
+            conn, cursor = get_connection()
+            with conn:
+                cursor.execute("""UPDATE images SET normal_url = ?, mirror_url = ?, flipped_url = ?,
+image_index = COALESCE(image_index, (SELECT COUNT(*) FROM images i WHERE i.character_id = images.character_id AND i.id <= images.id))
+WHERE id = ?;""", (images_obj.normal_url, images_obj.mirror_url, images_obj.upside_down_url, cur_id))
+                conn.commit()
+            catalog_changed()
         await asyncio.sleep(20)
 
-    conn.commit()
-    conn.close()
-
 def get_all_show_mal_urls():
     url_list = list()
 
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT mal_id, is_manga FROM show;""")
-    rows = cursor.fetchall()
-    for row in rows:
-        mal_id = row[0]
-        is_manga = row[1]
-        url_list.append(mal_tools.show_url_from_id(mal_id, is_manga))
-    conn.close()
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT mal_id, is_manga FROM show;""")
+        rows = cursor.fetchall()
+        for row in rows:
+            mal_id = row[0]
+            is_manga = row[1]
+            url_list.append(mal_tools.show_url_from_id(mal_id, is_manga))
 
     return url_list
 
 def get_character_image_urls(char_id):
     image_urls = list()
-    conn, cursor = get_connection()
-    cursor.execute("""SELECT DISTINCT mal_url FROM images WHERE character_id = ?;""", (char_id,))
-    rows = cursor.fetchall()
-    for row in rows:
-        image_urls.append(row[0])
-    conn.close()
+    conn, cursor = get_connection(readonly=True)
+    with conn:
+        cursor.execute("""SELECT DISTINCT mal_url FROM images WHERE character_id = ?;""", (char_id,))
+        rows = cursor.fetchall()
+        for row in rows:
+            image_urls.append(row[0])
     return image_urls
 
 # def change_name(char_id, en_name):
 #
+
+
+def _explain_statement(statement):
+    conn, cursor = get_connection(readonly=True)
+    try:
+        return database_migrations.explain(cursor, statement, ())
+    finally:
+        conn.close()
+
+
+# Time every helper above. Leave out the ones that don't query the database themselves.
+db_metrics.explain = _explain_statement
+db_metrics.instrument(globals(), exclude={
+    "get_connection", "cached_guild_config", "epoch_day", "divide_waifus", "generate_rarity", "get_rarity_currency",
+})
@@ -0,0 +1,230 @@
+"""
+Timing of the database_tools functions and the statements they run.
+
+database_tools instruments its public functions when it is imported. Every call is counted and timed, together with
+the rows its statements fetched and the time it waited for the writer connection. The statements a call runs are followed through
+the connections' trace callback, and statements slower than constants.DB_SLOW_QUERY_MS are logged with their plan.
+"""
+
+import asyncio
+import collections
+import functools
+import inspect
+import threading
+import time
+
+import constants
+import logging
+logger = logging.getLogger('discord')
+
+# How many recent durations of each function are kept for the percentiles.
+SAMPLE_SIZE = 1024
+
+# Set by database_tools: gets the query plan of a statement as a string.
+explain = None
+
+_stats = {}
+_stats_lock = threading.Lock()
+_local = threading.local()
+
+
+class FunctionStats:
+    '''
+    Totals for one function, and its most recent durations.
+    '''
+
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.total = 0.0
+        self.lock_wait = 0.0
+        self.slow_statements = 0
+        self.durations = collections.deque(maxlen = SAMPLE_SIZE)
+
+
+    def summary(self, name):
+        ordered = sorted(self.durations)
+
+        def percentile(fraction):
+            if not ordered:
+                return 0.0
+            return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+        return {
+            "function": name,
+            "calls": self.calls,
+            "total_ms": self.total * 1000,
+            "p50_ms": percentile(0.50),
+            "p95_ms": percentile(0.95),
+            "p99_ms": percentile(0.99),
+            "rows": self.rows,
+            "lock_wait_ms": self.lock_wait * 1000,
+            "slow_statements": self.slow_statements,
+        }
+
+
+class _Call:
+    '''
+    A running instrumented call on this thread, and the statement it is currently running.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.lock_wait = 0.0
+        self.statement = None
+        self.statement_start = 0.0
+        self.rows = 0
+        self.slow = []
+
+
+    def finish_statement(self, now):
+        if self.statement is None:
+            return
+
+        duration = now - self.statement_start
+        if duration * 1000 >= constants.DB_SLOW_QUERY_MS:
+            self.slow.append((self.statement, duration))
+        self.statement = None
+
+
+def _calls():
+    if not hasattr(_local, 'calls'):
+        _local.calls = []
+    return _local.calls
+
+
+def trace_statement(statement):
+    '''
+    Trace callback for sqlite3 connections. A statement runs until the next one starts or the call returns.
+    '''
+
+    calls = _calls()
+    if not calls or getattr(_local, 'explaining', False):
+        return
+
+    if statement.startswith('--'):
+        # A statement inside a trigger, its time belongs to the statement that fired it.
+        return
+
+    call = calls[-1]
+    now = time.perf_counter()
+    call.finish_statement(now)
+    call.statement = statement
+    call.statement_start = now
+
+
+def record_rows(count):
+    '''
+    Add rows fetched from a cursor to the running call.
+    '''
+
+    calls = _calls()
+    if calls:
+        calls[-1].rows += count
+
+
+def record_lock_wait(seconds):
+    '''
+    Add time spent waiting for the writer connection to the running call.
+    '''
+
+    calls = _calls()
+    if calls:
+        calls[-1].lock_wait += seconds
+
+
+def _log_slow(call):
+    for statement, duration in call.slow:
+        plan = "unavailable"
+        if explain is not None and not statement.lstrip().upper().startswith(("BEGIN", "COMMIT", "ROLLBACK", "PRAGMA")):
+            _local.explaining = True
+            try:
+                plan = explain(statement)
+            except Exception as e:
+                plan = f"unavailable ({e})"
+            finally:
+                _local.explaining = False
+
+        logger.warning(f"Slow statement in {call.name}: {duration * 1000:.1f} ms\n    {statement}\n    plan: {plan}")
+
+
+def _record(call, duration):
+    with _stats_lock:
+        stats = _stats.get(call.name)
+        if stats is None:
+            stats = _stats[call.name] = FunctionStats()
+
+        stats.calls += 1
+        stats.rows += call.rows
+        stats.total += duration
+        stats.lock_wait += call.lock_wait
+        stats.slow_statements += len(call.slow)
+        stats.durations.append(duration)
+
+
+def timed(name, function):
+    '''
+    Wrap a function so its calls are recorded under `name`.
+    '''
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        calls = _calls()
+        if calls:
+            # Time spent in this call isn't part of the caller's current statement.
+            calls[-1].finish_statement(time.perf_counter())
+
+        call = _Call(name)
+        calls.append(call)
+        start = time.perf_counter()
+
+        try:
+            return function(*args, **kwargs)
+
+        finally:
+            end = time.perf_counter()
+            call.finish_statement(end)
+            calls.pop()
+
+            _record(call, end - start)
+            if call.slow:
+                _log_slow(call)
+
+    return wrapper
+
+
+def instrument(namespace, exclude = ()):
+    '''
+    Replace the public functions defined in a module, given its globals(), with timed wrappers.
+
+    Coroutine functions are skipped, as they give the thread away while they wait.
+    '''
+
+    module_name = namespace['__name__']
+
+    for name, function in list(namespace.items()):
+        if (
+            name.startswith('_') or name in exclude
+            or not inspect.isfunction(function) or function.__module__ != module_name
+            or asyncio.iscoroutinefunction(function)
+        ):
+            continue
+
+        namespace[name] = timed(name, function)
+
+
+def summary():
+    '''
+    Get the stats of every function that was called, slowest in total first.
+    '''
+
+    with _stats_lock:
+        summaries = [stats.summary(name) for name, stats in _stats.items()]
+
+    summaries.sort(key = lambda entry: entry["total_ms"], reverse = True)
+    return summaries
+
+
+def reset():
+    with _stats_lock:
+        _stats.clear()
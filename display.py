@@ -57,17 +57,29 @@ async def page(bot, args, elements, title, page_no = None, page_size = 25, timeo
     Creates a paginated display of a list of elements. The elements will be converted into strings.
     Paging is controlled by Discord buttons, and is locked if too much time passes since the last use.
     """
+
+    async def fetch_page(i):
+        return elements[i * page_size : (i + 1) * page_size]
+
+    await lazy_page(bot, args, len(elements), fetch_page, title, page_no, page_size, timeout, error_message, **kwargs)
+
+
+async def lazy_page(bot, args, count, fetch_page, title, page_no = None, page_size = 25, timeout = 30, error_message = None, **kwargs):
+    """
+    Like page(), but only the number of elements is known up front.
+    The elements of a page are requested with ``await fetch_page(page index)`` the first time the page is shown.
+    """
     if not error_message:
         error_message = "There is nothing to show."
 
-    if not elements:
+    if not count:
         await args.message.reply(embed = create_embed(
             title,
             error_message
         ))
         return
     
-    pages = 1 + (len(elements) - 1) // page_size
+    pages = 1 + (count - 1) // page_size
 
     page_no = (
         0 if page_no is None
@@ -75,18 +87,16 @@ async def page(bot, args, elements, title, page_no = None, page_size = 25, timeo
         else min(page_no, pages) - 1
     )
 
-    # Create the text for each page.
-    page_texts = []
-
-    for i in range(pages):
-        lines = []
+    # The text of each page that has been shown so far.
+    page_texts = {}
 
-        for element in elements[i * page_size : (i + 1) * page_size]:
-            lines.append(str(element))
+    async def page_text(i):
+        if i not in page_texts:
+            page_texts[i] = '\n'.join(str(element) for element in await fetch_page(i))
 
-        page_texts.append('\n'.join(lines))
+        return page_texts[i]
 
-    embed = create_embed(title + f' - Page {page_no + 1}/{pages}', page_texts[page_no], **kwargs)
+    embed = create_embed(title + f' - Page {page_no + 1}/{pages}', await page_text(page_no), **kwargs)
 
     if pages > 1:
         # There are multiple pages.
@@ -123,7 +133,7 @@ async def page(bot, args, elements, title, page_no = None, page_size = 25, timeo
 
                 # Merge multiple quick presses together.
                 if button_queue.empty():
-                    embed = create_embed(title + f' - Page {page_no + 1}/{pages}', page_texts[page_no], **kwargs)
+                    embed = create_embed(title + f' - Page {page_no + 1}/{pages}', await page_text(page_no), **kwargs)
 
                     await message.edit(embed = embed, view = view)
 
@@ -2,7 +2,7 @@ import random
 import time
 
 import constants
-import database_tools as db
+import database_async as adb
 import display
 import name_tools as nt
 import util
@@ -18,8 +18,8 @@ class Drop:
         """
         Create a new random drop.
         """
-        history = db.get_history(channel.guild.id)
-        data = db.get_drop_data(history)
+        history = await adb.get_history(channel.guild.id)
+        data = await adb.get_drop_data(history)
         waifu = Waifu.from_data(data)
 
         random_number = random.random()
@@ -34,7 +34,7 @@ class Drop:
         # if not await util.verify_url(image_url):
         #     return await cls.create(channel)
 
-        db.update_history(channel.guild.id, history, data)
+        await adb.update_history(channel.guild.id, history, data)
         return cls(waifu, channel, image_url)
 
 
@@ -42,6 +42,13 @@ class Drop:
         self.waifu = waifu
         self.channel = channel
         self.drop_image_url = image_url
+
+        # Normalize the answers once, instead of for every guess.
+        self.answers = (
+            nt.unordered_normalized(self.waifu.character.en_name),
+            nt.unordered_normalized(self.waifu.character.alt_name),
+            nt.unordered_normalized(self.waifu.character.ja_name)
+        )
     
 
     def guess_matches(self, guess):
@@ -49,11 +56,7 @@ class Drop:
         Check if a message is a correct guess.
         """
 
-        return nt.unordered_normalized(guess) in (
-            nt.unordered_normalized(self.waifu.character.en_name),
-            nt.unordered_normalized(self.waifu.character.alt_name),
-            nt.unordered_normalized(self.waifu.character.ja_name)
-        )
+        return nt.unordered_normalized(guess) in self.answers
         
 
     def create_guess_embed(self):
@@ -0,0 +1,121 @@
+import array
+import collections
+import random
+import threading
+
+# How many random picks may land in the exclusion set before falling back to an exact filtered pick.
+MAX_REJECTIONS = 64
+
+
+class DropSampler:
+    '''
+    In-memory pool of the droppable characters and their droppable images.
+
+    Ids are kept in compact arrays, with the images of each character stored contiguously:
+    the images of char_ids[i] are image_ids[image_starts[i]:image_starts[i + 1]].
+    '''
+
+    def __init__(self):
+        self.pool = (array.array('q'), array.array('q', [0]), array.array('q'))
+        self.version = None
+        self.lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self.pool[0])
+
+
+    def is_stale(self, version):
+        return self.version != version
+
+
+    def load(self, rows, version):
+        '''
+        Replace the pool with (character id, image id) rows, which must be ordered by character id.
+        '''
+
+        char_ids = array.array('q')
+        image_starts = array.array('q')
+        image_ids = array.array('q')
+
+        for char_id, image_id in rows:
+            if not char_ids or char_ids[-1] != char_id:
+                char_ids.append(char_id)
+                image_starts.append(len(image_ids))
+            image_ids.append(image_id)
+
+        image_starts.append(len(image_ids))
+
+        # Swap everything at once, so samplers on other threads never see a half-built pool.
+        self.pool = (char_ids, image_starts, image_ids)
+        self.version = version
+
+
+    def sample(self, exclude = ()):
+        '''
+        Pick a random character that is not in `exclude`, and one of its images.
+
+        Returns a (character id, image id) tuple.
+        '''
+
+        char_ids, image_starts, image_ids = self.pool
+
+        if not char_ids:
+            raise IndexError("No droppable characters.")
+
+        index = None
+        for _ in range(MAX_REJECTIONS):
+            candidate = random.randrange(len(char_ids))
+            if char_ids[candidate] not in exclude:
+                index = candidate
+                break
+
+        if index is None:
+            # Almost every character is excluded, so pick from the ones that are left.
+            remaining = [i for i, char_id in enumerate(char_ids) if char_id not in exclude]
+            index = random.choice(remaining) if remaining else random.randrange(len(char_ids))
+
+        image_index = random.randrange(image_starts[index], image_starts[index + 1])
+        return char_ids[index], image_ids[image_index]
+
+
+class GuildHistory:
+    '''
+    The characters most recently dropped in a guild, oldest first. Mirrors the guild's rows in guild_history.
+
+    `head` counts every drop ever recorded, the next drop is stored in ring buffer slot head % size.
+    '''
+
+    def __init__(self, size, char_ids = (), head = 0):
+        self.size = size
+        self.recent = collections.deque(char_ids, maxlen = size)
+        self.counts = collections.Counter(self.recent)
+        self.head = head
+
+
+    def __contains__(self, char_id):
+        return char_id in self.counts
+
+
+    def __iter__(self):
+        return iter(self.recent)
+
+
+    def __len__(self):
+        return len(self.recent)
+
+
+    def next_slot(self):
+        return self.head % self.size
+
+
+    def append(self, char_id):
+        if len(self.recent) == self.size:
+            oldest = self.recent[0]
+            self.counts[oldest] -= 1
+            if not self.counts[oldest]:
+                del self.counts[oldest]
+
+        self.recent.append(char_id)
+        self.counts[char_id] += 1
+        self.head += 1
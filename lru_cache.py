@@ -0,0 +1,69 @@
+import collections
+import threading
+
+
+class LRUCache:
+    '''
+    A thread-safe mapping that holds at most `maxsize` entries, evicting the least recently used one.
+    '''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def get(self, key, default = None):
+        with self.lock:
+            try:
+                self.entries.move_to_end(key)
+            except KeyError:
+                return default
+            return self.entries[key]
+
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self._evict()
+
+
+    def setdefault(self, key, value):
+        '''
+        Store a value unless the key is already cached, and return the cached value.
+
+        Used to fill the cache after a read, so it doesn't overwrite a newer value written in the meantime.
+        '''
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+            self.entries[key] = value
+            self._evict()
+            return value
+
+
+    def pop(self, key, default = None):
+        with self.lock:
+            return self.entries.pop(key, default)
+
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+    def _evict(self):
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last = False)
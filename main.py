@@ -16,6 +16,7 @@ import os
 import discord
 import constants
 import bot
+import database_tools as db
 import internet
 
 logger.info("Starting main script.")
@@ -24,6 +25,9 @@ logger.info("Starting main script.")
 if not internet.verify():
     asyncio.run(internet.handle_disconnect(from_reboot=True))
 
+# Create the database or bring its schema up to date.
+db.create_database()
+
 intents = discord.Intents().all()
 
 token = os.environ[f'{constants.ENVVAR_PREFIX}TOKEN']
@@ -8,7 +8,7 @@ import time
 from PIL import Image, ImageOps
 
 import constants
-import database_tools as db
+import database_async as adb
 import logging
 logger = logging.getLogger('discord')
 
@@ -168,11 +168,6 @@ async def downloadInsertShowCharacters(show_url, overwrite=False):
             jp_title = jp_title_element.contents[0]
             en_title = jp_title_element.find("span", class_="title-english").text
 
-    if not db.show_exists_by_mal(mal_id, is_manga):
-        db.insert_show(mal_id, jp_title, en_title, is_manga)
-
-    show_id = db.get_show_id_by_mal(mal_id, is_manga)
-
     if not is_manga:
         character_tables = soup.find_all("table", class_="js-anime-character-table")
     else:
@@ -181,22 +176,23 @@ async def downloadInsertShowCharacters(show_url, overwrite=False):
     character_count = len(character_tables)
     logger.info(f"Found {character_count} characters.")
 
+    character_urls = {}
     for character_table in character_tables:
         character_url = character_table.find_all("a", href=True)[0]
-        character_id = getCharacterIDFromURL(character_url["href"])
-        if not overwrite:
-            # Check if already exists and ignore if so.
-            if db.character_exists(character_id):
-                if db.character_has_show(character_id, show_id):
-                    logger.warn(f"Character {character_id} already exists.")
-                    continue
-                else:
-                    # Add show to character.
-                    db.add_show_to_character(character_id, show_id)
-                    continue
-        character_data = await downloadCharacterFromURL(character_url["href"])
-        db.insert_character(character_data, overwrite=overwrite)
-        db.add_show_to_character(character_id, show_id)
+        character_urls[int(getCharacterIDFromURL(character_url["href"]))] = character_url["href"]
+
+    # Characters that already exist only need to be linked to the show.
+    existing = set() if overwrite else await adb.get_existing_character_ids(list(character_urls))
+
+    character_data_list = []
+    for character_id, character_url in character_urls.items():
+        if character_id in existing:
+            logger.warn(f"Character {character_id} already exists.")
+            continue
+        character_data_list.append(await downloadCharacterFromURL(character_url))
+
+    # Everything is stored at once, so the show is imported in a single commit.
+    await adb.ingest_show(mal_id, jp_title, en_title, is_manga, list(character_urls), character_data_list, overwrite=overwrite)
 
 
 def getCharacterIDFromURL(character_url):
@@ -252,7 +248,7 @@ async def getImages(image_page_url, char_id):
     # Remove duplicates
     image_urls = list(dict.fromkeys(image_urls))
 
-    existing_image_urls = db.get_character_image_urls(char_id)
+    existing_image_urls = await adb.get_character_image_urls(char_id)
 
     image_objects = list()
     for image_url in image_urls:
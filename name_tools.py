@@ -53,6 +53,29 @@ def unordered_normalized(text):
     )
 
 
+def name_tokens(text):
+    """
+    Returns the normalized parts of a name, as stored for unordered name lookups.
+    """
+
+    if not text:
+        return []
+
+    return [
+        token
+        for token in (normalize_romanization(part) for part in text.split())
+        if token
+    ]
+
+
+def name_keys(en_name, alt_name = None, jp_name = None):
+    """
+    Returns the normalized name and the set of name tokens stored for a character.
+    """
+
+    return normalize_romanization(en_name), set(name_tokens(en_name) + name_tokens(alt_name) + name_tokens(jp_name))
+
+
 def initials(name):
     """
     Get the initials of a name.
@@ -0,0 +1,1049 @@
+"""
+Storage backends: the operations the bot needs on users, waifus, the character catalog, guilds and drop history.
+
+SQLiteBackend is the bot's database, it hands every call to database_tools. MemoryBackend keeps everything in
+dicts with its own indexes, for load tests and benchmarks that don't need a database file. Both return the same
+dicts and values as the database_tools function of the same name, benchmark.py --check compares them.
+Another database can be plugged in by implementing StorageBackend and adding it to BACKENDS.
+"""
+
+import abc
+import bisect
+import collections
+import functools
+import itertools
+import os
+import threading
+
+import constants
+import database_tools as db
+import drop_sampler
+import name_tools as nt
+
+
+class StorageBackend(abc.ABC):
+    '''
+    The operations every storage backend provides. See the database_tools function of the same name for the arguments
+    and the returned values.
+    '''
+
+    # Users
+
+    @abc.abstractmethod
+    def ensure_user_exists(self, user_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_user_state(self, user_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_user_currency(self, user_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def add_user_currency(self, user_id, amount):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def subtract_user_currency(self, user_id, amount):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def change_user_currency(self, user_id, amount, required = 0):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def transfer_user_currency(self, sender_id, recipient_id, amount):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def set_user_currency(self, user_id, amount):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_user_upgrades(self, user_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def add_user_upgrades(self, user_id, amount):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def subtract_user_upgrades(self, user_id, amount):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def user_can_daily(self, user_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def claim_daily(self, user_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def add_drop_reward(self, user_id, image_id, rarity, currency, upgrades = 0):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def flush_pending_rewards(self, user_id = None):
+        raise NotImplementedError
+
+
+    # Waifus
+
+    @abc.abstractmethod
+    def add_waifu(self, user_id, image_id, rarity):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_waifu_count(self, user_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_all_waifu_data_for_user(self, user_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_waifu_page(self, user_id, after_id = None, before_id = None, limit = constants.PROFILE_PAGE_SIZE, start_index = 0):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_waifu_data_of_user(self, user_id, waifu_index):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_waifus_by_indices(self, user_id, indices):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def remove_waifu(self, waifus_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def remove_waifus(self, user_id, waifus_ids):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def set_favorite(self, waifus_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def set_favorites(self, user_id, waifus_ids, favorite = True):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def unfavorite(self, waifus_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def upgrade_user_waifu(self, user_id, waifus_id, amount):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def trade(self, user1_id, user2_id, user1_offer, user2_offer):
+        raise NotImplementedError
+
+
+    # Catalog
+
+    @abc.abstractmethod
+    def insert_character(self, char_data, alt_name = None, overwrite = False):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def character_exists(self, char_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def insert_show(self, mal_id, jp_title, en_title, is_manga):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_show_id_by_mal(self, mal_id, is_manga):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def add_show_to_character(self, char_id, show_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_shows_from_character(self, char_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_characters_from_show(self, show_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_character_info(self, char_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_character_data_like(self, search_query):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_character_data_by_name(self, name):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_character_ids_with_name_part(self, name_part):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_shows_like(self, search_query):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_drop_data(self, history = None, price = None, user_id = None):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def roll_waifus(self, user_id, price, count = 1):
+        raise NotImplementedError
+
+
+    # Guilds and history
+
+    @abc.abstractmethod
+    def get_guild_config(self, guild_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def assign_channel_to_guild(self, channel_id, guild_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def enable_drops(self, guild_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def disable_drops(self, guild_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def remove_guild(self, guild_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def get_history(self, guild_id):
+        raise NotImplementedError
+
+
+    @abc.abstractmethod
+    def update_history(self, guild_id, history, waifu_data):
+        raise NotImplementedError
+
+
+def _delegate(name):
+    '''
+    A SQLiteBackend operation that calls the database_tools function of the same name on the backend's database.
+    '''
+
+    function = getattr(db, name)
+
+    @functools.wraps(function)
+    def operation(self, *args, **kwargs):
+        with db.using_database(self.uri):
+            return function(*args, **kwargs)
+
+    return operation
+
+
+class SQLiteBackend(StorageBackend):
+    '''
+    A SQLite database through database_tools. Each backend uses its own URI, database_tools.DATABASE_URI by default,
+    and with it its own connection pool and caches.
+    '''
+
+    def __init__(self, uri = None):
+        self.uri = uri or db.DATABASE_URI
+        with db.using_database(self.uri):
+            db.create_database()
+
+
+    # Every operation is the database_tools function of the same name, run on this backend's database.
+
+    # Users
+    ensure_user_exists = _delegate("ensure_user_exists")
+    get_user_state = _delegate("get_user_state")
+    get_user_currency = _delegate("get_user_currency")
+    add_user_currency = _delegate("add_user_currency")
+    subtract_user_currency = _delegate("subtract_user_currency")
+    change_user_currency = _delegate("change_user_currency")
+    transfer_user_currency = _delegate("transfer_user_currency")
+    set_user_currency = _delegate("set_user_currency")
+    get_user_upgrades = _delegate("get_user_upgrades")
+    add_user_upgrades = _delegate("add_user_upgrades")
+    subtract_user_upgrades = _delegate("subtract_user_upgrades")
+    user_can_daily = _delegate("user_can_daily")
+    claim_daily = _delegate("claim_daily")
+    add_drop_reward = _delegate("add_drop_reward")
+    flush_pending_rewards = _delegate("flush_pending_rewards")
+
+    # Waifus
+    add_waifu = _delegate("add_waifu")
+    get_waifu_count = _delegate("get_waifu_count")
+    get_all_waifu_data_for_user = _delegate("get_all_waifu_data_for_user")
+    get_waifu_page = _delegate("get_waifu_page")
+    get_waifu_data_of_user = _delegate("get_waifu_data_of_user")
+    get_waifus_by_indices = _delegate("get_waifus_by_indices")
+    remove_waifu = _delegate("remove_waifu")
+    remove_waifus = _delegate("remove_waifus")
+    set_favorite = _delegate("set_favorite")
+    set_favorites = _delegate("set_favorites")
+    unfavorite = _delegate("unfavorite")
+    upgrade_user_waifu = _delegate("upgrade_user_waifu")
+    trade = _delegate("trade")
+
+    # Catalog
+    insert_character = _delegate("insert_character")
+    character_exists = _delegate("character_exists")
+    insert_show = _delegate("insert_show")
+    get_show_id_by_mal = _delegate("get_show_id_by_mal")
+    add_show_to_character = _delegate("add_show_to_character")
+    get_shows_from_character = _delegate("get_shows_from_character")
+    get_characters_from_show = _delegate("get_characters_from_show")
+    get_character_info = _delegate("get_character_info")
+    get_character_data_like = _delegate("get_character_data_like")
+    get_character_data_by_name = _delegate("get_character_data_by_name")
+    get_character_ids_with_name_part = _delegate("get_character_ids_with_name_part")
+    get_shows_like = _delegate("get_shows_like")
+    get_drop_data = _delegate("get_drop_data")
+    roll_waifus = _delegate("roll_waifus")
+
+    # Guilds and history
+    get_guild_config = _delegate("get_guild_config")
+    assign_channel_to_guild = _delegate("assign_channel_to_guild")
+    enable_drops = _delegate("enable_drops")
+    disable_drops = _delegate("disable_drops")
+    remove_guild = _delegate("remove_guild")
+    get_history = _delegate("get_history")
+    update_history = _delegate("update_history")
+
+
+class MemoryBackend(StorageBackend):
+    '''
+    Everything in memory, nothing is persisted.
+
+    Rows are dicts keyed by id, with indexes for the lookups the bot does: waifus by owner (ids in inventory order),
+    images by character, shows by MAL id, show membership both ways, and name tokens sorted for prefix lookups.
+    Character statistics are kept up to date as cards change, like the character_stats table.
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+
+        self.users = {}
+        self.waifus = {}
+        self.user_waifus = collections.defaultdict(list)
+        self.characters = {}
+        self.images = {}
+        self.character_images = collections.defaultdict(list)
+        self.name_tokens = []
+        self.shows = {}
+        self.shows_by_mal = {}
+        self.show_characters = collections.defaultdict(set)
+        self.character_shows = collections.defaultdict(set)
+        self.character_stats = collections.defaultdict(lambda: {"copies": 0, "favorites": 0, "rarities": collections.Counter()})
+        self.guilds = {}
+        self.histories = {}
+
+        self.waifu_ids = itertools.count(1)
+        self.image_ids = itertools.count(1)
+        self.show_ids = itertools.count(1)
+
+        self.sampler = drop_sampler.DropSampler()
+        self.catalog_version = 0
+
+
+    # Users
+
+    def _user(self, user_id):
+        # The user's row, created if it doesn't exist yet.
+        with self.lock:
+            if user_id not in self.users:
+                self.users[user_id] = {
+                    "currency": 500,
+                    "upgrades": 0,
+                    "last_daily_day": db.epoch_day(),
+                    "can_trade": True,
+                    "can_remove": True,
+                }
+            return self.users[user_id]
+
+
+    def ensure_user_exists(self, user_id):
+        self._user(user_id)
+
+
+    def get_user_state(self, user_id):
+        user = self._user(user_id)
+        return {"currency": user["currency"], "upgrades": user["upgrades"], "last_daily_day": user["last_daily_day"]}
+
+
+    def get_user_currency(self, user_id):
+        return self._user(user_id)["currency"]
+
+
+    def add_user_currency(self, user_id, amount):
+        with self.lock:
+            user = self._user(user_id)
+            user["currency"] += amount
+            return user["currency"]
+
+
+    def subtract_user_currency(self, user_id, amount):
+        with self.lock:
+            user = self._user(user_id)
+            if user["currency"] < amount:
+                return False
+            user["currency"] -= amount
+            return True
+
+
+    def change_user_currency(self, user_id, amount, required = 0):
+        with self.lock:
+            user = self._user(user_id)
+            if user["currency"] < required:
+                return None
+            user["currency"] += amount
+            return user["currency"]
+
+
+    def transfer_user_currency(self, sender_id, recipient_id, amount):
+        with self.lock:
+            sender = self._user(sender_id)
+            recipient = self._user(recipient_id)
+            if sender["currency"] < amount:
+                return None
+            sender["currency"] -= amount
+            recipient["currency"] += amount
+            return sender["currency"], recipient["currency"]
+
+
+    def set_user_currency(self, user_id, amount):
+        with self.lock:
+            user = self._user(user_id)
+            previous = user["currency"]
+            user["currency"] = amount
+            return previous, amount
+
+
+    def get_user_upgrades(self, user_id):
+        return self._user(user_id)["upgrades"]
+
+
+    def add_user_upgrades(self, user_id, amount):
+        with self.lock:
+            user = self._user(user_id)
+            user["upgrades"] += amount
+            return user["upgrades"]
+
+
+    def subtract_user_upgrades(self, user_id, amount):
+        with self.lock:
+            user = self._user(user_id)
+            if user["upgrades"] < amount:
+                return False
+            user["upgrades"] -= amount
+            return True
+
+
+    def user_can_daily(self, user_id):
+        return self._user(user_id)["last_daily_day"] < db.epoch_day()
+
+
+    def claim_daily(self, user_id):
+        today = db.epoch_day()
+        with self.lock:
+            user = self._user(user_id)
+            if user["last_daily_day"] >= today:
+                return None
+            user["currency"] += db.DAILY_CURRENCY
+            user["last_daily_day"] = today
+            return user["currency"]
+
+
+    def add_drop_reward(self, user_id, image_id, rarity, currency, upgrades = 0):
+        # Nothing to batch in memory, the reward is applied straight away.
+        with self.lock:
+            slot = self.add_waifu(user_id, image_id, rarity)["slot"]
+            user = self.users[user_id]
+            user["currency"] += currency
+            user["upgrades"] += upgrades
+            return {"currency": user["currency"], "upgrades": user["upgrades"], "slot": slot}
+
+
+    def flush_pending_rewards(self, user_id = None):
+        # Rewards are applied straight away, there is nothing to write.
+        pass
+
+
+    # Waifus
+
+    def _change_stats(self, waifu, sign):
+        stats = self.character_stats[self.images[waifu["images_id"]]["character_id"]]
+        stats["copies"] += sign
+        stats["favorites"] += sign * bool(waifu["favorite"])
+        stats["rarities"][waifu["rarity"]] += sign
+
+
+    def _insert_waifu(self, user_id, image_id, rarity):
+        waifu = {"id": next(self.waifu_ids), "user_id": user_id, "images_id": image_id, "rarity": rarity, "favorite": False}
+        self.waifus[waifu["id"]] = waifu
+        # Ids only grow, so appending keeps the inventory in order.
+        self.user_waifus[user_id].append(waifu["id"])
+        self._change_stats(waifu, 1)
+        return waifu
+
+
+    def _delete_waifu(self, waifu):
+        inventory = self.user_waifus[waifu["user_id"]]
+        del inventory[bisect.bisect_left(inventory, waifu["id"])]
+        del self.waifus[waifu["id"]]
+        self._change_stats(waifu, -1)
+
+
+    def _waifu_data(self, waifus_id, card_index):
+        waifu = self.waifus[waifus_id]
+        image = self.images[waifu["images_id"]]
+        character = self.characters[image["character_id"]]
+        return {
+            "en_name": character["en_name"],
+            "jp_name": character["jp_name"],
+            "image_index": image["image_index"],
+            "rarity": waifu["rarity"],
+            "id": character["id"],
+            "image_id": image["id"],
+            "waifus_id": waifus_id,
+            "card_index": card_index,
+            "image_url": image["normal_url"],
+            "favorite": waifu["favorite"],
+        }
+
+
+    def add_waifu(self, user_id, image_id, rarity):
+        with self.lock:
+            self._user(user_id)
+            waifu = self._insert_waifu(user_id, image_id, rarity)
+            return {"waifus_id": waifu["id"], "slot": len(self.user_waifus[user_id])}
+
+
+    def get_waifu_count(self, user_id):
+        self._user(user_id)
+        return len(self.user_waifus[user_id])
+
+
+    def get_all_waifu_data_for_user(self, user_id):
+        with self.lock:
+            self._user(user_id)
+            return [self._waifu_data(waifus_id, index) for index, waifus_id in enumerate(self.user_waifus[user_id])]
+
+
+    def get_waifu_page(self, user_id, after_id = None, before_id = None, limit = constants.PROFILE_PAGE_SIZE, start_index = 0):
+        with self.lock:
+            self._user(user_id)
+            inventory = self.user_waifus[user_id]
+
+            if before_id is not None:
+                end = bisect.bisect_left(inventory, before_id)
+                start = max(0, end - limit)
+            else:
+                start = bisect.bisect_right(inventory, after_id) if after_id is not None else 0
+                end = start + limit
+
+            return [self._waifu_data(waifus_id, start_index + index) for index, waifus_id in enumerate(inventory[start:end])]
+
+
+    def get_waifu_data_of_user(self, user_id, waifu_index):
+        return self.get_waifus_by_indices(user_id, [waifu_index])[0]
+
+
+    def get_waifus_by_indices(self, user_id, indices):
+        with self.lock:
+            self._user(user_id)
+            inventory = self.user_waifus[user_id]
+            waifus = []
+
+            for waifu_index in indices:
+                if waifu_index < 1:
+                    # Negative numbers are taken from the end.
+                    position = waifu_index % len(inventory) if inventory else None
+                else:
+                    # Waifus are 1-indexed.
+                    position = waifu_index - 1 if waifu_index <= len(inventory) else None
+
+                waifus.append(self._waifu_data(inventory[position], position) if position is not None else None)
+
+            return waifus
+
+
+    def remove_waifu(self, waifus_id):
+        with self.lock:
+            waifu = self.waifus.get(waifus_id)
+            if waifu is None:
+                return False
+            self._delete_waifu(waifu)
+            return True
+
+
+    def remove_waifus(self, user_id, waifus_ids):
+        with self.lock:
+            user = self._user(user_id)
+            removed = []
+            reward = 0
+
+            for waifus_id in dict.fromkeys(waifus_ids):
+                waifu = self.waifus.get(waifus_id)
+                if waifu is None or waifu["user_id"] != user_id:
+                    continue
+                self._delete_waifu(waifu)
+                removed.append(waifus_id)
+                reward += db.get_rarity_currency(waifu["rarity"])
+
+            user["currency"] += reward
+            return removed, reward
+
+
+    def _set_favorite(self, waifus_id, favorite):
+        with self.lock:
+            waifu = self.waifus.get(waifus_id)
+            if waifu is None or waifu["favorite"] == favorite:
+                return
+            self._change_stats(waifu, -1)
+            waifu["favorite"] = favorite
+            self._change_stats(waifu, 1)
+
+
+    def set_favorite(self, waifus_id):
+        self._set_favorite(waifus_id, True)
+
+
+    def unfavorite(self, waifus_id):
+        self._set_favorite(waifus_id, False)
+
+
+    def set_favorites(self, user_id, waifus_ids, favorite = True):
+        with self.lock:
+            changed = [
+                waifus_id
+                for waifus_id in dict.fromkeys(waifus_ids)
+                if self.waifus.get(waifus_id, {}).get("user_id") == user_id
+            ]
+            for waifus_id in changed:
+                self._set_favorite(waifus_id, bool(favorite))
+            return changed
+
+
+    def upgrade_user_waifu(self, user_id, waifus_id, amount):
+        with self.lock:
+            waifu = self.waifus.get(waifus_id)
+            if waifu is None or waifu["user_id"] != user_id or not self.subtract_user_upgrades(user_id, amount):
+                return None
+            self._change_stats(waifu, -1)
+            waifu["rarity"] += 1
+            self._change_stats(waifu, 1)
+            return {"upgrades": self.users[user_id]["upgrades"], "rarity": waifu["rarity"]}
+
+
+    def trade(self, user1_id, user2_id, user1_offer, user2_offer):
+        with self.lock:
+            users = {user_id: self._user(user_id) for user_id in (user1_id, user2_id)}
+            sides = ((user1_id, user2_id, user1_offer), (user2_id, user1_id, user2_offer))
+
+            # Check both sides before changing anything. Like the database, the second side is checked with the
+            # currency of the first side already moved.
+            balances = {user_id: user["currency"] for user_id, user in users.items()}
+            for giver_id, receiver_id, offer in sides:
+                if offer.money > 0:
+                    if offer.money > balances[giver_id]:
+                        return False
+                    balances[giver_id] -= offer.money
+                    balances[receiver_id] += offer.money
+                for waifu in offer.waifus:
+                    if self.waifus.get(waifu.waifu_id, {}).get("user_id") != giver_id:
+                        return False
+
+            for giver_id, receiver_id, offer in sides:
+                if offer.money > 0:
+                    users[giver_id]["currency"] -= offer.money
+                    users[receiver_id]["currency"] += offer.money
+
+                # Like the database, a traded card is a new card at the end of the receiver's inventory.
+                for waifus_id in dict.fromkeys(waifu.waifu_id for waifu in offer.waifus):
+                    waifu = self.waifus[waifus_id]
+                    self._delete_waifu(waifu)
+                    self._insert_waifu(receiver_id, waifu["images_id"], waifu["rarity"])
+
+            return True
+
+
+    # Catalog
+
+    def _index_character_name(self, char_id):
+        character = self.characters[char_id]
+        self.name_tokens = [entry for entry in self.name_tokens if entry[1] != char_id]
+        normalized_name, tokens = nt.name_keys(character["en_name"], character["alt_name"], character["jp_name"])
+        character["normalized_name"] = normalized_name
+        for token in tokens:
+            bisect.insort(self.name_tokens, (token, char_id))
+
+
+    def insert_character(self, char_data, alt_name = None, overwrite = False):
+        char_id = char_data["char_id"]
+        images = char_data["images"]
+
+        with self.lock:
+            exists = char_id in self.characters
+            if (exists and not overwrite) or not images:
+                return
+
+            if not exists:
+                self.characters[char_id] = {
+                    "id": char_id,
+                    "en_name": char_data["en_name"],
+                    "jp_name": char_data["jp_name"],
+                    "alt_name": alt_name,
+                    "droppable": True,
+                }
+            elif self.characters[char_id]["alt_name"] is None:
+                # A set alt_name means the names were changed by hand.
+                self.characters[char_id].update(en_name = char_data["en_name"], jp_name = char_data["jp_name"])
+
+            self._index_character_name(char_id)
+
+            known_urls = {self.images[image_id]["mal_url"] for image_id in self.character_images[char_id]}
+            for image in images:
+                if image.mal_url in known_urls:
+                    continue
+                known_urls.add(image.mal_url)
+                image_id = next(self.image_ids)
+                self.images[image_id] = {
+                    "id": image_id,
+                    "character_id": char_id,
+                    "mal_url": image.mal_url,
+                    "normal_url": image.normal_url,
+                    "mirror_url": image.mirror_url,
+                    "flipped_url": image.upside_down_url,
+                    "image_index": len(self.character_images[char_id]) + 1,
+                    "droppable": True,
+                }
+                self.character_images[char_id].append(image_id)
+
+            self.catalog_version += 1
+
+
+    def character_exists(self, char_id):
+        return char_id in self.characters
+
+
+    def insert_show(self, mal_id, jp_title, en_title, is_manga):
+        with self.lock:
+            show_id = next(self.show_ids)
+            self.shows[show_id] = {"id": show_id, "mal_id": mal_id, "jp_title": jp_title, "en_title": en_title, "is_manga": is_manga}
+            self.shows_by_mal.setdefault((mal_id, bool(is_manga)), show_id)
+
+
+    def get_show_id_by_mal(self, mal_id, is_manga):
+        return self.shows_by_mal.get((mal_id, bool(is_manga)))
+
+
+    def add_show_to_character(self, char_id, show_id):
+        with self.lock:
+            self.show_characters[show_id].add(char_id)
+            self.character_shows[char_id].add(show_id)
+
+
+    def get_shows_from_character(self, char_id):
+        return sorted(self.character_shows.get(char_id, ()))
+
+
+    def get_characters_from_show(self, show_id):
+        with self.lock:
+            char_list = [
+                {
+                    "id": char_id,
+                    "en_name": self.characters[char_id]["en_name"],
+                    "image_count": len(self.character_images[char_id]),
+                }
+                for char_id in self.show_characters.get(show_id, ())
+                if char_id in self.characters and self.character_images[char_id]
+            ]
+
+        if not char_list:
+            return None
+        char_list.sort(key = lambda chara: chara["en_name"])
+        return char_list
+
+
+    def get_character_info(self, char_id):
+        with self.lock:
+            character = self.characters.get(char_id)
+            if character is None:
+                return None
+
+            stats = self.character_stats.get(char_id, {"copies": 0, "favorites": 0, "rarities": {}})
+            return {
+                "id": char_id,
+                "en_name": character["en_name"],
+                "jp_name": character["jp_name"],
+                "waifu_count": stats["copies"],
+                "rarity_count": {rarity: count for rarity, count in sorted(stats["rarities"].items()) if count},
+                "image_urls": [self.images[image_id]["normal_url"] for image_id in self.character_images[char_id]],
+                "favorites": stats["favorites"],
+            }
+
+
+    def get_character_data_like(self, search_query):
+        search_query = search_query.lower()
+        chara_list = []
+
+        with self.lock:
+            for character in self.characters.values():
+                names = (character["en_name"], character["jp_name"], character["alt_name"])
+                if any(name and search_query in name.lower() for name in names):
+                    chara_list.append({'id': character["id"], 'en_name': character["en_name"]})
+                    if len(chara_list) == 25:
+                        break
+
+        return chara_list
+
+
+    def get_character_data_by_name(self, name):
+        tokens = sorted(nt.name_tokens(name), key = len, reverse = True)
+        if not tokens:
+            return []
+        normalized_name = nt.normalize_romanization(" ".join(name.split()))
+
+        with self.lock:
+            char_ids = sorted(char_id for char_id, character in self.characters.items() if character["normalized_name"] == normalized_name)
+            if char_ids:
+                return [{'id': char_id, 'en_name': self.characters[char_id]["en_name"]} for char_id in char_ids[:db.NAME_MATCH_LIMIT]]
+
+            for exact in (True, False):
+                matches = None
+                for token in tokens:
+                    # Every (token, char_id) entry that is this token, or starts with it.
+                    start = bisect.bisect_left(self.name_tokens, (token,))
+                    end = bisect.bisect_left(self.name_tokens, (token + ("\0" if exact else "\uffff"),))
+                    char_ids = {entry[1] for entry in self.name_tokens[start:end]}
+                    matches = char_ids if matches is None else matches & char_ids
+
+                chara_list = []
+                for char_id in sorted(matches)[:db.NAME_MATCH_LIMIT]:
+                    character = self.characters[char_id]
+                    if db._tokens_match(tokens, nt.name_tokens(character["en_name"]), exact) or db._tokens_match(tokens, nt.name_tokens(character["alt_name"]), exact):
+                        chara_list.append({'id': char_id, 'en_name': character["en_name"]})
+
+                if chara_list:
+                    return chara_list
+
+        return []
+
+
+    def get_character_ids_with_name_part(self, name_part):
+        normalized_part = nt.normalize_romanization(name_part)
+        with self.lock:
+            return {
+                character["id"]
+                for character in self.characters.values()
+                if normalized_part in character["normalized_name"] or (character["jp_name"] and name_part in character["jp_name"])
+            }
+
+
+    def get_shows_like(self, search_query):
+        search_query = search_query.lower()
+        shows_list = []
+
+        with self.lock:
+            for show in self.shows.values():
+                if any(title and search_query in title.lower() for title in (show["jp_title"], show["en_title"])):
+                    shows_list.append({"id": show["id"], "jp_title": show["jp_title"], "is_manga": show["is_manga"]})
+                    if len(shows_list) == 25:
+                        break
+
+        return shows_list
+
+
+    def _load_sampler(self):
+        if self.sampler.is_stale(self.catalog_version):
+            self.sampler.load(
+                (
+                    (char_id, image_id)
+                    for char_id in sorted(self.characters)
+                    if self.characters[char_id]["droppable"]
+                    for image_id in self.character_images[char_id]
+                    if self.images[image_id]["droppable"]
+                ),
+                self.catalog_version,
+            )
+
+
+    def _drop_data(self, image_id, rarity):
+        image = self.images[image_id]
+        character = self.characters[image["character_id"]]
+        return {"id": character["id"],
+                "en_name": character["en_name"],
+                "jp_name": character["jp_name"],
+                "alt_name": character["alt_name"],
+                "image_url": image["normal_url"],
+                "image_id": image_id,
+                "image_index": image["image_index"],
+                "rarity": rarity,
+                "normal_url": image["normal_url"],
+                "mirror_url": image["mirror_url"],
+                "flipped_url": image["flipped_url"]}
+
+
+    def get_drop_data(self, history = None, price = None, user_id = None):
+        with self.lock:
+            self._load_sampler()
+            _, image_id = self.sampler.sample(history or ())
+
+        rarity, price = db.generate_rarity(price)
+        cur_waifu = self._drop_data(image_id, rarity)
+
+        if price and user_id:
+            self.subtract_user_currency(user_id, price)
+            return cur_waifu, price
+
+        return cur_waifu
+
+
+    def roll_waifus(self, user_id, price, count = 1):
+        with self.lock:
+            # Pick everything before charging, so nothing is charged if the pick fails.
+            self._load_sampler()
+            picked = set()
+            rolled = []
+
+            for _ in range(count):
+                char_id, image_id = self.sampler.sample(picked)
+                picked.add(char_id)
+                rolled.append(self._drop_data(image_id, db.generate_rarity(price)[0]))
+
+            if self.change_user_currency(user_id, -price * count, price * count) is None:
+                return None
+
+            for waifu_data in rolled:
+                waifu = self._insert_waifu(user_id, waifu_data["image_id"], waifu_data["rarity"])
+                waifu_data["waifus_id"] = waifu["id"]
+                waifu_data["slot"] = len(self.user_waifus[user_id])
+
+            return self.users[user_id]["currency"], rolled
+
+
+    # Guilds and history
+
+    def get_guild_config(self, guild_id):
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            return {"exists": False, "channel_id": None, "can_drop": False, "history_head": 0}
+        return {"exists": True, **guild}
+
+
+    def assign_channel_to_guild(self, channel_id, guild_id):
+        with self.lock:
+            guild = self.guilds.setdefault(guild_id, {"channel_id": None, "can_drop": True, "history_head": 0})
+            guild["channel_id"] = channel_id
+
+
+    def _set_can_drop(self, guild_id, can_drop):
+        with self.lock:
+            if guild_id in self.guilds:
+                self.guilds[guild_id]["can_drop"] = can_drop
+
+
+    def enable_drops(self, guild_id):
+        self._set_can_drop(guild_id, True)
+
+
+    def disable_drops(self, guild_id):
+        self._set_can_drop(guild_id, False)
+
+
+    def remove_guild(self, guild_id):
+        with self.lock:
+            self.guilds.pop(guild_id, None)
+            self.histories.pop(guild_id, None)
+
+
+    def get_history(self, guild_id):
+        with self.lock:
+            history = self.histories.get(guild_id)
+            if history is None:
+                history = self.histories[guild_id] = drop_sampler.GuildHistory(constants.HISTORY_SIZE)
+            return history
+
+
+    def update_history(self, guild_id, history, waifu_data):
+        with self.lock:
+            if history is None:
+                history = self.get_history(guild_id)
+            history.append(waifu_data["id"])
+            if guild_id in self.guilds:
+                self.guilds[guild_id]["history_head"] = history.head
+
+
+BACKENDS = {
+    "sqlite": SQLiteBackend,
+    "memory": MemoryBackend,
+}
+
+
+def create_backend(name = None):
+    '''
+    Create a storage backend by name, "sqlite" or "memory". Defaults to the ACGB_STORAGE environment variable, or
+    "sqlite".
+    '''
+
+    name = name or os.getenv("ACGB_STORAGE") or "sqlite"
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown storage backend {name}, expected one of: {', '.join(BACKENDS)}")
+    return BACKENDS[name]()
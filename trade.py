@@ -1,6 +1,7 @@
 import time
 
 import constants
+import database_async as adb
 import database_tools as db
 import display
 
@@ -93,20 +94,20 @@ class Trade:
         return self.user1.id == user or self.user2.id == user
     
 
-    def mark_users_as_trading(self):
+    async def mark_users_as_trading(self):
         '''
         Flag the participants as in a trade, so they cannot start trading elsewhere.
         '''
-        db.disable_trade(self.user1.id)
-        db.disable_trade(self.user2.id)
+        await adb.disable_trade(self.user1.id)
+        await adb.disable_trade(self.user2.id)
     
 
-    def mark_trade_over(self):
+    async def mark_trade_over(self):
         '''
         Flag the participants as no longer in a trade.
         '''
-        db.enable_trade(self.user1.id)
-        db.enable_trade(self.user2.id)
+        await adb.enable_trade(self.user1.id)
+        await adb.enable_trade(self.user2.id)
 
 
     def offer_of(self, user):
@@ -128,11 +129,11 @@ class Trade:
         return self.offer1.confirmed and self.offer2.confirmed
 
 
-    def perform(self):
+    async def perform(self):
         '''
         Perform the trade. returns if successful.
         '''
-        return db.trade(self.user1.id, self.user2.id, self.offer1, self.offer2)
+        return await adb.run(self.user1.id, db.trade, self.user1.id, self.user2.id, self.offer1, self.offer2)
     
 
     def create_embed(self, bot):
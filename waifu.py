@@ -5,6 +5,7 @@ import string
 from urllib.parse import urlparse
 
 import constants
+import database_async as adb
 import database_tools as db
 import display
 
@@ -211,6 +212,19 @@ class Waifu:
         return cls.from_data(data, user)
 
 
+    @classmethod
+    def from_user_indices(cls, user, indices):
+        '''
+        Fetch and create the waifus at several inventory numbers of a user, in the same order.
+        Numbers that aren't in the inventory give None.
+        '''
+
+        return [
+            cls.from_data(data, user) if data is not None else None
+            for data in db.get_waifus_by_indices(user.id, indices)
+        ]
+
+
     def __init__(self, character, image, image_url, rarity, image_id = None, owner = None, index = None, waifu_id = None, fav = None, normal_url = None, mirror_url = None, flipped_url = None):
         self.character = character
         self.image = image
@@ -297,6 +311,25 @@ class Waifu:
         )
     
 
+    @staticmethod
+    def create_multi_roll_embed(waifus, currency, total, price):
+        '''
+        Create a Discord embed for several waifus rolled at once, showing the rarest one.
+        '''
+
+        lines = [f'You rolled **{len(waifus)}** waifus!\n']
+        lines.extend(str(waifu) for waifu in waifus)
+        lines.append(f'\n:coin: Your {currency}: {total} (-{price})')
+
+        best = max(waifus, key = lambda waifu: waifu.rarity)
+
+        return display.create_embed(
+            f"{best.owner.display_name}'s Gacha Roll",
+            '\n'.join(lines),
+            thumbnail = best.image_url
+        )
+
+
     def obfuscated_url(self):
         '''
         The waifu's image's URL, but with some unused parameters to slow down googlers.
@@ -334,3 +367,45 @@ class Waifu:
             newquery = ''
 
         return f'{url.scheme}://{url.netloc}{newpath}?{newquery}'
+
+
+class InventoryPages:
+    '''
+    Fetches the pages of a user's inventory as they are viewed, for display.lazy_page.
+
+    Pages are read with keyset pagination, continuing from the waifus ids of a neighbouring page that was already
+    fetched. Only jumping to an unvisited page has to skip through the inventory, and then only its index.
+    '''
+
+    def __init__(self, user, page_size):
+        self.user = user
+        self.page_size = page_size
+
+        # Page number -> (first waifus id, last waifus id) of the pages fetched so far.
+        self.bounds = {}
+
+
+    async def fetch(self, page_no):
+        start = page_no * self.page_size
+
+        if page_no - 1 in self.bounds:
+            data = await adb.get_waifu_page(self.user.id, after_id = self.bounds[page_no - 1][1], limit = self.page_size, start_index = start)
+
+        elif page_no + 1 in self.bounds:
+            data = await adb.get_waifu_page(self.user.id, before_id = self.bounds[page_no + 1][0], limit = self.page_size, start_index = start)
+
+        elif start:
+            after_id = await adb.get_waifu_id_at(self.user.id, start - 1)
+
+            if after_id is None:
+                return []
+
+            data = await adb.get_waifu_page(self.user.id, after_id = after_id, limit = self.page_size, start_index = start)
+
+        else:
+            data = await adb.get_waifu_page(self.user.id, limit = self.page_size)
+
+        if data:
+            self.bounds[page_no] = (data[0]['waifus_id'], data[-1]['waifus_id'])
+
+        return [Waifu.from_data(waifu, self.user) for waifu in data]
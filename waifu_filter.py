@@ -1,5 +1,4 @@
 import database_tools as db
-import name_tools as nt
 from show import Show
 
 class Filter:
@@ -19,8 +18,9 @@ class Filter:
             
             if next_type == 'name' or (next_type is None and not arg.startswith('-')):
                 # To avoid name order mattering, split the name up and check each segment.
+                # The characters matching a segment are looked up once, using their stored normalized names.
                 for part in arg.split():
-                    self.filters.append(lambda waifu, q = nt.normalize_romanization(part): q in nt.normalize_romanization(waifu.character.en_name) or (waifu.character.ja_name and q in waifu.character.ja_name))
+                    self.filters.append(lambda waifu, q = db.get_character_ids_with_name_part(part): waifu.character.character_id in q)
 
             elif next_type == 'rarity':
                 self.filters.append(lambda waifu, q = int(arg) - 1: waifu.rarity == q)
@@ -0,0 +1,78 @@
+import threading
+
+
+class PendingRewards:
+    '''
+    Drop rewards that have been granted but not written to the database yet.
+
+    database_tools writes them in one transaction per tick. Until then, reads of a user's balances add the pending
+    amounts, so the user sees their own rewards straight away. Hold `lock` while reading the database and the pending
+    amounts together, the flush holds it while committing.
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.waifus = []
+        self.totals = {}
+
+
+    def __contains__(self, user_id):
+        return user_id in self.totals
+
+
+    def __bool__(self):
+        return bool(self.totals)
+
+
+    def add(self, user_id, image_id, rarity, currency, upgrades):
+        '''
+        Queue a reward. Returns the user's pending totals including it.
+        '''
+
+        with self.lock:
+            self.waifus.append((user_id, image_id, rarity))
+
+            totals = self.totals.setdefault(user_id, {"currency": 0, "upgrades": 0, "waifus": 0})
+            totals["currency"] += currency
+            totals["upgrades"] += upgrades
+            totals["waifus"] += 1
+
+            return dict(totals)
+
+
+    def pending_for(self, user_id, key):
+        '''
+        Get the pending amount of "currency", "upgrades" or "waifus" for a user.
+        '''
+
+        totals = self.totals.get(user_id)
+        return totals[key] if totals else 0
+
+
+    def clear(self):
+        self.waifus = []
+        self.totals = {}
+
+
+    def drain(self):
+        '''
+        Take every queued reward out, as (waifus, totals). Hold `lock` until they are written or restored.
+        '''
+
+        drained = self.waifus, self.totals
+        self.clear()
+        return drained
+
+
+    def restore(self, waifus, totals):
+        '''
+        Queue drained rewards again, ahead of any queued since, after writing them failed.
+        '''
+
+        with self.lock:
+            self.waifus = waifus + self.waifus
+
+            for user_id, pending in totals.items():
+                current = self.totals.setdefault(user_id, {"currency": 0, "upgrades": 0, "waifus": 0})
+                for key, amount in pending.items():
+                    current[key] += amount